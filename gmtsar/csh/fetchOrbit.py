@@ -6,7 +6,9 @@ import re
 import os
 import argparse
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from html.parser import HTMLParser
+from orbitIndex import fileToRange, orbitType, expandInputs, loadOrbitIndex, buildIntervals, findOrbit
 
 server = 'https://scihub.copernicus.eu/gnss/'
 
@@ -26,11 +28,19 @@ def cmdLineParse():
     Command line parser.
     '''
 
-    parser = argparse.ArgumentParser(description='Fetch orbits corresponding to given SAFE package')
-    parser.add_argument('-i', '--input', dest='input', type=str, required=True,
-                        help='Path to SAFE package of interest')
+    parser = argparse.ArgumentParser(description='Fetch orbits corresponding to given SAFE packages')
+    parser.add_argument('-i', '--input', dest='input', type=str, required=True, nargs='+',
+                        help='Path to SAFE package(s) of interest, directories of SAFE packages '
+                             'or text files listing them')
     parser.add_argument('-o', '--output', dest='outdir', type=str, default='.',
                         help='Path to output directory')
+    parser.add_argument('-a', '--archive', dest='archive', type=str, default=None,
+                        help='Local orbit archive searched before the server and where '
+                             'downloads are kept (default: output directory)')
+    parser.add_argument('-n', '--nproc', dest='nproc', type=int, default=8,
+                        help='Number of concurrent searches and downloads')
+    parser.add_argument('-s', '--server', dest='server', type=str, default=server,
+                        help='Orbit server URL, e.g. a local test server')
 
     return parser.parse_args()
 
@@ -58,15 +68,16 @@ def FileToTimeStamp(safename):
 
 class MyHTMLParser(HTMLParser):
 
-    def __init__(self,url):
+    def __init__(self,url,server=server):
         HTMLParser.__init__(self)
         self.fileList = []
         self._url = url
+        self._server = server
         
     def handle_starttag(self, tag, attrs):
         for name, val in attrs:
             if name == 'href':
-                if val.startswith("https://scihub.copernicus.eu/gnss/odata") and val.endswith(")/"):
+                if val.startswith(self._server + "odata") and val.endswith(")/"):
                     pass
                 else:
                     downloadLink = val.strip()
@@ -79,9 +90,10 @@ class MyHTMLParser(HTMLParser):
             self.fileList.append((self._url, data.strip()))
             
 
-def download_file(url, outdir='.', session=None):
+def download_file(url, outdir='.', session=None, chunk_size=1024*1024):
     '''
     Download file to specified directory.
+    The file is written under a temporary name and renamed when complete.
     '''
 
     if session is None:
@@ -89,35 +101,143 @@ def download_file(url, outdir='.', session=None):
 
     path = outdir
     print('Downloading URL: ', url)
-    request = session.get(url, stream=True, verify=True, auth=credentials)
 
     try:
+        request = session.get(url, stream=True, verify=True, auth=credentials)
         val = request.raise_for_status()
         success = True
     except:
         success = False
 
     if success:
-        with open(path, 'wb') as f:
-            for chunk in request.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
+        try:
+            with open(path + '.part', 'wb') as f:
+                for chunk in request.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+            os.replace(path + '.part', path)
+        except Exception:
+            success = False
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
 
     return success
 
 
-def fileToRange(fname):
+def searchOrbits(session, satName, fileTS, spec, server=server):
     '''
-    Derive datetime range from orbit file name.
+    Query server for orbits of type spec around fileTS.
+    Return the list of (url, name) found.
     '''
 
-    fields = os.path.basename(fname).split('_')
-    start = datetime.datetime.strptime(fields[-2][1:16], datefmt)
-    stop = datetime.datetime.strptime(fields[-1][:15], datefmt)
-    mission = fields[0]
+    delta = datetime.timedelta(days=1)
+    timebef = (fileTS - delta).strftime(queryfmt)
+    timeaft = (fileTS + delta).strftime(queryfmt)
+    url = server + 'search?q=( beginPosition:[{0}T00:00:00.000Z TO {1}T23:59:59.999Z] AND endPosition:[{0}T00:00:00.000Z TO {1}T23:59:59.999Z] ) AND ( (platformname:Sentinel-1 AND filename:{2}_* AND producttype:{3}))&start=0&rows=100'.format(timebef,timeaft, satName,spec[1])
 
-    return (start, stop, mission)
+    try:
+        r = session.get(url, verify=True, auth=credentials)
+        r.raise_for_status()
+        parser = MyHTMLParser(url, server)
+        parser.feed(r.text)
+        return parser.fileList
+    except:
+        return []
+
+
+def linkOrbit(archive, outdir, name):
+    '''
+    Make the orbit name from the archive available in outdir.
+    '''
+
+    src = os.path.join(archive, name)
+    dst = os.path.join(outdir, os.path.basename(name))
+    if os.path.abspath(src) != os.path.abspath(dst) and not os.path.exists(dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(os.path.abspath(src), dst)
+
+
+def fetchOrbits(safes, outdir='.', archive=None, nproc=8, session=None, server=server):
+    '''
+    Find the orbit of every SAFE package in safes, first in the local archive
+    and then on server. Searches for the same satellite and day are done
+    once, each orbit is downloaded once into the archive, and searches and
+    downloads run concurrently over one pooled session.
+    Return a dict SAFE: orbit file name (None if not found).
+    '''
+
+    if not server.endswith('/'):
+        server = server + '/'
+    if archive is None:
+        archive = outdir
+    os.makedirs(archive, exist_ok=True)
+    os.makedirs(outdir, exist_ok=True)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=nproc, pool_maxsize=nproc)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    scenes = {}
+    for safe in safes:
+        fileTS, satName, fileTSStart = FileToTimeStamp(safe)
+        if fileTSStart == []:
+            fileTSStart = fileTS
+        scenes[safe] = (fileTS, satName, fileTSStart)
+
+    intervals = buildIntervals(loadOrbitIndex(archive))
+    result = {}
+    misses = []
+    for safe, (fileTS, satName, fileTSStart) in scenes.items():
+        result[safe] = findOrbit(intervals, satName, fileTSStart, fileTS)
+        if result[safe] is None:
+            misses.append(safe)
+    print('Found orbits of {0} out of {1} SAFE packages in {2}'.format(len(safes) - len(misses), len(safes), archive))
+
+    downloads = {}
+    with ThreadPoolExecutor(max_workers=max(nproc, 1)) as pool:
+        for spec in orbitMap:
+            if len(misses) == 0:
+                break
+            queries = {}
+            for safe in misses:
+                fileTS, satName, fileTSStart = scenes[safe]
+                queries.setdefault((satName, fileTS.date()), fileTS)
+            print('Searching {0} {1} orbits for {2} SAFE packages'.format(len(queries), spec[0], len(misses)))
+            jobs = {key: pool.submit(searchOrbits, session, key[0], fileTS, spec, server) for key, fileTS in queries.items()}
+            hits = {key: job.result() for key, job in jobs.items()}
+
+            remaining = []
+            for safe in misses:
+                fileTS, satName, fileTSStart = scenes[safe]
+                for resulturl, name in hits[(satName, fileTS.date())]:
+                    tbef, taft, mission = fileToRange(os.path.basename(name))
+                    if (tbef <= fileTSStart) and (taft >= fileTS):
+                        result[safe] = name
+                        downloads[name] = resulturl
+                if result[safe] is None:
+                    remaining.append(safe)
+            misses = remaining
+
+        print('Downloading {0} orbit files'.format(len(downloads)))
+        jobs = {name: pool.submit(download_file, url, os.path.join(archive, name), session)
+                for name, url in downloads.items()}
+        for name, job in jobs.items():
+            if not job.result():
+                print('Failed to download URL: ', downloads[name])
+                for safe in result:
+                    if result[safe] == name:
+                        result[safe] = None
+
+    if len(downloads) > 0:
+        loadOrbitIndex(archive)
+    for safe, name in result.items():
+        if name is not None:
+            linkOrbit(archive, outdir, name)
+        else:
+            print('Failed to find {1} orbits for tref {0}'.format(scenes[safe][0], scenes[safe][1]))
+    return result
 
 
 if __name__ == '__main__':
@@ -127,45 +247,7 @@ if __name__ == '__main__':
 
     inps = cmdLineParse()
 
-    fileTS, satName, fileTSStart = FileToTimeStamp(inps.input)
-    print('Reference time: ', fileTS)
-    print('Satellite name: ', satName)
-    match = None
-    session = requests.Session()
-
-    for spec in orbitMap:
-        oType = spec[0]
-        delta = datetime.timedelta(days=1)
-        timebef = (fileTS - delta).strftime(queryfmt)
-        timeaft = (fileTS + delta).strftime(queryfmt)
-        url = server + 'search?q=( beginPosition:[{0}T00:00:00.000Z TO {1}T23:59:59.999Z] AND endPosition:[{0}T00:00:00.000Z TO {1}T23:59:59.999Z] ) AND ( (platformname:Sentinel-1 AND filename:{2}_* AND producttype:{3}))&start=0&rows=100'.format(timebef,timeaft, satName,spec[1])
-        
-        success = False
-        match = None
-  
-        try:
-            r = session.get(url, verify=True, auth=credentials)
-            r.raise_for_status()
-            parser = MyHTMLParser(url)
-            parser.feed(r.text)
-            for resulturl, result in parser.fileList:
-                tbef, taft, mission = fileToRange(os.path.basename(result))
-                if (tbef <= fileTSStart) and (taft >= fileTS):
-                    matchFileName = result
-                    match = resulturl
-
-            if match is not None:
-                success = True
-        except:
-            pass
-
-        if success:
-            break
-
-    if match is not None:
-        output = os.path.join(inps.outdir, matchFileName)
-        res = download_file(match, output, session)
-        if res is False:
-            print('Failed to download URL: ', match)
-    else:
-        print('Failed to find {1} orbits for tref {0}'.format(fileTS, satName))
+    safes = expandInputs(inps.input)
+    result = fetchOrbits(safes, inps.outdir, inps.archive, inps.nproc, server=inps.server)
+    for safe in safes:
+        print(os.path.basename(os.path.normpath(safe)), result[safe] if result[safe] is None else os.path.basename(result[safe]))
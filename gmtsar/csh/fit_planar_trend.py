@@ -1,29 +1,186 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
+#
+# fit_planar_trend.py fits z = a + b*x + c*y to xyz data and prints a b c.
+#
+# Usage: fit_planar_trend.py unwrap.dat [-bi3f] [-chunk rows] [-robust niter]
+#
+#   unwrap.dat   - x y z as text, as 3 float32 binary columns with -bi3f
+#                  (gmt grd2xyz -bo3f), or a grid (.grd/.nc) read directly
+#   -chunk rows  - number of points read at a time (default 1000000)
+#   -robust n    - reweight outliers with Huber weights for n passes
+#
+# The data are read in chunks and only the sums of the normal equations are
+# kept, so the size of the input is not limited by memory. NaNs are skipped.
 
-import subprocess
-import os.path
+import itertools
 import numpy as np
 import sys
 
-def get_trend(x,y,z):
-    G=np.column_stack((np.ones(np.shape(x)),x,y))
-    #p=(G'*G)\G'*z
-    p=np.dot(np.dot(np.linalg.inv(np.dot(np.transpose(G),G)),np.transpose(G)),z)
-    return p
+def get_trend(x,y,z,w=None,shift=(0.,0.)):
+    # get_trend returns the normal-equation sums of one chunk of points,
+    # A = G'WG and b = G'Wz with G = [1, x-x0, y-y0], and the number of
+    # points used.
+    x=np.asarray(x,dtype=np.float64).ravel()
+    y=np.asarray(y,dtype=np.float64).ravel()
+    z=np.asarray(z,dtype=np.float64).ravel()
+    ok=np.isfinite(x) & np.isfinite(y) & np.isfinite(z)
+    if w is None:
+        w=np.ones(np.shape(z))
+    else:
+        w=np.asarray(w,dtype=np.float64).ravel()
+        ok &= np.isfinite(w)
+    G=np.column_stack((np.ones(np.count_nonzero(ok)),x[ok]-shift[0],y[ok]-shift[1]))
+    Gw=G*w[ok][:,None]
+    return np.dot(np.transpose(Gw),G), np.dot(np.transpose(Gw),z[ok]), G.shape[0]
+
+def read_chunks(fname,binary=False,chunk=1000000):
+    # read_chunks yields the x, y, z columns of fname in chunks of rows.
+    if fname.endswith('.grd') or fname.endswith('.nc'):
+        import xarray as xr
+        ds=xr.open_dataset(fname,cache=False)
+        da=ds['z'] if 'z' in ds.data_vars else ds[list(ds.data_vars)[0]]
+        ydim,xdim=da.dims
+        xc=da[xdim].values
+        yc=da[ydim].values
+        rows=max(chunk//len(xc),1)
+        for i0 in range(0,len(yc),rows):
+            z=np.asarray(da[i0:i0+rows,:].values)
+            x,y=np.meshgrid(xc,yc[i0:i0+rows])
+            yield x,y,z
+        ds.close()
+    elif binary:
+        with open(fname,'rb') as f:
+            while True:
+                data=np.fromfile(f,dtype=np.float32,count=3*chunk)
+                if data.size<3:
+                    break
+                data=data[:data.size//3*3].reshape(-1,3)
+                yield data[:,0],data[:,1],data[:,2]
+    else:
+        with open(fname,'r') as f:
+            while True:
+                lines=list(itertools.islice(f,chunk))
+                if len(lines)==0:
+                    break
+                data=np.loadtxt(lines,ndmin=2)
+                yield data[:,0],data[:,1],data[:,2]
+
+def huber_weights(r,sigma,k=1.345):
+    # Huber weights of the residuals r for a residual scale sigma.
+    a=np.abs(r)/(k*sigma)
+    return np.where(a<=1.,1.,1./np.maximum(a,1e-12))
+
+def residuals(x,y,z,p,shift):
+    # residuals of z from the plane p about shift, as float64.
+    return np.asarray(z,dtype=np.float64)-p[0]-p[1]*(np.asarray(x,dtype=np.float64)-shift[0])-p[2]*(np.asarray(y,dtype=np.float64)-shift[1])
+
+def stream_select(chunks,k,lo,hi,bins=4096,keep=1<<20):
+    # stream_select returns the value of rank k (from 0) among the values
+    # yielded by chunks(), all within [lo, hi]. Each pass histograms the
+    # values and narrows [lo, hi] to the bin holding rank k; once that bin
+    # holds at most keep values, a last pass collects them and picks rank k.
+    below=0
+    while hi>lo:
+        counts=np.zeros(bins,dtype=np.int64)
+        for v in chunks():
+            v=v[(v>=lo) & (v<=hi)]
+            counts+=np.bincount(np.minimum(((v-lo)*(bins/(hi-lo))).astype(np.int64),bins-1),minlength=bins)
+        cum=below+np.cumsum(counts)
+        j=min(int(np.searchsorted(cum,k+1)),bins-1)
+        width=(hi-lo)/bins
+        lo_j,hi_j=lo+j*width,min(lo+(j+1)*width,hi)
+        if (lo_j,hi_j)==(lo,hi):
+            break
+        below=cum[j]-counts[j]
+        lo,hi=lo_j,hi_j
+        if counts[j]<=keep:
+            break
+    # widen [lo, hi] by the rounding of the bin edges; the rank is exact anyway
+    eps=1e-6*(hi-lo)+8*np.spacing(max(abs(lo),abs(hi)))
+    lo,hi=lo-eps,hi+eps
+    below=0
+    vals=[]
+    for v in chunks():
+        below+=np.count_nonzero(v<lo)
+        vals.append(v[(v>=lo) & (v<=hi)])
+    vals=np.sort(np.concatenate(vals))
+    if vals.size==0:
+        return lo
+    return float(vals[min(max(k-below,0),vals.size-1)])
+
+def mad_scale(fname,binary,chunk,p,shift):
+    # mad_scale returns the robust residual scale 1.4826*MAD of the plane p.
+    # The median and the MAD are found by stream_select, so memory does not
+    # grow with the number of points.
+    def res():
+        for x,y,z in read_chunks(fname,binary,chunk):
+            r=residuals(x,y,z,p,shift).ravel()
+            yield r[np.isfinite(r)]
+    n,lo,hi=0,np.inf,-np.inf
+    for r in res():
+        if r.size>0:
+            n+=r.size
+            lo,hi=min(lo,r.min()),max(hi,r.max())
+    if n==0:
+        return 0.
+    med=stream_select(res,n//2,lo,hi)
+    dev=lambda: (np.abs(r-med) for r in res())
+    return 1.4826*stream_select(dev,n//2,0.,max(hi-med,med-lo))
+
+def fit_trend(fname,binary=False,chunk=1000000,robust=0,tol=1e-10):
+    # fit_trend returns (a, b, c) of z = a + b*x + c*y fitted to fname.
+    # Each pass streams the data once; robust > 0 adds that many
+    # iteratively reweighted passes, each preceded by a pass that sets
+    # the Huber scale to 1.4826*MAD of the residuals.
+    shift=None
+    p=None
+    sigma=None
+    for it in range(robust+1):
+        if p is not None:
+            sigma=mad_scale(fname,binary,chunk,p,shift)
+            if sigma==0.:
+                break
+        A=np.zeros((3,3))
+        b=np.zeros(3)
+        n=0
+        for x,y,z in read_chunks(fname,binary,chunk):
+            if shift is None:
+                # shift the coordinates to the first chunk's mean to keep G'G well conditioned.
+                ok=np.isfinite(x) & np.isfinite(y) & np.isfinite(z)
+                if not ok.any():
+                    continue
+                shift=(float(np.mean(x[ok])),float(np.mean(y[ok])))
+            w=None
+            if p is not None:
+                w=huber_weights(residuals(x,y,z,p,shift),sigma)
+            dA,db,dn=get_trend(x,y,z,w,shift)
+            A+=dA
+            b+=db
+            n+=dn
+        if n<3:
+            sys.exit('fit_planar_trend.py: not enough valid points in '+fname)
+        p_new=np.linalg.solve(A,b)
+        converged=p is not None and np.allclose(p_new,p,rtol=tol,atol=tol)
+        p=p_new
+        if converged:
+            break
+    return p[0]-p[1]*shift[0]-p[2]*shift[1], p[1], p[2]
 
 if __name__ == '__main__':
 
+    if len(sys.argv)<2:
+        sys.exit('Usage: fit_planar_trend.py unwrap.dat [-bi3f] [-chunk rows] [-robust niter]')
+
     # load data from the unwrapped subset
     unwrap=sys.argv[1] # eg. unwrap.dat
-    data=np.loadtxt(unwrap)
-    x=data[:,0]
-    y=data[:,1]
-    z=data[:,2]
+    binary='-bi3f' in sys.argv
+    chunk=int(sys.argv[sys.argv.index('-chunk')+1]) if '-chunk' in sys.argv else 1000000
+    robust=int(sys.argv[sys.argv.index('-robust')+1]) if '-robust' in sys.argv else 0
 
     # find the trend
-    trend_params=get_trend(x,y,z)
-    print('%.15f %.15f %.15f') %(trend_params[0], trend_params[1],trend_params[2])
+    trend_params=fit_trend(unwrap,binary,chunk,robust)
+    print('%.15f %.15f %.15f' %(trend_params[0], trend_params[1],trend_params[2]))
+
 
 
-    
 ## END ##
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+#
+# intfBatch.py runs the interferograms of intf.in with the steps of
+# intf_tops.csh as a graph of jobs on a local pool of processes:
+#
+#   preproc (optional) -> topo -> intf+filter -> unwrap -> geocode
+#                          topo -> [landmask] -> unwrap
+#
+# A job starts once the jobs it depends on are done, when a process slot is
+# free and its memory estimate fits the memory budget. The state of every job
+# is saved in a checkpoint file after each job, so running the same command
+# again only runs the jobs that failed or did not run. It replaces
+# intf_tops_parallel.csh and unwrap_parallel.csh and needs no GNU parallel.
+#
+# Usage: intfBatch.py intf.in batch_tops.config [-n N] [-m GB] [options]
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import subprocess
+
+#Order of the steps of a pair; later steps are started first to finish pairs early
+steps = ['preproc', 'topo', 'intf', 'landmask', 'unwrap', 'geocode']
+
+#Memory estimate (MB) of each step: fixed part, and MB per MB of its input files
+memModel = {'preproc': (2000, 0.), 'topo': (500, 8.), 'intf': (500, 2.5),
+            'landmask': (500, 0.), 'unwrap': (500, 15.), 'geocode': (500, 1.5)}
+
+
+def cmdLineParse():
+    '''
+    Command line parser.
+    '''
+
+    parser = argparse.ArgumentParser(description='Run the interferograms of intf.in as a graph of jobs '
+                                                 'with memory budgets and checkpoint/resume')
+    parser.add_argument('intf', type=str, help='intf.in, a list of ref_stem:rep_stem')
+    parser.add_argument('config', type=str, help='batch_tops.config')
+    parser.add_argument('-n', '--nproc', dest='nproc', type=int, default=os.cpu_count(),
+                        help='Maximum number of jobs running at the same time')
+    parser.add_argument('-m', '--memory', dest='memory', type=float, default=0.,
+                        help='Memory budget in GB shared by the running jobs (default: 90%% of MemAvailable)')
+    parser.add_argument('--mem', dest='mem', type=str, action='append', default=[],
+                        help='Memory estimate of a step in MB, e.g. --mem unwrap=8000 (repeatable)')
+    parser.add_argument('-p', '--preproc', dest='preproc', type=str, default=None,
+                        help='Pre-processing command run in raw/ before everything else, '
+                             'e.g. "preproc_batch_tops.csh data.in dem.grd 2"')
+    parser.add_argument('-s', '--state', dest='state', type=str, default='intfBatch.json',
+                        help='Checkpoint file of the job states (default: intfBatch.json)')
+    parser.add_argument('-l', '--logs', dest='logs', type=str, default='intfBatch_logs',
+                        help='Directory of the job logs')
+    parser.add_argument('-r', '--retries', dest='retries', type=int, default=1,
+                        help='Times a job killed by a signal (e.g. out of memory) is retried alone')
+    parser.add_argument('-f', '--force', dest='force', action='store_true',
+                        help='Ignore the checkpoint file and run all jobs')
+    parser.add_argument('--dry-run', dest='dryrun', action='store_true',
+                        help='Print the jobs and their dependencies and exit')
+
+    return parser.parse_args()
+
+
+def readConfig(fname):
+    '''
+    Return the "name = value" parameters of a batch config file as a dict of strings.
+    '''
+
+    config = {}
+    with open(fname, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[1] == '=' and not fields[0].startswith('#'):
+                config[fields[0]] = fields[2] if len(fields) > 2 else ''
+    return config
+
+
+def readPairs(fname):
+    '''
+    Return the (ref, rep) stems of intf.in.
+    '''
+
+    pairs = []
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.strip() != '':
+                ref, rep = line.strip().split(':')[:2]
+                pairs.append((ref, rep))
+    return pairs
+
+
+def prmValue(fname, name):
+    '''
+    Return the value of parameter name in the PRM file fname as a string.
+    '''
+
+    with open(fname, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == name:
+                return fields[2]
+    raise ValueError('no ' + name + ' in ' + fname)
+
+
+def sceneId(stem):
+    '''
+    Return the integer day of SC_clock_start in raw/stem.PRM, as intf_tops.csh names the pair folders.
+    '''
+
+    return str(int(float(prmValue(os.path.join('raw', stem + '.PRM'), 'SC_clock_start'))))
+
+
+def maskRegion():
+    '''
+    Return the region of the landmask, the extent of topo/master.PRM rounded up
+    to the 4/8 increments of landmask.csh. filter.csh (conv) writes phase.grd
+    within 0/num_rng_bins/0/num_lines at any decimation and snaphu.csh cuts the
+    landmask to the phase, so one region serves every pair.
+    '''
+
+    prm = os.path.join('topo', 'master.PRM')
+    xmax = -(-int(prmValue(prm, 'num_rng_bins')) // 4) * 4
+    ymax = -(-int(prmValue(prm, 'num_lines')) // 8) * 8
+    return '0/' + str(xmax) + '/0/' + str(ymax)
+
+
+def pairDir(ref, rep):
+    '''
+    Return the working folder intf/refid_repid of a pair.
+    '''
+
+    return os.path.join('intf', sceneId(ref) + '_' + sceneId(rep))
+
+
+def fileMB(*names):
+    '''
+    Total size in MB of the files that exist among names.
+    '''
+
+    return sum(os.path.getsize(fn) for fn in names if os.path.exists(fn)) / 1e6
+
+
+def buildJobs(pairs, config, preproc=None):
+    '''
+    Return the jobs as a dict name: job, in the order they are listed. A job has
+    its step, the names of the jobs it depends on, and the pair it works on.
+    The folder, command and memory of a job are worked out when it starts,
+    since they depend on the files the jobs before it make.
+    '''
+
+    jobs = {}
+
+    def add(name, step, deps, pair=None):
+        jobs[name] = {'step': step, 'deps': [d for d in deps if d in jobs], 'pair': pair}
+
+    topoPhase = config.get('topo_phase', '1') == '1'
+    stage = int(config.get('proc_stage', '1') or 1)
+    unwrap = float(config.get('threshold_snaphu', '0') or 0) != 0
+    geocode = float(config.get('threshold_geocode', '0') or 0) != 0
+    landmask = unwrap and (config.get('mask_water', '') == '1' or config.get('switch_land', '') == '1')
+
+    if preproc is not None:
+        add('preproc', 'preproc', [])
+    if stage <= 1 and topoPhase:
+        add('topo', 'topo', ['preproc'])
+    if landmask:
+        add('landmask', 'landmask', ['preproc', 'topo'])
+
+    for ref, rep in pairs:
+        pair = ref + ':' + rep
+        add('intf:' + pair, 'intf', ['preproc', 'topo'], (ref, rep))
+        last = 'intf:' + pair
+        if unwrap:
+            add('unwrap:' + pair, 'unwrap', [last, 'landmask'], (ref, rep))
+            last = 'unwrap:' + pair
+        if geocode and topoPhase:
+            add('geocode:' + pair, 'geocode', [last, 'topo'], (ref, rep))
+            last = 'geocode:' + pair
+        jobs[last]['final'] = True
+
+    return jobs
+
+
+def jobCommand(job, config):
+    '''
+    Return (folder, shell command, memory estimate in MB) of a job, following intf_tops.csh.
+    '''
+
+    step = job['step']
+    base, perMB = memModel[step]
+    topoGrd = 'topo_shift.grd' if config.get('shift_topo', '0') == '1' else 'topo_ra.grd'
+
+    if step == 'preproc':
+        return 'raw', job['command'], base
+
+    if step == 'landmask':
+        return 'topo', '[ -f landmask_ra.grd ] || landmask.csh ' + maskRegion(), base
+
+    if step == 'topo':
+        master = config['master_image']
+        region = config.get('region_cut', '')
+        # the job runs in topo/, so clean it in place as cleanup.csh topo does
+        cmd = ['find . -maxdepth 1 -type f ! -name dem.grd -delete', 'cp ../raw/' + master + '.PRM ./master.PRM', 'ln -sf ../raw/' + master + '.LED .']
+        if region != '':
+            cmd += ['cut_slc master.PRM junk ' + region + ' 1', 'mv junk.PRM master.PRM']
+        cmd += ['dem2topo_ra.csh master.PRM dem.grd']
+        if config.get('shift_topo', '0') == '1':
+            cmd += ['ln -sf ../raw/' + master + '.SLC .', 'slc2amp.csh master.PRM 4 amp-' + master + '.grd',
+                    'offset_topo amp-' + master + '.grd topo_ra.grd 0 0 7 topo_shift.grd']
+        return 'topo', ' && '.join(cmd), base + perMB * fileMB('topo/dem.grd')
+
+    ref, rep = job['pair']
+    folder = pairDir(ref, rep)
+    up = '../../'
+
+    if step == 'intf':
+        region = config.get('region_cut', '')
+        cmd = ['ln -sf ' + up + 'raw/' + s + '.' + ext + ' .' for s in (ref, rep) for ext in ('LED', 'SLC')]
+        cmd += ['cp ' + up + 'raw/' + s + '.PRM .' for s in (ref, rep)]
+        if region != '':
+            cmd += ['cut_slc ' + ref + '.PRM junk1 ' + region, 'cut_slc ' + rep + '.PRM junk2 ' + region,
+                    'mv junk1.PRM ' + ref + '.PRM', 'mv junk2.PRM ' + rep + '.PRM',
+                    'mv junk1.SLC ' + ref + '.SLC', 'mv junk2.SLC ' + rep + '.SLC']
+        if config.get('topo_phase', '1') == '1':
+            cmd += ['ln -sf ' + up + 'topo/' + topoGrd + ' .',
+                    'intf.csh ' + ref + '.PRM ' + rep + '.PRM -topo ' + topoGrd]
+        else:
+            cmd += ['intf.csh ' + ref + '.PRM ' + rep + '.PRM']
+        cmd += ['filter.csh ' + ref + '.PRM ' + rep + '.PRM ' + ' '.join(config.get(k, '') or d for k, d in
+                [('filter_wavelength', '200'), ('dec_factor', '2'), ('range_dec', ''), ('azimuth_dec', '')])]
+        mem = base + perMB * fileMB('raw/' + ref + '.SLC', 'raw/' + rep + '.SLC')
+        return folder, ' && '.join(cmd), mem
+
+    if step == 'unwrap':
+        cmd = []
+        if config.get('mask_water', '') == '1' or config.get('switch_land', '') == '1':
+            cmd += ['ln -sf ' + up + 'topo/landmask_ra.grd .']
+        snaphu = 'snaphu_interp.csh' if config.get('near_interp', '') == '1' else 'snaphu.csh'
+        cmd += [snaphu + ' ' + config['threshold_snaphu'] + ' ' + (config.get('defomax', '') or '0')]
+        return folder, ' && '.join(cmd), base + perMB * fileMB(os.path.join(folder, 'phasefilt.grd'))
+
+    if step == 'geocode':
+        cmd = ['rm -f raln.grd ralt.grd trans.dat', 'ln -s ' + up + 'topo/trans.dat .',
+               'geocode.csh ' + config['threshold_geocode']]
+        return folder, ' && '.join(cmd), base + perMB * fileMB('topo/trans.dat')
+
+    raise ValueError('unknown step ' + step)
+
+
+def loadState(fname):
+    '''
+    Return the saved job states, or an empty dict without a checkpoint.
+    '''
+
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def saveState(fname, state):
+    '''
+    Write the job states atomically, so a killed scheduler leaves a valid checkpoint.
+    '''
+
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+
+def memoryBudget():
+    '''
+    Return 90% of MemAvailable in MB, or 0 (no budget) where /proc/meminfo does not exist.
+    '''
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return 0.9 * int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return 0.
+
+
+def finishPair(job):
+    '''
+    Move the folder of a finished pair from intf/ to intf_all/, as intf_tops.csh.
+    '''
+
+    folder = pairDir(*job['pair'])
+    target = os.path.join('intf_all', os.path.basename(folder))
+    os.makedirs('intf_all', exist_ok=True)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    shutil.move(folder, target)
+
+
+def runJobs(jobs, config, nproc, budget, stateFile, logDir, retries=1, memOverride={}):
+    '''
+    Run the jobs not yet done in the checkpoint, at most nproc at a time and
+    within budget MB of estimated memory. A job whose dependencies failed is
+    left blocked. A job killed by a signal, most often the OOM killer, is
+    retried alone up to retries times. Returns the number of jobs not done.
+    '''
+
+    state = loadState(stateFile)
+    os.makedirs(logDir, exist_ok=True)
+    pending = [name for name in jobs if state.get(name, {}).get('status') != 'done']
+    for name in pending:
+        # jobs failed or blocked last time run again; only their memory peak is kept
+        state[name] = {'status': 'pending', 'maxrss_mb': state.get(name, {}).get('maxrss_mb', 0)}
+    running = {}
+    tries = {}
+    alone = set()
+    print('intfBatch.py: ' + str(len(jobs) - len(pending)) + ' jobs done before, ' + str(len(pending)) + ' to run')
+
+    def status(name):
+        return state.get(name, {}).get('status')
+
+    def finish(name, record):
+        state[name] = record
+        saveState(stateFile, state)
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                if any(status(d) in ('failed', 'blocked') for d in jobs[name]['deps']):
+                    pending.remove(name)
+                    finish(name, {'status': 'blocked'})
+                    print('intfBatch.py: ' + name + ' blocked by a failed job')
+
+            ready = [name for name in pending if all(status(d) == 'done' for d in jobs[name]['deps'])]
+            ready.sort(key=lambda name: -steps.index(jobs[name]['step']))
+            used = sum(r['mem'] for r in running.values())
+            exclusive = any(r['name'] in alone for r in running.values())
+            for name in ready:
+                if len(running) >= nproc or exclusive:
+                    break
+                job = jobs[name]
+                try:
+                    folder, cmd, mem = jobCommand(job, config)
+                except (OSError, ValueError, KeyError) as e:
+                    pending.remove(name)
+                    finish(name, {'status': 'failed', 'error': str(e)})
+                    print('intfBatch.py: ' + name + ' could not start: ' + str(e))
+                    continue
+                mem = max(memOverride.get(job['step'], mem), state.get(name, {}).get('maxrss_mb', 0))
+                if len(running) > 0 and name in alone:
+                    break
+                if len(running) > 0 and budget > 0 and used + mem > budget:
+                    continue
+                if job['step'] == 'intf':
+                    if os.path.exists(folder):
+                        shutil.rmtree(folder)
+                    os.makedirs(folder)
+                log = open(os.path.join(logDir, name.replace(':', '_') + '.log'), 'w')
+                proc = subprocess.Popen(cmd, shell=True, cwd=folder, stdout=log, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+                running[proc.pid] = {'name': name, 'proc': proc, 'log': log, 'mem': mem, 'start': time.time()}
+                pending.remove(name)
+                used += mem
+                exclusive = name in alone
+                print('intfBatch.py: start ' + name + ' in ' + folder + ' (' + str(int(mem)) + ' MB)')
+
+            if len(running) == 0:
+                if len(pending) > 0:
+                    print('intfBatch.py: ' + str(len(pending)) + ' jobs cannot start')
+                break
+
+            pid, wstatus, usage = os.wait4(-1, 0)
+            if pid not in running:
+                continue
+            r = running.pop(pid)
+            r['log'].close()
+            r['proc'].returncode = os.waitstatus_to_exitcode(wstatus)
+            name = r['name']
+            record = {'status': 'done' if r['proc'].returncode == 0 else 'failed',
+                      'returncode': r['proc'].returncode, 'elapsed': time.time() - r['start'],
+                      'maxrss_mb': usage.ru_maxrss / 1024., 'estimate_mb': r['mem']}
+            if r['proc'].returncode == 0 and jobs[name].get('final') and jobs[name]['pair'] is not None:
+                finishPair(jobs[name])
+            # the shell reports a command killed by signal n as 128+n
+            killed = r['proc'].returncode < 0 or r['proc'].returncode == 128 + signal.SIGKILL
+            if killed and tries.get(name, 0) < retries:
+                tries[name] = tries.get(name, 0) + 1
+                alone.add(name)
+                pending.append(name)
+                record['status'] = 'retry'
+                print('intfBatch.py: ' + name + ' was killed (out of memory?), retrying alone')
+            else:
+                print('intfBatch.py: ' + record['status'] + ' ' + name + ' in ' + '%.1f' % record['elapsed'] + ' s')
+            finish(name, record)
+
+    except KeyboardInterrupt:
+        for r in running.values():
+            os.killpg(r['proc'].pid, signal.SIGTERM)
+            finish(r['name'], {'status': 'interrupted'})
+        raise
+
+    return sum(1 for name in jobs if status(name) != 'done')
+
+
+if __name__ == '__main__':
+    '''
+    Main driver.
+    '''
+
+    inps = cmdLineParse()
+    config = readConfig(inps.config)
+    pairs = readPairs(inps.intf)
+    jobs = buildJobs(pairs, config, inps.preproc)
+    if inps.preproc is not None:
+        jobs['preproc']['command'] = inps.preproc
+
+    memOverride = {}
+    for item in inps.mem:
+        step, sep, mb = item.partition('=')
+        if sep == '' or step not in memModel:
+            sys.exit('intfBatch.py: --mem ' + item + ' should be step=MB with a step among ' + ', '.join(steps))
+        try:
+            memOverride[step] = float(mb)
+        except ValueError:
+            sys.exit('intfBatch.py: --mem ' + item + ' should be step=MB with MB a number')
+
+    if inps.dryrun:
+        for name, job in jobs.items():
+            print(name + ' <- ' + ' '.join(job['deps']))
+        sys.exit(0)
+
+    if inps.force and os.path.isfile(inps.state):
+        os.remove(inps.state)
+    budget = inps.memory * 1000. if inps.memory > 0 else memoryBudget()
+
+    print('intfBatch.py: ' + str(len(pairs)) + ' pairs, ' + str(len(jobs)) + ' jobs on ' + str(inps.nproc) +
+          ' processes within ' + str(int(budget)) + ' MB')
+    left = runJobs(jobs, config, inps.nproc, budget, inps.state, inps.logs, inps.retries, memOverride)
+    if left > 0:
+        print('intfBatch.py: ' + str(left) + ' jobs not done; run the same command again to resume')
+        sys.exit(1)
+    print('intfBatch.py: all jobs done')
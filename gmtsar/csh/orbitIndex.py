@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import glob
+import bisect
+import argparse
+import datetime
+
+datefmt = "%Y%m%dT%H%M%S"
+
+#Name of the index of EOF files kept in the orbit archive
+indexName = 'orbitIndex.json'
+
+#Orbit types in order of preference
+orbitTypes = ['precise', 'restituted']
+
+
+def cmdLineParse():
+    '''
+    Command line parser.
+    '''
+
+    parser = argparse.ArgumentParser(description='Match SAFE packages to the orbit files of a local orbit archive')
+    parser.add_argument('-d', '--orbits', dest='archive', type=str, required=True,
+                        help='Orbit archive, a directory of EOF files (subdirectories such as S1A/ and S1B/ allowed)')
+    parser.add_argument('-i', '--input', dest='input', type=str, nargs='+', default=[],
+                        help='SAFE package(s), directories of SAFE packages or text files listing them')
+    parser.add_argument('-o', '--output', dest='output', type=str, default='-',
+                        help='Output table (default: standard output)')
+    parser.add_argument('-f', '--format', dest='format', type=str, default='table', choices=['table', 'datain'],
+                        help='table: "SAFE EOF" per line; datain: "image:...:EOF" lines for preproc_batch_tops.csh')
+    parser.add_argument('-s', '--subswath', dest='subswath', type=int, default=1,
+                        help='Subswath of the images written with -f datain')
+    parser.add_argument('-p', '--polarization', dest='pol', type=str, default='vv',
+                        help='Polarization of the images written with -f datain')
+    parser.add_argument('-t', '--type', dest='type', type=str, default='any', choices=['any', 'precise', 'restituted'],
+                        help='Orbit type to use (default: precise if available, else restituted)')
+
+    return parser.parse_args()
+
+
+def fileToRange(fname):
+    '''
+    Derive datetime range from orbit file name.
+    '''
+
+    fields = os.path.basename(fname).split('_')
+    start = datetime.datetime.strptime(fields[-2][1:16], datefmt)
+    stop = datetime.datetime.strptime(fields[-1][:15], datefmt)
+    mission = fields[0]
+
+    return (start, stop, mission)
+
+
+def orbitType(fname):
+    '''
+    Return 'precise' or 'restituted' for an orbit file name.
+    '''
+
+    return 'precise' if 'POEORB' in os.path.basename(fname) else 'restituted'
+
+
+def safeToRange(safename):
+    '''
+    Return mission, start and stop time of a SAFE package from its name.
+    '''
+
+    fields = os.path.basename(os.path.normpath(safename)).split('_')
+    start = datetime.datetime.strptime(fields[-5], datefmt)
+    stop = datetime.datetime.strptime(fields[-4], datefmt)
+
+    return (fields[0], start, stop)
+
+
+def expandInputs(paths):
+    '''
+    Return the SAFE packages given as SAFE paths, directories holding
+    SAFE packages (.SAFE or .zip) or text files listing them.
+    '''
+
+    safes = []
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        if name.startswith('S1') and (name.endswith('.SAFE') or name.endswith('.zip')):
+            safes.append(path)
+        elif os.path.isdir(path):
+            safes += sorted(glob.glob(os.path.join(path, 'S1*.SAFE')) +
+                            glob.glob(os.path.join(path, 'S1*.zip')))
+        elif os.path.isfile(path):
+            with open(path, 'r') as f:
+                safes += [line.strip() for line in f if line.strip() != '']
+        else:
+            safes.append(path)
+
+    return list(dict.fromkeys(safes))
+
+
+def loadOrbitIndex(archive):
+    '''
+    Return the index of the EOF files under the archive directory as a dict
+    relative path: (start, stop, mission). The index is kept in
+    archive/orbitIndex.json together with the modification time of every
+    directory, so only directories that changed since the last call are
+    listed again and only new files are parsed with fileToRange.
+    '''
+
+    fn = os.path.join(archive, indexName)
+    known = {}
+    if os.path.isfile(fn):
+        with open(fn, 'r') as f:
+            known = json.load(f).get('dirs', {})
+
+    dirs = {}
+    changed = not os.path.isfile(fn)
+    stack = ['']
+    while len(stack) > 0:
+        rel = stack.pop()
+        path = os.path.join(archive, rel)
+        mtime = os.stat(path).st_mtime_ns
+        old = known.get(rel, {'mtime': None, 'subdirs': [], 'files': {}})
+        if old['mtime'] == mtime:
+            dirs[rel] = old
+        else:
+            changed = True
+            entry = {'mtime': mtime, 'subdirs': [], 'files': {}}
+            for item in os.scandir(path):
+                if item.is_dir():
+                    entry['subdirs'].append(os.path.join(rel, item.name))
+                elif item.name.startswith('S1') and item.name.endswith('.EOF'):
+                    if item.name in old['files']:
+                        entry['files'][item.name] = old['files'][item.name]
+                    else:
+                        start, stop, mission = fileToRange(item.name)
+                        entry['files'][item.name] = [start.strftime(datefmt), stop.strftime(datefmt), mission]
+            dirs[rel] = entry
+        stack += dirs[rel]['subdirs']
+
+    if changed or dirs.keys() != known.keys():
+        saveOrbitIndex(archive, dirs)
+
+    index = {}
+    for rel, entry in dirs.items():
+        for name, (start, stop, mission) in entry['files'].items():
+            index[os.path.join(rel, name)] = (datetime.datetime.strptime(start, datefmt),
+                                              datetime.datetime.strptime(stop, datefmt), mission)
+    return index
+
+
+def saveOrbitIndex(archive, dirs):
+    '''
+    Write the orbit index atomically; a read-only archive is just not indexed.
+    '''
+
+    fn = os.path.join(archive, indexName)
+    try:
+        with open(fn + '.tmp', 'w') as f:
+            json.dump({'dirs': dirs}, f, sort_keys=True)
+        os.replace(fn + '.tmp', fn)
+    except OSError:
+        print('Could not write the orbit index ' + fn, file=sys.stderr)
+
+
+def buildIntervals(index):
+    '''
+    Sort the orbits of index by start time for every mission and orbit type.
+    Return a dict (mission, type): (starts, stops, names, longest duration),
+    which findOrbit searches by bisection.
+    '''
+
+    groups = {}
+    for name, (start, stop, mission) in index.items():
+        groups.setdefault((mission, orbitType(name)), []).append((start, stop, os.path.basename(name), name))
+
+    intervals = {}
+    for key, items in groups.items():
+        items.sort()
+        longest = max(stop - start for start, stop, base, name in items)
+        intervals[key] = ([item[0] for item in items], [item[1] for item in items],
+                          [item[3] for item in items], longest)
+    return intervals
+
+
+def findOrbit(intervals, mission, tstart, tstop, types=orbitTypes):
+    '''
+    Return the orbit covering [tstart, tstop] for mission, trying the orbit
+    types in order, or None. Only the orbits starting between
+    tstop - (longest duration) and tstart can cover the interval, so the
+    search is a bisection plus a scan over those few orbits. When several
+    orbits cover it, the last produced one is returned.
+    '''
+
+    for otype in types:
+        if (mission, otype) not in intervals:
+            continue
+        starts, stops, names, longest = intervals[(mission, otype)]
+        i0 = bisect.bisect_left(starts, tstop - longest)
+        i1 = bisect.bisect_right(starts, tstart)
+        match = None
+        for i in range(i0, i1):
+            if stops[i] >= tstop and (match is None or os.path.basename(names[i]) > os.path.basename(match)):
+                match = names[i]
+        if match is not None:
+            return match
+    return None
+
+
+def matchOrbits(safes, archive, types=orbitTypes):
+    '''
+    Return a dict SAFE: orbit path (None if no orbit of the archive covers it).
+    '''
+
+    intervals = buildIntervals(loadOrbitIndex(archive))
+    result = {}
+    for safe in safes:
+        mission, start, stop = safeToRange(safe)
+        name = findOrbit(intervals, mission, start, stop, types)
+        result[safe] = None if name is None else os.path.join(archive, name)
+    return result
+
+
+def safeImages(safe, subswath, pol):
+    '''
+    Return the image names (tiff names without extension) of a subswath and
+    polarization in a SAFE package, as listed in data.in.
+    '''
+
+    pattern = os.path.join(safe, 'measurement', '*iw' + str(subswath) + '*' + pol + '*.tiff')
+    return [os.path.basename(fn)[:-5] for fn in sorted(glob.glob(pattern))]
+
+
+def writeOrbitTable(fn, safes, result, fmt='table', subswath=1, pol='vv'):
+    '''
+    Write the SAFE to EOF table: "SAFE EOF" per line (fmt='table'), or the
+    "image:image:...:EOF" lines read by preproc_batch_tops.csh (fmt='datain'),
+    where the images of the SAFE packages of one date share a line.
+    '''
+
+    lines = []
+    dates = {}
+    for safe in safes:
+        orbit = result[safe]
+        if orbit is None:
+            print('No orbit found for ' + safe, file=sys.stderr)
+            continue
+        if fmt == 'datain':
+            images = safeImages(safe, subswath, pol)
+            if len(images) == 0:
+                print('No iw' + str(subswath) + ' ' + pol + ' image found in ' + safe, file=sys.stderr)
+                continue
+            mission, start, stop = safeToRange(safe)
+            key = (mission, start.date(), orbit)
+            if key in dates:
+                k = dates[key]
+                lines[k] = ':'.join(lines[k].split(':')[:-1] + images + [os.path.basename(orbit)])
+            else:
+                dates[key] = len(lines)
+                lines.append(':'.join(images + [os.path.basename(orbit)]))
+        else:
+            lines.append(safe + ' ' + orbit)
+
+    if fn == '-':
+        for line in lines:
+            print(line)
+    else:
+        with open(fn, 'w') as f:
+            for line in lines:
+                f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    '''
+    Main driver.
+    '''
+
+    inps = cmdLineParse()
+    types = orbitTypes if inps.type == 'any' else [inps.type]
+
+    safes = expandInputs(inps.input)
+    result = matchOrbits(safes, inps.archive, types)
+    writeOrbitTable(inps.output, safes, result, inps.format, inps.subswath, inps.pol)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# selectPairs.py selects the interferometric pairs of a baseline table, as
+# select_pairs.csh, and writes intf.in and the baseline network plot.
+#
+# Usage: selectPairs.py baseline_table.dat threshold_time threshold_baseline [options]
+#
+# The table is read once and all pairs are tested at once on the N x N
+# matrices of time and perpendicular baseline differences; the network is
+# plotted with one gmt psxy call for all the pairs.
+
+import os
+import sys
+import argparse
+import subprocess
+import numpy as np
+
+
+def cmdLineParse():
+    '''
+    Command line parser.
+    '''
+
+    parser = argparse.ArgumentParser(description='Select pairs for time series analysis with thresholds '
+                                                 'in time and baseline and write intf.in')
+    parser.add_argument('table', type=str, help='baseline_table.dat')
+    parser.add_argument('dt', type=float, help='Threshold in time (days)')
+    parser.add_argument('db', type=float, help='Threshold in perpendicular baseline (m)')
+    parser.add_argument('-o', '--output', dest='output', type=str, default='intf.in',
+                        help='Output list of pairs (default: intf.in)')
+    parser.add_argument('-m', '--mode', dest='mode', type=str, default='threshold',
+                        choices=['threshold', 'connect', 'mst'],
+                        help='threshold: pairs within both thresholds (select_pairs.csh); '
+                             'connect: also link the disconnected parts of that network with the '
+                             'shortest pairs of the minimum spanning tree; mst: only the minimum '
+                             'spanning tree of the normalized time/baseline distance')
+    parser.add_argument('-c', '--coherence', dest='coherence', type=float, default=0.,
+                        help='Drop pairs whose predicted coherence is below this value')
+    parser.add_argument('--tau', dest='tau', type=float, default=0.,
+                        help='Decorrelation time (days) of the predicted coherence exp(-dt/tau); 0: no temporal term')
+    parser.add_argument('--bcrit', dest='bcrit', type=float, default=0.,
+                        help='Critical baseline (m) of the predicted coherence 1-|dB|/bcrit; 0: no geometric term')
+    parser.add_argument('-t', '--pair-table', dest='pairTable', type=str, default=None,
+                        help='Also write "ref rep dt dB coherence" for every selected pair')
+    parser.add_argument('-p', '--plot', dest='plot', type=str, default='baseline.ps',
+                        help='Network plot (default: baseline.ps); "none" for no plot')
+
+    return parser.parse_args()
+
+
+def loadBaselineTable(fname):
+    '''
+    Return names, days and perpendicular baselines of baseline_table.dat
+    (name, SC_clock_start, days, parallel and perpendicular baseline).
+    '''
+
+    names = []
+    rows = []
+    with open(fname, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            names.append(fields[0])
+            rows.append((float(fields[2]), float(fields[4])))
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 2)
+
+    return np.array(names), rows[:, 0], rows[:, 1]
+
+
+def predictCoherence(dt, db, tau=0., bcrit=0.):
+    '''
+    Predicted coherence of pairs with time span dt and baseline db:
+    exp(-dt/tau) * max(1-|db|/bcrit, 0), each term left out when its scale is 0.
+    '''
+
+    coh = np.ones(np.broadcast(dt, db).shape)
+    if tau > 0:
+        coh = coh * np.exp(-np.abs(dt) / tau)
+    if bcrit > 0:
+        coh = coh * np.maximum(1. - np.abs(db) / bcrit, 0.)
+    return coh
+
+
+def thresholdPairs(days, bperp, dt, db):
+    '''
+    Return the boolean matrix of the pairs (i, j) with days[i] < days[j],
+    days[j] - days[i] < dt and the integer part of |bperp[j] - bperp[i]| < db,
+    the tests of select_pairs.csh.
+    '''
+
+    ddays = days[None, :] - days[:, None]
+    dbase = np.trunc(np.abs(bperp[None, :] - bperp[:, None]))
+    return (ddays > 0) & (ddays < dt) & (dbase < db)
+
+
+def spanningTree(days, bperp, dt, db, selected=None):
+    '''
+    Kruskal's minimum spanning tree of the acquisitions with the distance
+    (ddays/dt)^2 + (dbperp/db)^2. With selected, the pairs already in it are
+    taken first, so only the tree edges joining its disconnected parts are added.
+    Return the boolean matrix of the tree (or of the added) pairs, i < j in time.
+    '''
+
+    n = len(days)
+    order = np.argsort(days, kind='stable')
+    ii, jj = np.triu_indices(n, 1)
+    ii, jj = order[ii], order[jj]
+    keep = days[jj] > days[ii]
+    ii, jj = ii[keep], jj[keep]
+    dist = ((days[jj] - days[ii]) / dt) ** 2 + ((bperp[jj] - bperp[ii]) / db) ** 2
+
+    parent = np.arange(n)
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    if selected is not None:
+        for i, j in zip(*np.nonzero(selected)):
+            parent[find(i)] = find(j)
+
+    tree = np.zeros((n, n), dtype=bool)
+    for k in np.argsort(dist, kind='stable'):
+        a, b = find(ii[k]), find(jj[k])
+        if a != b:
+            parent[a] = b
+            tree[ii[k], jj[k]] = True
+    return tree
+
+
+def plotNetwork(fname, names, days, bperp, pairs):
+    '''
+    Plot the acquisitions and the pairs in year/baseline space, as
+    select_pairs.csh, with one gmt psxy call for all the pairs.
+    '''
+
+    year = 2014 + days / 365.25
+    region = '-R%g/%g/%g/%g' % (year.min() - 0.5, year.max() + 0.5, bperp.min() - 50, bperp.max() + 50)
+    text = ''.join('%.6f %.6f %s\n' % (year[k], bperp[k], names[k]) for k in range(len(names)))
+    segments = ''.join('>\n%.6f %.6f\n%.6f %.6f\n' % (year[i], bperp[i], year[j], bperp[j]) for i, j in pairs)
+    points = ''.join('%.6f %.6f\n' % (year[k], bperp[k]) for k in range(len(names)))
+
+    with open(fname, 'w') as f:
+        subprocess.run(['gmt', 'pstext', '-JX8.8i/6.8i', region, '-D0.2/0.2', '-X1.5i', '-Y1i', '-K', '-N',
+                        '-F+f8,Helvetica+j5'], input=text, stdout=f, text=True)
+    with open(fname, 'a') as f:
+        if len(pairs) > 0:
+            subprocess.run(['gmt', 'psxy', '-R', '-J', '-K', '-O'], input=segments, stdout=f, text=True)
+        subprocess.run(['gmt', 'psxy', '-Sp0.2c', '-G0', '-R', '-JX',
+                        '-Ba0.5:"year":/a50g00f25:"baseline (m)":WSen', '-O'], input=points, stdout=f, text=True)
+
+
+if __name__ == '__main__':
+    '''
+    Main driver.
+    '''
+
+    inps = cmdLineParse()
+    names, days, bperp = loadBaselineTable(inps.table)
+    print('selectPairs.py: ' + str(len(names)) + ' acquisitions in ' + inps.table)
+
+    if inps.mode == 'mst':
+        selected = spanningTree(days, bperp, inps.dt, inps.db)
+    else:
+        selected = thresholdPairs(days, bperp, inps.dt, inps.db)
+
+    ddays = days[None, :] - days[:, None]
+    dbase = bperp[None, :] - bperp[:, None]
+    coh = predictCoherence(ddays, dbase, inps.tau, inps.bcrit)
+    if inps.coherence > 0:
+        selected &= coh >= inps.coherence
+
+    if inps.mode == 'connect':
+        added = spanningTree(days, bperp, inps.dt, inps.db, selected)
+        print('selectPairs.py: ' + str(np.count_nonzero(added)) + ' pairs added to connect the network')
+        selected |= added
+
+    pairs = list(zip(*np.nonzero(selected)))
+    with open(inps.output, 'w') as f:
+        for i, j in pairs:
+            f.write(names[i] + ':' + names[j] + '\n')
+    print('selectPairs.py: ' + str(len(pairs)) + ' pairs written to ' + inps.output)
+
+    if inps.pairTable is not None:
+        with open(inps.pairTable, 'w') as f:
+            for i, j in pairs:
+                f.write('%s %s %g %.2f %.4f\n' % (names[i], names[j], ddays[i, j], dbase[i, j], coh[i, j]))
+
+    if inps.plot != 'none':
+        plotNetwork(inps.plot, names, days, bperp, pairs)
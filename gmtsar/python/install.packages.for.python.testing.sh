@@ -1,3 +1,3 @@
 #! /bin/bash
 
-apt install python3-skimage python3-matplotlib python3-xarray
+apt install python3-skimage python3-matplotlib python3-xarray python3-netcdf4
@@ -1,10 +1,11 @@
 #! /usr/bin/env python3
-import os, time
+import os, sys, time
 import numpy as np
 import xarray as xr
 from skimage import io
 from skimage.metrics import structural_similarity as ssim
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from pathListForTest import caseNameList, intfDirList, rawDir, SLCDir
 
 fileNameList = ['corr_ll.png','display_amp_ll.png','phasefilt_mask_ll.png',
@@ -12,42 +13,82 @@ fileNameList = ['corr_ll.png','display_amp_ll.png','phasefilt_mask_ll.png',
 refRoot  = 'csh.test'
 testRoot = 'py.test'
 fileDiffNumericThreshold = 1e-3
+phaseDiffNumericThreshold = 0.1
 imageSimilarityIndexThreshold = 0.999
+chunkRows = 4096
+ssimPyramidFactors = [8, 4, 2, 1]
 
-def parseCmdOutput(fn, searchStr):
-    with open(fn,'r') as f:
-        for line in f:
-            if searchStr in line:
-                val = line.split()
-                keyIndex = val.index(searchStr)
-                result = float(val[keyIndex+1])
-    return result
+def openGrid(fn, useDask=False):
+    # openGrid opens the first data variable of a NetCDF grid lazily; with
+    # useDask (and dask installed) it is backed by dask chunks of chunkRows rows.
+    if useDask:
+        ds = xr.open_dataset(fn, chunks={})
+        ds = ds.chunk({ds[list(ds.data_vars)[0]].dims[0]: chunkRows})
+    else:
+        ds = xr.open_dataset(fn, cache=False)
+    return ds, ds[list(ds.data_vars)[0]]
+
+def diffStats(z1, z2, useDask=False):
+    # diffStats computes mean, stdev, rms and max-abs of z1-z2 over the nodes
+    # where both are finite (as gmt grdmath SUB + gmt grdinfo -L2) in one pass,
+    # reading chunkRows rows of each grid at a time. Per-chunk (n, mean, M2)
+    # are merged as in grid_lib.grd_info_stats so the stdev of a tiny offset
+    # between large, nearly equal grids does not cancel to zero.
+    if z1.shape != z2.shape:
+        return None
+    if useDask:
+        import dask, dask.array
+        d = z1.data.astype(np.float64)-z2.data.astype(np.float64)
+        d = dask.array.where(dask.array.isfinite(d), d, np.nan)
+        n, mean, var, ss, m = dask.compute(dask.array.isfinite(d).sum(), dask.array.nanmean(d),
+                                           dask.array.nanvar(d, ddof=1), dask.array.nansum(d*d),
+                                           dask.array.nanmax(abs(d)))
+        m2 = var*(n-1) if n > 1 else 0.
+    else:
+        n, mean, m2, ss, m = 0, 0., 0., 0., 0.
+        for i0 in range(0, z1.shape[0], chunkRows):
+            d = np.asarray(z1[i0:i0+chunkRows], dtype=np.float64)-np.asarray(z2[i0:i0+chunkRows], dtype=np.float64)
+            d = d[np.isfinite(d)]
+            if d.size == 0:
+                continue
+            bmean = d.mean()
+            bm2 = np.sum((d-bmean)**2)
+            delta = bmean-mean
+            mean += delta*d.size/(n+d.size)
+            m2 += bm2+delta*delta*n*d.size/(n+d.size)
+            ss += np.dot(d, d)
+            n += d.size
+            m = max(m, np.abs(d).max())
+    if n == 0:
+        return {'n': 0, 'mean': np.nan, 'stdev': np.nan, 'rms': np.nan, 'maxabs': np.nan}
+    var = m2/(n-1) if n > 1 else 0.
+    return {'n': int(n), 'mean': float(mean), 'stdev': float(np.sqrt(var)),
+            'rms': float(np.sqrt(ss/n)), 'maxabs': float(m)}
+
+def sameAttrs(a1, a2):
+    # attributes may hold arrays such as actual_range
+    return a1.keys() == a2.keys() and all(np.array_equal(a1[k], a2[k]) for k in a1)
 
 def compare_nc_files(fn1,fn2,threshold=1e-3):
     isTheSame = 'SUCCESS '+fn1+' '+fn2
     f1 = xr.open_dataset(fn1)
     f2 = xr.open_dataset(fn2)
-    metadata_equal = f1.identical(f2)
-    data_equal = (f1==f2).all().items()
     
-    # Compare variables
+    # Compare variables, loading each of them once
     for var in f1.variables:
-        var1 = f1[var]
-        var2 = f2[var]
-        if var1.dims != var2.dims:
+        if var not in f2.variables or f1[var].dims != f2[var].dims:
             isTheSame = 'FAIL var dim '+fn1+' '+fn2
-        if not np.allclose(var1,var2,rtol=threshold, atol=threshold):
+            continue
+        v1 = f1[var].values
+        v2 = f2[var].values
+        if v1.shape != v2.shape or not np.allclose(v1,v2,rtol=threshold, atol=threshold, equal_nan=True):
             isTheSame = 'FAIL var numbers '+fn1+' '+fn2
-        
-    if not metadata_equal:# and data_equal:
-        isTheSame = 'FAIL metadata '+fn1+' '+fn2
     
-    try:
-        xr.testing.assert_allclose(f1,f2)
-        print('SUCCESS by xarray.testing.assert_allclose')
-        print('SUCCESS '+fn1 +' '+fn2)
-    except AssertionError as e:
-        print(e)
+    if not sameAttrs(f1.attrs, f2.attrs) or \
+       not all(sameAttrs(f1[var].attrs, f2[var].attrs) for var in f1.variables if var in f2.variables):
+        isTheSame = 'FAIL metadata '+fn1+' '+fn2
+    f1.close()
+    f2.close()
     print(isTheSame)
     
     return isTheSame
@@ -55,50 +96,72 @@ def compare_nc_files(fn1,fn2,threshold=1e-3):
 def compare_txt_files(fn1,fn2,threshold=1e-3):
     isTheSame = 'SUCCESS '+fn1+' '+fn2
     with open(fn1,'r') as f1, open(fn2,'r') as f2:
-        result1 = f1.read().split()
-        result2 = f2.read().split()
-    if len(result1) != len(result2):
+        result1 = np.array(f1.read().split(), dtype=float)
+        result2 = np.array(f2.read().split(), dtype=float)
+    if len(result1) != len(result2) or np.any(np.abs(result1-result2) > threshold):
         isTheSame = 'FAIL '+fn1+' '+fn2
-    
-    for num1,num2 in zip(result1,result2):
-        fnum1, fnum2 = float(num1),float(num2)
-        if abs(fnum1-fnum2) > threshold:
-            isTheSame = 'FAIL '+fn1+' '+fn2
     print(isTheSame)
+    return isTheSame
 
-def compare_files(fnNew, fnRef, fileName, fileType):
+def downsample(image, factor):
+    # block-average factor x factor pixels; the image is cropped to a multiple of factor.
+    if factor == 1:
+        return image.astype(np.float64)
+    ny = image.shape[0]//factor*factor
+    nx = image.shape[1]//factor*factor
+    blocks = image[:ny, :nx].astype(np.float64).reshape((ny//factor, factor, nx//factor, factor)+image.shape[2:])
+    return blocks.mean(axis=(1, 3))
+
+def compare_images(fnNew, fnRef, fileName):
+    # compare_images checks shape and dtype first, then computes SSIM from the
+    # coarsest level of an image pyramid down to full resolution, stopping as
+    # soon as a level clears imageSimilarityIndexThreshold.
+    isTheSame = 'SUCCESS: python and csh '+fileName+' are the same'
+    notTheSame = 'FAIL: python and csh '+fileName+' are different'
+    imageNew = io.imread(fnNew)
+    imageRef = io.imread(fnRef)
+    if imageNew.shape != imageRef.shape:
+        return notTheSame+' image shapes do not match '+str(imageNew.shape)+' '+str(imageRef.shape)
+    if imageNew.dtype != imageRef.dtype:
+        return notTheSame+' image dtypes do not match '+str(imageNew.dtype)+' '+str(imageRef.dtype)
+    if np.issubdtype(imageRef.dtype, np.integer):
+        dataRange = np.iinfo(imageRef.dtype).max-np.iinfo(imageRef.dtype).min
+    else:
+        dataRange = 1.
+    channelAxis = -1 if imageRef.ndim == 3 else None
+
+    ssim_index = np.nan
+    for factor in ssimPyramidFactors:
+        if min(imageRef.shape[:2])//factor < 7:
+            continue
+        ssim_index = ssim(downsample(imageNew, factor), downsample(imageRef, factor),
+                          data_range=dataRange, channel_axis=channelAxis)
+        if ssim_index>imageSimilarityIndexThreshold:
+            return isTheSame+' '+f'SSIM: {ssim_index} at 1/{factor} resolution'
+    return notTheSame+' '+f'SSIM: {ssim_index}'
+
+def compare_files(fnNew, fnRef, fileName, fileType, useDask=False):
     isTheSame = 'SUCCESS: python and csh '+fileName+' are the same'
     notTheSame = 'FAIL: python and csh '+fileName+' are different'
 
     if fileType=='png':
-        imageNew = io.imread(fnNew)
-        imageRef = io.imread(fnRef)
-        #assert imageNew.shape == imageRef.shape, 'Images must be the same shape.'
-        try:
-            ssim_index = ssim(imageNew,imageRef,multichannel=True)
-            if ssim_index>imageSimilarityIndexThreshold:
-                print(isTheSame+' '+f'SSIM: {ssim_index}')
-            else:
-                print(notTheSame+' '+f'SSIM: {ssim_index}')
-        except:
-            print(notTheSame+' no SSIM')
-
-        if imageNew.shape != imageRef.shape:
-            print(notTheSame+' image shapes do not match')
+        print(compare_images(fnNew, fnRef, fileName))
     elif fileType=='grd':
-        os.system('gmt grdmath '+fnNew+' '+fnRef+' SUB = diff.grd')
-        os.system('gmt grdinfo -L2 diff.grd > gmt.log.txt')
-        mean = parseCmdOutput('gmt.log.txt', 'mean:')
-        stdev = parseCmdOutput('gmt.log.txt', 'stdev:')
-        rms = parseCmdOutput('gmt.log.txt', 'rms:')
-        #print('Python and csh '+fileName+' "s difference are')
-        #print('mean = ',mean, ' stddev = ', stdev, 'rms = ', rms)
-        if (rms<fileDiffNumericThreshold and not('phase' in fnNew)) or \
-                (rms<0.1 and ('phase' in fnNew)):
-            print(isTheSame+'; diff.grd mean='+str(mean)+' stdev='+str(stdev)+' rms='+str(rms))
+        dsNew, zNew = openGrid(fnNew, useDask)
+        dsRef, zRef = openGrid(fnRef, useDask)
+        stats = diffStats(zNew, zRef, useDask)
+        dsNew.close()
+        dsRef.close()
+        if stats is None:
+            print(notTheSame+' grid shapes do not match')
+            return
+        threshold = phaseDiffNumericThreshold if 'phase' in fnNew else fileDiffNumericThreshold
+        summary = ' diff mean='+str(stats['mean'])+' stdev='+str(stats['stdev'])+ \
+                  ' rms='+str(stats['rms'])+' maxabs='+str(stats['maxabs'])
+        if stats['rms']<threshold:
+            print(isTheSame+';'+summary)
         else:
-            print(notTheSame+' diff.grd mean='+str(mean)+' stdev='+str(stdev)+' rms='+str(rms))
-        os.system('rm diff.grd gmt.log.txt')
+            print(notTheSame+summary)
 
 def findErrorsInLogFiles(rootDir):
     errKeyWordList = ['error', 'Error', 'Traceback', 'ERROR']
@@ -113,18 +176,37 @@ def findErrorsInLogFiles(rootDir):
                         print('No Error found in ', os.path.join(root,file))
 
 
-for caseName in caseNameList:
-    print(' ')
-    print('Comparing case ', caseName)
-    for fileName in fileNameList:
-        for path in intfDirList[caseName]:
-            refPath  = refRoot+'/'+caseName+'/'+path+'/'+fileName
-            testPath = testRoot+'/'+caseName+'/'+path+'/'+fileName
-            if os.path.exists(refPath) and os.path.exists(testPath):
-                if 'png' in fileName:
-                    compare_files(testPath, refPath, fileName, 'png')
-                elif 'grd' in fileName:
-                    compare_files(testPath, refPath, fileName, 'grd')
+def checkTest(useDask=False, nproc=os.cpu_count()):
+    # the png comparisons of all cases are spread over a pool of nproc workers,
+    # grids are compared while the images are being processed.
+    imageJobs = {}
+    with ProcessPoolExecutor(max_workers=max(nproc, 1)) as pool:
+        for caseName in caseNameList:
+            for fileName in fileNameList:
+                for path in intfDirList[caseName]:
+                    refPath  = refRoot+'/'+caseName+'/'+path+'/'+fileName
+                    testPath = testRoot+'/'+caseName+'/'+path+'/'+fileName
+                    if 'png' in fileName and os.path.exists(refPath) and os.path.exists(testPath):
+                        imageJobs[(caseName, fileName, path)] = pool.submit(compare_images, testPath, refPath, fileName)
+
+        for caseName in caseNameList:
+            print(' ')
+            print('Comparing case ', caseName)
+            for fileName in fileNameList:
+                for path in intfDirList[caseName]:
+                    refPath  = refRoot+'/'+caseName+'/'+path+'/'+fileName
+                    testPath = testRoot+'/'+caseName+'/'+path+'/'+fileName
+                    if (caseName, fileName, path) in imageJobs:
+                        print(imageJobs[(caseName, fileName, path)].result())
+                    elif 'grd' in fileName and os.path.exists(refPath) and os.path.exists(testPath):
+                        compare_files(testPath, refPath, fileName, 'grd', useDask)
 
-    findErrorsInLogFiles(testRoot+'/'+caseName)
+            findErrorsInLogFiles(testRoot+'/'+caseName)
 
+if __name__ == '__main__':
+    # python checkTest.py [-dask] [-nproc N]
+    # -dask evaluates the grid differences with dask chunks
+    nproc = os.cpu_count()
+    if '-nproc' in sys.argv:
+        nproc = int(sys.argv[sys.argv.index('-nproc')+1])
+    checkTest('-dask' in sys.argv, nproc)
@@ -1,18 +1,119 @@
 #! /usr/bin/env python3
-import os, time
+"""
+# runAllTest.py runs the README scripts of all cases in caseNameList.
+# Cases run concurrently on a pool of worker processes, each in its own case
+# folder under workAbsoluteDir. A case is skipped (resumed) when its last run
+# is recorded as done in timingReport.json and all of its outputs in
+# intfDirList are newer than its README script, unless -force is given.
+# Timing per case and per p2p stage is written to timingReport.json;
+# timeSpentLog.txt is still appended for each case.
+# Syntax: python3 runAllTest.py [-nproc N] [-cases name1,name2] [-force] [-nocheck]
+"""
+import os, sys, re, time, json, argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from pathListForTest import caseNameList, intfDirList, rawDir, \
     SLCDir, workAbsoluteDir, pythonCommandListPath
 
-for caseName in caseNameList:
+stagePattern = re.compile(r'^(P2P \d+)')
+outputFileName = 'phasefilt.grd'
+
+def cmdLineParse():
+    parser = argparse.ArgumentParser(description='Run the csh-vs-Python regression cases')
+    parser.add_argument('-nproc', dest='nproc', type=int, default=os.cpu_count(),
+                        help='number of cases run at the same time')
+    parser.add_argument('-cases', dest='cases', type=str, default='',
+                        help='comma separated subset of caseNameList')
+    parser.add_argument('-force', dest='force', action='store_true',
+                        help='rerun cases even when their outputs are up to date')
+    parser.add_argument('-nocheck', dest='nocheck', action='store_true',
+                        help='do not run checkTest.py afterwards')
+    return parser.parse_args()
+
+def isUpToDate(caseName, report):
+    # a case is done if its last run finished without error (a case that failed
+    # after stage 4 still has its interferograms) and every intf folder has its
+    # output newer than the README script.
+    if report.get(caseName, {}).get('status') != 'done':
+        return False
+    readme = pythonCommandListPath+'README_'+caseName+'.txt'
+    if not os.path.exists(readme):
+        return False
+    readmeTime = os.path.getmtime(readme)
+    for path in intfDirList[caseName]:
+        fn = workAbsoluteDir+caseName+'/'+path+'/'+outputFileName
+        if not os.path.exists(fn) or os.path.getmtime(fn) < readmeTime:
+            return False
+    return True
+
+def runCase(caseName):
+    # runCase runs one case inside its own folder and times each p2p stage
+    # from the stage markers printed to log.txt.
+    caseDir = workAbsoluteDir+caseName
+    readme = 'README_'+caseName+'.txt'
     startTime = time.time()
-    os.chdir(workAbsoluteDir+caseName)
-    os.system('pwd')
-    os.system('cleanup all')
-    os.system('cp -r '+pythonCommandListPath+'README_'+caseName+'.txt .')
-    os.system('./README_'+caseName+'.txt > log.txt')
+    subprocess.run(['cleanup', 'all'], cwd=caseDir)
+    subprocess.run(['cp', '-r', pythonCommandListPath+readme, '.'], cwd=caseDir)
+
+    stages = {}
+    current = None
+    with open(caseDir+'/log.txt', 'w') as log:
+        # unbuffered so that the stage markers arrive when the stages start
+        proc = subprocess.Popen(['./'+readme], cwd=caseDir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True, bufsize=1,
+                                env=dict(os.environ, PYTHONUNBUFFERED='1'))
+        for line in proc.stdout:
+            log.write(line)
+            match = stagePattern.match(line)
+            if match and match.group(1) != current:
+                now = time.time()
+                if current is not None:
+                    stages[current] = stages.get(current, 0.)+now-stageStart
+                current = match.group(1)
+                stageStart = now
+        returnCode = proc.wait()
+    if current is not None:
+        stages[current] = stages.get(current, 0.)+time.time()-stageStart
+
     elapsedTime = time.time()-startTime
-    with open('timeSpentLog.txt', 'a') as f:
+    with open(caseDir+'/timeSpentLog.txt', 'a') as f:
         f.write(caseName+' used '+str(elapsedTime)+' s \n')
+    return {'status': 'done' if returnCode == 0 else 'failed', 'returncode': returnCode,
+            'elapsed': elapsedTime, 'stages': stages}
+
+def runAllTest():
+    inps = cmdLineParse()
+    cases = caseNameList if inps.cases == '' else inps.cases.split(',')
+
+    reportFile = workAbsoluteDir+'timingReport.json'
+    report = {}
+    if os.path.exists(reportFile):
+        with open(reportFile, 'r') as f:
+            report = json.load(f)
+
+    todo = []
+    for caseName in cases:
+        if not inps.force and isUpToDate(caseName, report):
+            print('Skipping case ', caseName, ' as its outputs are up to date')
+            report[caseName]['skipped'] = True
+        else:
+            todo.append(caseName)
+
+    print('Running cases ', todo, ' on ', inps.nproc, ' workers')
+    with ProcessPoolExecutor(max_workers=max(inps.nproc, 1)) as pool:
+        jobs = {pool.submit(runCase, caseName): caseName for caseName in todo}
+        for job in jobs:
+            caseName = jobs[job]
+            try:
+                report[caseName] = job.result()
+            except Exception as e:
+                report[caseName] = {'status': 'failed', 'error': str(e)}
+            print('Case ', caseName, ' ', report[caseName]['status'])
+            with open(reportFile, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if not inps.nocheck:
+        subprocess.run(['python', 'checkTest.py'], cwd=workAbsoluteDir)
 
-os.chdir(workAbsoluteDir)
-os.system('python checkTest.py')
+if __name__ == '__main__':
+    runAllTest()
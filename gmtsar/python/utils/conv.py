@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+"""
+# conv.py is part of pyGMTSAR.
+# It is an in-process port of the C program conv.
+
+# Purpose: to convolve a grid with a filter from the filters/ directory and
+# output the result at every idec-th row and jdec-th column, as conv does.
+# Separable filters (the Gaussians) are applied as two 1-D passes, large
+# non-separable ones with FFT overlap-add, and only the decimated output
+# nodes are computed. Complex arrays (real + 1j*imag) are filtered in one pass.
+# Syntax: conv.py idec jdec filter_file input output
+
+# read_filter
+# conv_size
+# conv_decimate
+# read_slc_power
+# read_conv_input
+# conv_grid
+# write_conv_grid
+"""
+
+import sys, os
+import numpy as np
+from gmtsar_lib import *
+
+DFACT = 2.5e-07
+FFT_TAPS = 400
+
+def read_filter(fn):
+    # read_filter reads a conv filter file: 'nx ny' then ny rows of nx values.
+    # Returns the (ny, nx) kernel, with the 1-D factors (u, v) if it is
+    # separable (kernel = outer(u, v)) or None otherwise.
+    with open(fn, 'r') as f:
+        tokens = f.read().split()
+    nx, ny = int(tokens[0]), int(tokens[1])
+    if nx < 1 or ny < 1 or nx % 2 == 0 or ny % 2 == 0 or len(tokens) < 2+nx*ny:
+        sys.exit('CONV: filter incomplete '+fn)
+    kernel = np.array(tokens[2:2+nx*ny], dtype=np.float64).reshape(ny, nx)
+    u, s, vt = np.linalg.svd(kernel)
+    factors = None
+    if s[0] > 0 and (len(s) == 1 or s[1] <= 1e-6*s[0]):
+        factors = (u[:, 0]*np.sqrt(s[0]), vt[0, :]*np.sqrt(s[0]))
+    return kernel, factors
+
+def conv_size(xmax, ymax, nx, ny, idec, jdec):
+    # conv_size returns the output increments and size (incx, incy, jout, iout)
+    # of conv for an input of nx by ny nodes whose region ends at xmax, ymax.
+    iout = len(range(0, ny, idec))
+    jout = len(range(0, nx, jdec))
+    incx = round(xmax/jout)
+    incy = round(ymax/iout)
+    return incx, incy, int(np.floor(xmax/incx)), int(np.floor(ymax/incy))
+
+def _edge_norm(kernel, ny, nx, idec, jdec, iout, jout):
+    # sum of the filter coefficients that fall on the data at each output node,
+    # from 2-D prefix sums of the kernel.
+    h, w = kernel.shape
+    csum = np.zeros((h+1, w+1))
+    csum[1:, 1:] = kernel.cumsum(0).cumsum(1)
+    ic = np.arange(iout)*idec
+    jc = np.arange(jout)*jdec
+    a0 = np.clip(h//2-ic, 0, h)[:, None]
+    a1 = np.clip(h//2+ny-ic, 0, h)[:, None]
+    b0 = np.clip(w//2-jc, 0, w)[None, :]
+    b1 = np.clip(w//2+nx-jc, 0, w)[None, :]
+    norm = csum[a1, b1]-csum[a0, b1]-csum[a1, b0]+csum[a0, b0]
+    return np.where((a1 > a0) & (b1 > b0), norm, 0.)
+
+def conv_decimate(z, kernel, idec=1, jdec=1, iout=None, jout=None, factors=None):
+    # conv_decimate convolves the 2-D array z (top row first, real or complex)
+    # with kernel and returns the (iout, jout) output at rows 0, idec, ... and
+    # columns 0, jdec, ..., normalised at the edges like conv: smoothing
+    # filters are divided by the sum of the coefficients on the data, and
+    # derivative filters (coefficients summing to ~0) are set to 0 where
+    # the filter is cut by the edge.
+    ny, nx = z.shape
+    h, w = kernel.shape
+    if iout is None:
+        iout = len(range(0, ny, idec))
+    if jout is None:
+        jout = len(range(0, nx, jdec))
+    ry = (iout-1)*idec+1
+    rx = (jout-1)*jdec+1
+    dtype = np.complex64 if np.iscomplexobj(z) else np.float32
+    pad = np.zeros((ry+h-1, rx+w-1), dtype=dtype)
+    sy = min(ny, ry+h//2)
+    sx = min(nx, rx+w//2)
+    pad[h//2:h//2+sy, w//2:w//2+sx] = z[:sy, :sx]
+
+    if factors is not None:
+        u, v = [f.astype(np.float32) for f in factors]
+        tmp = np.zeros((pad.shape[0], jout), dtype=dtype)
+        for b in range(w):
+            if v[b] != 0:
+                tmp += v[b]*pad[:, b:b+rx:jdec]
+        out = np.zeros((iout, jout), dtype=dtype)
+        for a in range(h):
+            if u[a] != 0:
+                out += u[a]*tmp[a:a+ry:idec, :]
+    elif h*w >= FFT_TAPS:
+        from scipy.signal import oaconvolve
+        full = oaconvolve(pad, kernel[::-1, ::-1].astype(np.float32), mode='valid')
+        out = full[::idec, ::jdec][:iout, :jout].astype(dtype)
+    else:
+        taps = kernel.astype(np.float32)
+        out = np.zeros((iout, jout), dtype=dtype)
+        for a in range(h):
+            for b in range(w):
+                if taps[a, b] != 0:
+                    out += taps[a, b]*pad[a:a+ry:idec, b:b+rx:jdec]
+
+    anorm = np.abs(kernel).sum()
+    rsum = kernel.sum()
+    norm = _edge_norm(kernel, ny, nx, idec, jdec, iout, jout)
+    if abs(rsum) > 0.05*anorm:
+        good = np.abs(norm) > 0.01*rsum
+        out = np.where(good, out/np.where(good, norm, 1.), 0.)
+    else:
+        out = np.where(np.abs(norm) < 0.0001*anorm, out, 0.)
+    return out.astype(dtype)
+
+def read_slc_power(prm):
+    # read_slc_power returns the squared amplitude of the SLC of a PRM file,
+    # scaled by DFACT**2 like conv, and the size (xmax, ymax) conv gives it.
+    slc, dtype, nx, nvalid, npatch = get_prm(prm, 'SLC_file', 'dtype', 'num_rng_bins',
+                                              'num_valid_az', 'num_patches')
+    ny = nvalid*npatch
+    if str(dtype).startswith('c'):
+        data = np.memmap(slc, dtype=np.float32, mode='r', shape=(ny, 2*nx))
+    else:
+        data = np.memmap(slc, dtype=np.int16, mode='r', shape=(ny, 2*nx))
+    power = np.empty((ny, nx), dtype=np.float32)
+    for i0 in range(0, ny, 4096):
+        block = data[i0:i0+4096].astype(np.float32)
+        power[i0:i0+4096] = DFACT*DFACT*(block[:, 0::2]**2+block[:, 1::2]**2)
+    return power, float(nx), float(ny)
+
+def read_conv_input(fn):
+    # read_conv_input returns (z, xmax, ymax) of a grid or of the SLC of a PRM file,
+    # with z top row first. Grids may be NetCDF or GMT native float (=bf).
+    from grid_lib import read_grd, grd_region, grd_rows_tl
+    if fn.endswith('PRM') or fn.endswith('prm'):
+        return read_slc_power(fn)
+    grd = read_grd(fn)
+    w, e, s, n = grd_region(grd)
+    return grd_rows_tl(grd), e, n
+
+def conv_grid(z, xmax, ymax, filter_file, idec=1, jdec=1):
+    # conv_grid filters z (top row first) like conv idec jdec filter_file and
+    # returns the result with its region (out, xmax, ymax), ready for another
+    # conv_grid call or for write_conv_grid.
+    kernel, factors = read_filter(filter_file)
+    ny, nx = z.shape
+    incx, incy, jout, iout = conv_size(xmax, ymax, nx, ny, idec, jdec)
+    out = conv_decimate(z, kernel, idec, jdec, iout, jout, factors)
+    return out, incx*jout, incy*iout
+
+def write_conv_grid(fn, z, xmax, ymax):
+    # write_conv_grid writes a top-row-first array z as the pixel registered
+    # grid conv writes, spanning 0/xmax/0/ymax.
+    import xarray as xr
+    from grid_lib import write_grd
+    iout, jout = z.shape
+    incx = xmax/jout
+    incy = ymax/iout
+    x = (np.arange(jout)+0.5)*incx
+    y = (np.arange(iout)+0.5)*incy
+    da = xr.DataArray(np.asarray(z)[::-1, :], dims=('y', 'x'), coords={'x': x, 'y': y}, name='z')
+    write_grd(fn.replace('=bf', ''), da, registration=1)
+
+def _main_func(description):
+    arg = sys.argv
+    if len(arg) < 6:
+        print(description)
+        print("Usage: conv.py idec jdec filter_file input output")
+        print(" ")
+        print("   idec           - row decimation factor ")
+        print("   jdec           - column decimation factor ")
+        print("   filter_file    - eg. filters/gauss17x5 ")
+        print("   input          - grid or PRM file (amplitude of its SLC) ")
+        print("   output         - filtered grid ")
+        sys.exit(1)
+
+    idec = int(arg[1])
+    jdec = int(arg[2])
+    if idec <= 0 or jdec <= 0:
+        sys.exit('CONV: idec and jdec should be positive integers.')
+    z, xmax, ymax = read_conv_input(arg[4])
+    out, xmax, ymax = conv_grid(z, xmax, ymax, arg[3], idec, jdec)
+    write_conv_grid(arg[5], out, xmax, ymax)
+
+if __name__ == "__main__":
+    _main_func(__doc__)
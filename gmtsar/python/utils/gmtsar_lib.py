@@ -7,11 +7,32 @@
 # check_file_report
 # grep_value
 # replace_strings
+# read_prm
+# get_prm
+# set_prm
 # file_shuttle
+# delete
+# run
+# run_pipe
+# run_parallel
+# run_summary
+# grdinfo_R
+# grdinfo_I
+# grdinfo_inc
+# grdinfo_stats
 """
 
 import sys, os, re, configparser
-import subprocess, glob
+import subprocess, glob, shutil, shlex
+import json, time, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Every command started by run/run_pipe/run_parallel is timed. The records are
+# kept in run_records and, when the environment variable GMTSAR_RUN_LOG names a
+# file, appended to it as one JSON line each, so that the scripts started by
+# p2p_processing all log to the same file.
+run_records = []
+_run_lock = threading.Lock()
 
 def check_file_report(fn):
     # Check if a file exists.
@@ -26,7 +47,11 @@ def check_file_report(fn):
 
 def catch_output_cmd(cmd_list, choose_split=False, split_id=-999, digit_id=-100000):
     # catch_output_cmd takes in cmd_list and return the string
-    tmp = subprocess.run(cmd_list, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+    start = time.time()
+    proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE)
+    tmp = proc.stdout.read().decode('utf-8').strip()
+    proc.stdout.close()
+    _record(' '.join(cmd_list), start, [_wait(proc)], proc.returncode)
     
     if choose_split==True:
         
@@ -42,6 +67,38 @@ def catch_output_cmd(cmd_list, choose_split=False, split_id=-999, digit_id=-1000
         # If choose_split==False, default return is a string. 
     return out
 
+def grdinfo_R(fn):
+    # grdinfo_R returns the -Rw/e/s/n string of grid fn (gmt grdinfo -I-), read
+    # from the cached NetCDF header by grid_lib, or from gmt if it cannot be imported.
+    try:
+        from grid_lib import grd_R
+    except ImportError:
+        return catch_output_cmd(['gmt', 'grdinfo', fn, '-I-', '--FORMAT_FLOAT_OUT=%.12lg'])
+    return grd_R(fn)
+
+def grdinfo_I(fn):
+    # grdinfo_I returns the -Idx/dy string of grid fn (gmt grdinfo -I).
+    try:
+        from grid_lib import grd_I
+    except ImportError:
+        return catch_output_cmd(['gmt', 'grdinfo', fn, '-I', '--FORMAT_FLOAT_OUT=%.12lg'])
+    return grd_I(fn)
+
+def grdinfo_inc(fn):
+    # grdinfo_inc returns the grid spacing (dx, dy) of grid fn.
+    inc = grdinfo_I(fn)[2:].split('/')
+    return float(inc[0]), float(inc[-1])
+
+def grdinfo_stats(fn):
+    # grdinfo_stats returns the mean, stdev and rms of grid fn (gmt grdinfo -L2),
+    # cached with the header until fn changes.
+    try:
+        from grid_lib import grd_info_stats
+    except ImportError:
+        out = catch_output_cmd(['gmt', 'grdinfo', fn, '-C', '-L2'], True)
+        return float(out[11]), float(out[12]), float(out[13])
+    return grd_info_stats(fn)
+
 def intFloatOrString(val):
     if val.isdigit():
         return int(val)
@@ -51,23 +108,62 @@ def intFloatOrString(val):
         except ValueError:
             return ""
             
+# PRM parameters that are not doubles in struct PRM (PRM.h/sio_struct.c);
+# everything else in a PRM file is read as a float.
+PRM_INT = {'bytes_per_line', 'good_bytes_per_line', 'first_line', 'num_patches',
+           'first_sample', 'num_valid_az', 'st_rng_bin', 'num_rng_bins', 'nlooks',
+           'chirp_ext', 'rshift', 'ashift', 'SC_identity', 'ref_identity', 'nrows',
+           'num_lines', 'SLC_format'}
+PRM_STR = {'input_file', 'SLC_file', 'led_file', 'out_amp_file', 'out_data_file',
+           'deskew', 'Flip_iq', 'offset_video', 'scnd_rng_mig', 'ref_file',
+           'orbdir', 'lookdir', 'dtype', 'date'}
+
+# _lines_cache keeps the lines and parsed values of every file read by
+# grep_value/read_prm, keyed by absolute path; an entry is reused as long as
+# the size and modification time of the file are unchanged.
+_lines_cache = {}
+
+def _cached_entry(fn):
+    path = os.path.abspath(fn)
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    entry = _lines_cache.get(path)
+    if entry is None or entry['stamp'] != stamp:
+        with open(path, 'r') as f:
+            entry = {'stamp': stamp, 'lines': f.readlines(), 'prm': None}
+        _lines_cache[path] = entry
+    return entry
+
+def _prm_value(name, val):
+    if name in PRM_STR:
+        return val
+    try:
+        if name in PRM_INT:
+            return int(float(val))
+        return float(val)
+    except ValueError:
+        return val
+
 def grep_value(fn, s, i): 
     # grep_value performs similar functions to unix grep. 
     # Given a file name - fn, and a character string - s, find the ith value.
     # The character should be unique in file fn.
+    # The lines of fn are cached until fn changes.
     #
-    with open(fn, 'r') as f:
-        for line in f.readlines():
-            if re.search(s, line):
-                print(line)
-                val = line.split()[i-1]     
+    val = None
+    for line in _cached_entry(fn)['lines']:
+        if re.search(s, line):
+            hit = line
+            val = line.split()[i-1]
+    if val is None:
+        raise ValueError(s+' not found in '+fn)
+    print(hit)
     return intFloatOrString(val)
 
 def replace_strings(fn, s0, s1):
     # replace_strings will replace str s0 in file fn0,
     #   with the string s1, and update fn0.
-    with open(f"{fn}") as f:
-        lines = f.readlines()
+    lines = _cached_entry(fn)['lines']
 
     updated_lines = []
     for line in lines:
@@ -75,8 +171,63 @@ def replace_strings(fn, s0, s1):
             line = f"{s1}\n"
         updated_lines.append(line)
 
-    with open(f"{fn}", "w") as f:
-        f.writelines(updated_lines)
+    _write_lines(fn, updated_lines)
+
+def _write_lines(fn, lines):
+    # write lines to fn atomically and keep them in the cache.
+    tmp = fn+'.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp, fn)
+    _lines_cache.pop(os.path.abspath(fn), None)
+
+def read_prm(fn):
+    # read_prm parses the PRM file fn once into a dict of name: value,
+    # with the types of struct PRM (int, float or str). The dict is
+    # cached until fn changes; do not modify it, use set_prm instead.
+    entry = _cached_entry(fn)
+    if entry['prm'] is None:
+        prm = {}
+        for line in entry['lines']:
+            if '=' not in line:
+                continue
+            name, val = line.split('=', 1)
+            name = name.strip()
+            val = val.strip()
+            if name != '':
+                prm[name] = _prm_value(name, val)
+        entry['prm'] = prm
+    return entry['prm']
+
+def get_prm(fn, *names):
+    # get_prm returns the value of parameter names[0] in the PRM file fn,
+    # or a list of values when several names are given, e.g.
+    #   PRF, fs = get_prm('master.PRM', 'PRF', 'rng_samp_rate')
+    prm = read_prm(fn)
+    for name in names:
+        if name not in prm:
+            raise KeyError(name+' not found in '+fn)
+    if len(names) == 1:
+        return prm[names[0]]
+    return [prm[name] for name in names]
+
+def set_prm(fn, updates):
+    # set_prm sets the parameters in the dict updates in the PRM file fn,
+    # in place of their old lines or appended at the end for new ones.
+    # The file is rewritten atomically.
+    lines = list(_cached_entry(fn)['lines'])
+    todo = dict(updates)
+    for k, line in enumerate(lines):
+        if '=' not in line:
+            continue
+        name = line.split('=', 1)[0].strip()
+        if name in todo:
+            lines[k] = name+' = '+str(todo.pop(name))+'\n'
+    if len(lines) > 0 and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    for name in todo:
+        lines.append(name+' = '+str(todo[name])+'\n')
+    _write_lines(fn, lines)
 
 def append_new_line(fn,s0):
     # append the string s0 as a new line at the end of file named fn.
@@ -89,19 +240,39 @@ def append_new_line(fn,s0):
 
 def file_shuttle(fn0, fn1, opt):
     # copy/move fn0 and paste it to fn1.
+    # fn0 may be a wildcard pattern; the files are handled in-process.
+    # A failed copy, move or link raises OSError instead of being skipped.
     if opt == "cp":
         print("cp " + fn0 + " " + fn1)
-        os.system("cp " + fn0 + " " + fn1)
     elif opt == "mv":
         print("mv " + fn0 + " " + fn1)
-        os.system("mv " + fn0 + " " + fn1)
     elif opt == "link":
         print("ln -sf " + fn0 + " " + fn1)
-        os.system("ln -sf " + fn0 + " " + fn1)
+    # a pattern without matches is passed on literally, as the shell does
+    sources = (sorted(glob.glob(fn0)) or [fn0]) if glob.has_magic(fn0) else [fn0]
+    for src in sources:
+        dst = os.path.join(fn1, os.path.basename(src)) if os.path.isdir(fn1) else fn1
+        try:
+            if opt == "cp":
+                shutil.copy(src, dst)
+            elif opt == "mv":
+                shutil.move(src, dst)
+            elif opt == "link":
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(src, dst)
+        except OSError as e:
+            print(opt + ": " + str(e))
+            raise
 
 def delete(fn):
-    # delete file named fn.
-    os.system("rm -rf "+fn)
+    # delete file named fn (wildcards and directories allowed, like rm -rf).
+    # Missing files are ignored; a path that cannot be removed raises OSError.
+    for path in glob.glob(fn):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
     
 def assign_arg(arg, str):
     # arg is the list that contains arguments from a terminal input.
@@ -113,11 +284,113 @@ def assign_arg(arg, str):
     else:
        return 0
 
+def _wait(proc):
+    # reap proc with wait4 to get the rusage of proc and its waited-for children.
+    _, status, ru = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return ru
+
+def _record(cmd, start, rusages, returncode):
+    # _record stores the wall/CPU time and peak RSS of a finished command.
+    rec = {'cmd': cmd, 'cwd': os.getcwd(), 'pid': os.getpid(), 'start': start,
+           'wall': round(time.time()-start, 3),
+           'user': round(sum(ru.ru_utime for ru in rusages), 3),
+           'sys': round(sum(ru.ru_stime for ru in rusages), 3),
+           'maxrss_mb': round(max(ru.ru_maxrss for ru in rusages)/1024., 1),
+           'returncode': returncode}
+    with _run_lock:
+        run_records.append(rec)
+        log = os.environ.get('GMTSAR_RUN_LOG', '')
+        if log != '':
+            with open(log, 'a') as f:
+                f.write(json.dumps(rec)+'\n')
+    return rec
+
 def run(cmd):
     # run and print the command specified in cmd.
+    # Returns the exit code of cmd; its timing goes to the run log.
     print(" ")
     print(cmd)
-    os.system(cmd)
+    sys.stdout.flush()
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True)
+    ru = _wait(proc)
+    _record(cmd, start, [ru], proc.returncode)
+    return proc.returncode
+
+def run_pipe(cmds, fn_out=None, append=False):
+    # run_pipe connects the commands in the list cmds with real pipes, like
+    # 'cmd1 | cmd2 | ...', without a shell or temporary files. The output of
+    # the last command goes to file fn_out if given (appended if append=True).
+    # Returns the first non-zero exit code, or 0.
+    line = ' | '.join(cmds)
+    if fn_out is not None:
+        line += (' >> ' if append else ' > ')+fn_out
+    print(" ")
+    print(line)
+    sys.stdout.flush()
+    start = time.time()
+    out = open(fn_out, 'ab' if append else 'wb') if fn_out is not None else None
+    procs = []
+    for k, cmd in enumerate(cmds):
+        stdin = procs[-1].stdout if k > 0 else None
+        stdout = subprocess.PIPE if k < len(cmds)-1 else out
+        procs.append(subprocess.Popen(shlex.split(cmd), stdin=stdin, stdout=stdout))
+        if stdin is not None:
+            stdin.close()
+    rusages = [_wait(proc) for proc in procs]
+    if out is not None:
+        out.close()
+    codes = [proc.returncode for proc in procs if proc.returncode != 0]
+    returncode = codes[0] if len(codes) > 0 else 0
+    _record(line, start, rusages, returncode)
+    return returncode
+
+def _run_chain(cmds):
+    # run the commands of one run_parallel job in order, stopping at the first failure.
+    if isinstance(cmds, str):
+        cmds = [cmds]
+    for cmd in cmds:
+        returncode = run(cmd)
+        if returncode != 0:
+            return returncode
+    return 0
+
+def run_parallel(jobs, nproc=0):
+    # run_parallel runs independent jobs concurrently on nproc workers
+    # (default: one per job). Each job is a command string or a list of
+    # commands run in order. Returns the exit code of each job.
+    if len(jobs) == 0:
+        return []
+    nproc = len(jobs) if nproc <= 0 else nproc
+    print(" ")
+    print("RUN: running "+str(len(jobs))+" jobs on "+str(nproc)+" workers")
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        return list(pool.map(_run_chain, jobs))
+
+def run_summary(fn=None, top=15):
+    # run_summary prints the programs that took the most wall time, summed over
+    # the records of the run log fn (default: GMTSAR_RUN_LOG, else this process).
+    if fn is None:
+        fn = os.environ.get('GMTSAR_RUN_LOG', '')
+    records = run_records
+    if fn != '' and os.path.isfile(fn):
+        with open(fn, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip() != '']
+    total = {}
+    for rec in records:
+        words = rec['cmd'].split()
+        name = ' '.join(words[:2]) if len(words) > 1 and words[0] == 'gmt' else (words[0] if words else '')
+        t = total.setdefault(name, [0, 0., 0., 0.])
+        t[0] += 1
+        t[1] += rec['wall']
+        t[2] += rec['user']+rec['sys']
+        t[3] = max(t[3], rec['maxrss_mb'])
+    print(" ")
+    print("RUN: %-32s %6s %10s %10s %10s" % ('program', 'calls', 'wall [s]', 'cpu [s]', 'rss [MB]'))
+    for name in sorted(total, key=lambda k: -total[k][1])[:top]:
+        t = total[name]
+        print("RUN: %-32s %6d %10.2f %10.2f %10.1f" % (name, t[0], t[1], t[2], t[3]))
 
 def renameMasterAlignedForS1tops(master0, aligned0):
     print('Renaming master and aligned for SAT==S1_TOPS')
@@ -0,0 +1,305 @@
+#! /usr/bin/env python3
+"""
+# gnss_los.py is part of pyGMTSAR.
+# It replaces gnss_enu2los.csh and correct_insar_with_gnss.csh.
+
+# Purpose: to project GNSS ENU displacements into the radar line of sight and
+# to correct unwrapped interferograms with the long-wavelength misfit to them.
+# The height, look vector and range/azimuth of the stations only depend on
+# the geometry (PRM, LED and DEM), so they are computed for all stations with
+# one SAT_look and one SAT_llt2rat call and cached in gnss_look_<key>.npz;
+# the other interferograms of the stack only add their new stations.
+# A batch of interferograms is corrected one grid at a time per process, so
+# memory is bounded by nproc grids, and the filter windows and coarse grid of
+# a grid geometry are set up once for the batch.
+# Syntax: gnss_los.py master.PRM master.LED gnss.llenu dem.grd [gnss_los.rad]
+#         gnss_los.py -correct master.PRM master.LED dem.grd filter_wavelength batch.list [-nproc N]
+
+# read_gnss
+# station_geometry
+# enu2los
+# grid_setup
+# station_filter
+# correction_grid
+# correct_grid
+# correct_batch
+"""
+
+import sys, os, hashlib
+import subprocess
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from gmtsar_lib import *
+from grid_lib import read_grd, write_grd, grd_info
+
+def read_gnss(fn):
+    # read_gnss reads a GNSS table, either stat lon lat E N U (mm) or a
+    # gnss_los.rad of range azimuth LOS (mm). Returns the columns as a dict.
+    rows = []
+    with open(fn, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 6:
+                rows.append(fields[:6])
+            elif len(fields) == 3:
+                rows.append(fields)
+    if len(rows) > 0 and len(rows[0]) == 3:
+        v = np.array(rows, dtype=np.float64)
+        return {'rng': v[:, 0], 'azi': v[:, 1], 'los': v[:, 2]}
+    v = np.array([r[1:] for r in rows], dtype=np.float64).reshape(-1, 5)
+    return {'stat': [r[0] for r in rows], 'lon': v[:, 0], 'lat': v[:, 1], 'enu': v[:, 2:5]}
+
+def _geometry_key(prm, led, dem):
+    text = ''
+    for fn in [prm, led, dem]:
+        st = os.stat(fn)
+        text += '%s %d %d ' % (os.path.realpath(fn), st.st_size, st.st_mtime_ns)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def _station_ids(lon, lat):
+    return np.array(['%.6f/%.6f' % p for p in zip(lon, lat)])
+
+def station_geometry(prm, led, dem, lon, lat):
+    # station_geometry returns the DEM height, the look vector (E, N, U) and
+    # the range/azimuth of the stations lon/lat. The stations already in
+    # gnss_look_<key>.npz of this PRM/LED/DEM are read from it; the others are
+    # computed by one gmt grdtrack, SAT_look and SAT_llt2rat call and added.
+    fn = 'gnss_look_'+_geometry_key(prm, led, dem)+'.npz'
+    cache = {'id': np.array([], dtype='<U32'), 'hgt': np.zeros(0), 'look': np.zeros((0, 3)),
+             'rng': np.zeros(0), 'azi': np.zeros(0)}
+    if os.path.isfile(fn):
+        with np.load(fn) as f:
+            cache = {k: f[k] for k in f.files}
+    ids = _station_ids(lon, lat)
+    new = np.setdiff1d(ids, cache['id'])
+    if len(new) > 0:
+        print('GNSS_LOS: computing the look vectors of ', len(new), ' stations')
+        k = np.searchsorted(ids, new, sorter=np.argsort(ids))
+        k = np.argsort(ids)[k]
+        text = ''.join('%.10f %.10f\n' % (lon[i], lat[i]) for i in k)
+        llh = subprocess.run(['gmt', 'grdtrack', '-N', '-G'+dem], input=text, stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True).stdout
+        lltn = subprocess.run(['SAT_look', prm], input=llh, stdout=subprocess.PIPE,
+                              universal_newlines=True, check=True).stdout
+        rat = subprocess.run(['SAT_llt2rat', prm, '1'], input=llh, stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True).stdout
+        hgt = np.array([float(l.split()[2]) for l in llh.splitlines() if l.strip() != ''])
+        look = np.array([[float(v) for v in l.split()[3:6]] for l in lltn.splitlines() if l.strip() != '']).reshape(-1, 3)
+        ra = np.array([[float(v) for v in l.split()[:2]] for l in rat.splitlines() if l.strip() != '']).reshape(-1, 2)
+        if not (len(hgt) == len(look) == len(ra) == len(k)):
+            sys.exit('GNSS_LOS: SAT_look/SAT_llt2rat did not return one line per station')
+        cache = {'id': np.concatenate([cache['id'], new]), 'hgt': np.concatenate([cache['hgt'], hgt]),
+                 'look': np.concatenate([cache['look'], look]), 'rng': np.concatenate([cache['rng'], ra[:, 0]]),
+                 'azi': np.concatenate([cache['azi'], ra[:, 1]])}
+        with open(fn+'.tmp', 'wb') as f:
+            np.savez(f, **cache)
+        os.replace(fn+'.tmp', fn)
+    order = np.argsort(cache['id'])
+    k = order[np.searchsorted(cache['id'], ids, sorter=order)]
+    return {name: cache[name][k] for name in ['hgt', 'look', 'rng', 'azi']}
+
+def enu2los(geom, enu):
+    # enu2los returns the LOS displacement of the stations, the dot product of
+    # their ENU displacements with their look vectors (NaN off the DEM).
+    return np.einsum('ij,ij->i', np.asarray(enu, dtype=np.float64), geom['look'])
+
+def _gauss(width):
+    # GMT gaussian weights of a filter of full width (6 sigma) in nodes.
+    h = int(width)//2
+    return np.exp(-0.5*((np.arange(-h, h+1))/(width/6.))**2)
+
+def grid_setup(like, prm, filterw):
+    # grid_setup returns what the correction of a grid on the nodes of like
+    # needs: the pixel sizes in meters, the 1 km gaussian applied at the
+    # stations and the coarse template grid of filterw/16 pixels, as
+    # correct_insar_with_gnss.csh.
+    fs, vel, prf, wave = get_prm(prm, 'rng_samp_rate', 'SC_vel', 'PRF', 'radar_wavelength')
+    xc, yc = like['x'].values, like['y'].values
+    x_inc = int(abs(xc[1]-xc[0])+.5)
+    y_inc = int(abs(yc[1]-yc[0])+.5)
+    dx = x_inc*1.556*299792458/int(fs)/2
+    dy = y_inc*vel/prf
+    fsx = int(1000/dx)//2*2+1
+    fsy = int(1000/dy)//2*2+1
+    ndx = max(int(filterw/dx/16), 1)
+    ndy = max(int(filterw/dy/16), 1)
+    # coarse template: every ndx by ndy node of the grid, as grdsample -I
+    cx = np.arange(0, len(xc), ndx)
+    cy = np.arange(0, len(yc), ndy)
+    return {'wave': wave, 'dx': dx, 'dy': dy, 'kx': _gauss(fsx), 'ky': _gauss(fsy), 'cx': cx, 'cy': cy,
+            'xc': xc, 'yc': yc}
+
+def station_filter(z, setup, rng, azi):
+    # station_filter returns the 1 km gaussian filtered grid z (NaNs ignored)
+    # interpolated bilinearly at the range/azimuth of the stations, as
+    # grdfilter -Fg followed by grdtrack; NaN off the grid.
+    xc, yc, kx, ky = setup['xc'], setup['yc'], setup['kx'], setup['ky']
+    fx = (np.asarray(rng)-xc[0])/(xc[1]-xc[0])
+    fy = (np.asarray(azi)-yc[0])/(yc[1]-yc[0])
+    out = np.full(len(fx), np.nan)
+    inside = (fx >= 0) & (fx <= len(xc)-1) & (fy >= 0) & (fy <= len(yc)-1)
+    if not inside.any():
+        return out
+    hx, hy = len(kx)//2, len(ky)//2
+    pad = np.pad(np.asarray(z, dtype=np.float64), ((hy, hy+1), (hx, hx+1)), constant_values=np.nan)
+    i0 = np.floor(fy[inside]).astype(int)
+    j0 = np.floor(fx[inside]).astype(int)
+    wy, wx = fy[inside]-i0, fx[inside]-j0
+    rows = i0[:, None]+np.arange(len(ky)+1)[None, :]
+    cols = j0[:, None]+np.arange(len(kx)+1)[None, :]
+    win = pad[rows[:, :, None], cols[:, None, :]]
+    ok = np.isfinite(win)
+    win = np.where(ok, win, 0.)
+    val = 0.
+    for a, wa in [(0, 1-wy), (1, wy)]:
+        for b, wb in [(0, 1-wx), (1, wx)]:
+            k = np.zeros((len(ky)+1, len(kx)+1))
+            k[a:a+len(ky), b:b+len(kx)] = np.outer(ky, kx)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                node = np.einsum('pij,ij->p', win, k)/np.einsum('pij,ij->p', ok, k)
+            val = val+wa*wb*node
+    out[inside] = val
+    return out
+
+def correction_grid(setup, rng, azi, diff):
+    # correction_grid returns the correction on the grid nodes: the block
+    # median of the InSAR-GNSS differences on the coarse template, a thin
+    # plate spline through them (gmt surface), the 17 node gaussian of the
+    # coarse grid and a bilinear upsampling to the grid (grdsample).
+    from scipy.interpolate import RBFInterpolator
+    from scipy.ndimage import convolve
+    xc, yc, cx, cy = setup['xc'], setup['yc'], setup['cx'], setup['cy']
+    ok = np.isfinite(diff)
+    rng, azi, diff = np.asarray(rng)[ok], np.asarray(azi)[ok], np.asarray(diff)[ok]
+    if len(diff) == 0:
+        return np.zeros((len(yc), len(xc)))
+    # blockmedian on the coarse nodes
+    bx = np.rint(((rng-xc[0])/(xc[1]-xc[0]))/(cx[1]-cx[0] if len(cx) > 1 else 1)).astype(int)
+    by = np.rint(((azi-yc[0])/(yc[1]-yc[0]))/(cy[1]-cy[0] if len(cy) > 1 else 1)).astype(int)
+    cell = by*(len(cx)+1)+bx
+    pts, vals = [], []
+    for c in np.unique(cell):
+        m = cell == c
+        pts.append((np.median(rng[m])*setup['dx']/(xc[1]-xc[0]), np.median(azi[m])*setup['dy']/(yc[1]-yc[0])))
+        vals.append(np.median(diff[m]))
+    pts, vals = np.array(pts), np.array(vals)
+    gx = xc[cx]*setup['dx']/(xc[1]-xc[0])
+    gy = yc[cy]*setup['dy']/(yc[1]-yc[0])
+    GX, GY = np.meshgrid(gx, gy)
+    if len(vals) >= 3 and np.linalg.matrix_rank(np.column_stack([pts, np.ones(len(pts))])) == 3:
+        coarse = RBFInterpolator(pts, vals, kernel='thin_plate_spline')(np.column_stack([GX.ravel(), GY.ravel()]))
+        coarse = coarse.reshape(GX.shape)
+    else:
+        coarse = np.full(GX.shape, np.median(vals))
+    # 17 node gaussian, normalised at the edges
+    g = _gauss(17)
+    r = np.hypot(*np.meshgrid(np.arange(-8, 9), np.arange(-8, 9)))
+    kernel = np.where(r <= 8.5, np.outer(g, g), 0.)
+    coarse = convolve(coarse, kernel, mode='constant')/convolve(np.ones_like(coarse), kernel, mode='constant')
+    # bilinear upsampling to the grid nodes, held at the edges
+    def interp_axis(c, n):
+        q = np.clip(np.arange(n, dtype=np.float64), c[0], c[-1])
+        if len(c) == 1:
+            return np.zeros(n, int), np.zeros(n, int), np.zeros(n)
+        j1 = np.clip(np.searchsorted(c, q), 1, len(c)-1)
+        return j1-1, j1, (q-c[j1-1])/(c[j1]-c[j1-1])
+    x0, x1, wx = interp_axis(cx, len(xc))
+    y0, y1, wy = interp_axis(cy, len(yc))
+    top = coarse[y0][:, x0]*(1-wx)+coarse[y0][:, x1]*wx
+    bot = coarse[y1][:, x0]*(1-wx)+coarse[y1][:, x1]*wx
+    return top*(1-wy[:, None])+bot*wy[:, None]
+
+_setups = {}
+
+def correct_grid(insar, output, rng, azi, los, prm, filterw):
+    # correct_grid writes output = insar - correction, from the LOS (mm) of
+    # the stations at range/azimuth rng/azi. The setup of the grid geometry
+    # is kept for the next grids of the batch.
+    da = read_grd(insar)
+    info = grd_info(insar)
+    key = (prm, filterw, info.w, info.e, info.s, info.n, info.nx, info.ny)
+    if key not in _setups:
+        _setups[key] = grid_setup(da, prm, filterw)
+    setup = _setups[key]
+    gnss = np.asarray(los)*(4.0*3.141592653)/(-setup['wave']*1000.0)
+    diff = station_filter(da.values, setup, rng, azi)-gnss
+    correction = correction_grid(setup, rng, azi, diff)
+    write_grd(output, da.copy(data=da.values-correction))
+    print('GNSS_LOS: ', insar, ' corrected with ', int(np.isfinite(diff).sum()), ' stations and stored as ', output)
+
+def correct_batch(prm, led, dem, filterw, jobs, nproc=1):
+    # correct_batch corrects the interferograms of jobs [(phase.grd,
+    # gnss table, output.grd), ...]. The geometry of all the stations of
+    # all the tables is computed (or read from the cache) once.
+    tables = [read_gnss(j[1]) for j in jobs]
+    enu = [t for t in tables if 'enu' in t]
+    if len(enu) > 0:
+        lon = np.concatenate([t['lon'] for t in enu])
+        lat = np.concatenate([t['lat'] for t in enu])
+        _, first = np.unique(_station_ids(lon, lat), return_index=True)
+        station_geometry(prm, led, dem, lon[first], lat[first])
+    args = []
+    for (insar, table, output), t in zip(jobs, tables):
+        if 'enu' in t:
+            geom = station_geometry(prm, led, dem, t['lon'], t['lat'])
+            args.append((insar, output, geom['rng'], geom['azi'], enu2los(geom, t['enu']), prm, filterw))
+        else:
+            args.append((insar, output, t['rng'], t['azi'], t['los'], prm, filterw))
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            list(pool.map(correct_grid, *zip(*args)))
+    else:
+        for a in args:
+            correct_grid(*a)
+
+def _main_func(description):
+    arg = sys.argv
+    nproc = int(assign_arg(arg, '-nproc')) or 1
+    pos = [a for k, a in enumerate(arg[1:], 1) if a not in ['-correct', '-nproc'] and arg[k-1] != '-nproc']
+
+    def Error_Message():
+        print(description)
+        print("Usage: gnss_los.py master.PRM master.LED gnss.llenu dem.grd [gnss_los.rad]")
+        print("       gnss_los.py -correct master.PRM master.LED dem.grd filter_wavelength batch.list [-nproc N]")
+        print(" ")
+        print(" gnss.llenu        -  GNSS displacements (Stat | Lon | Lat | E | N | U) in millimeters")
+        print(" gnss_los.rad      -  output range | azimuth | LOS(mm) (default gnss_los.rad)")
+        print(" filter_wavelength -  wavelength of the filter in meters (0.5 gain)")
+        print(" batch.list        -  'phase.grd gnss_table [output.grd]' per line; gnss_table is a")
+        print("                      gnss.llenu or a gnss_los.rad; output defaults to gnss_corrected_<phase.grd>")
+        print(" ")
+        print("Example: gnss_los.py -correct supermaster.PRM supermaster.LED dem.grd 40000 batch.list -nproc 4")
+        sys.exit(1)
+
+    if '-correct' in arg:
+        if len(pos) != 5 or not os.path.isfile(pos[4]):
+            Error_Message()
+        jobs = []
+        with open(pos[4], 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                out = fields[2] if len(fields) > 2 else \
+                    os.path.join(os.path.dirname(fields[0]), 'gnss_corrected_'+os.path.basename(fields[0]))
+                jobs.append((fields[0], fields[1], out))
+        correct_batch(pos[0], pos[1], pos[2], float(pos[3]), jobs, nproc)
+    else:
+        if len(pos) < 4:
+            Error_Message()
+        for fn in pos[:4]:
+            if not os.path.isfile(fn):
+                print('GNSS_LOS: ', fn, ' does not exist -- this is required')
+                sys.exit(1)
+        t = read_gnss(pos[2])
+        geom = station_geometry(pos[0], pos[1], pos[3], t['lon'], t['lat'])
+        los = enu2los(geom, t['enu'])
+        output = pos[4] if len(pos) > 4 else 'gnss_los.rad'
+        with open(output, 'w') as f:
+            for k in np.flatnonzero(np.isfinite(los)):
+                f.write('%.9f %.9f %.12f\n' % (geom['rng'][k], geom['azi'][k], los[k]))
+        print('GNSS_LOS: result created and stored as ', output)
+    print('GNSS_LOS - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)
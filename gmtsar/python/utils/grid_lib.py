@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+"""
+# grid_lib.py is part of pyGMTSAR.
+# It hosts NumPy/xarray functions to work on GMT NetCDF grids in memory,
+# so that chains of gmt grdmath/grdcut/grdsample calls can be replaced by
+# one read and one write per grid.
+
+# open_grd
+# read_grd
+# is_bf_grd
+# write_grd
+# grd_region
+# grd_inc
+# cut_grd
+# sample_grd
+# grd_rows_tl
+# grd_from_rows_tl
+# grd_stats
+# grd_info
+# grd_info_stats
+# grd_R
+# grd_I
+# write_snaphu_input
+# read_snaphu_output
+"""
+
+import os
+from collections import namedtuple
+import numpy as np
+import xarray as xr
+import netCDF4
+
+def open_grd(fn):
+    # open_grd opens the z variable of a GMT NetCDF grid fn lazily;
+    # values are only read from disk when they are indexed.
+    # Returns a DataArray with dims ('y','x'); the grid registration
+    # (0 gridline, 1 pixel) is kept in attrs['node_offset'].
+    # GMT native float grids (fn=bf, as written by phasediff) are memory mapped.
+    if is_bf_grd(fn):
+        return _open_bf_grd(fn)
+    ds = xr.open_dataset(fn, mask_and_scale=True, cache=False)
+    name = 'z' if 'z' in ds.data_vars else list(ds.data_vars)[0]
+    da = ds[name]
+    if 'lon' in da.dims and 'lat' in da.dims:
+        da = da.rename({'lon': 'x', 'lat': 'y'})
+    da = da.transpose('y', 'x')
+    da.name = 'z'
+    da.attrs = {'node_offset': _registration(ds, da)}
+    return da
+
+def read_grd(fn):
+    # read_grd loads the z variable of a GMT NetCDF grid fn into memory.
+    if is_bf_grd(fn):
+        return _open_bf_grd(fn, mmap=False)
+    da = open_grd(fn)
+    out = da.load()
+    da.close()
+    return out
+
+# header of a GMT native binary grid: 3 int32, 10 float64 and 800 bytes of text
+_BF_HEADER = np.dtype([('nx', '=i4'), ('ny', '=i4'), ('registration', '=i4'),
+                       ('wesn', '=f8', 4), ('zmin', '=f8'), ('zmax', '=f8'),
+                       ('inc', '=f8', 2), ('scale', '=f8'), ('offset', '=f8'),
+                       ('text', 'S800')])
+
+def is_bf_grd(fn):
+    # is_bf_grd tells whether fn is a GMT native float grid: either named
+    # with the =bf suffix or a file that is neither NetCDF nor HDF5.
+    if fn.endswith('=bf'):
+        return True
+    if not os.path.isfile(fn):
+        return False
+    with open(fn, 'rb') as f:
+        magic = f.read(4)
+    return not (magic.startswith(b'CDF') or magic == b'\x89HDF')
+
+def _open_bf_grd(fn, mmap=True):
+    # read a GMT native float grid (top row first) as a DataArray like open_grd.
+    if fn.endswith('=bf'):
+        fn = fn[:-3]
+    h = np.fromfile(fn, dtype=_BF_HEADER, count=1)[0]
+    nx, ny, reg = int(h['nx']), int(h['ny']), int(h['registration'])
+    if os.path.getsize(fn) != _BF_HEADER.itemsize + 4 * nx * ny:
+        raise ValueError(fn + ' is not a GMT native float grid')
+    if mmap:
+        z = np.memmap(fn, dtype='=f4', mode='r', offset=_BF_HEADER.itemsize, shape=(ny, nx))
+    else:
+        z = np.fromfile(fn, dtype='=f4', offset=_BF_HEADER.itemsize).reshape(ny, nx)
+    if h['scale'] != 1. or h['offset'] != 0.:
+        z = z * np.float32(h['scale']) + np.float32(h['offset'])
+    w, e, s, n = h['wesn']
+    dx, dy = h['inc']
+    half = 0.5 if reg == 1 else 0.
+    x = w + (np.arange(nx) + half) * dx
+    y = n - (np.arange(ny) + half) * dy
+    return xr.DataArray(z, dims=('y', 'x'), coords={'x': x, 'y': y}, name='z',
+                        attrs={'node_offset': reg})
+
+def _registration(ds, da):
+    # GMT stores the registration as a global attribute node_offset; old
+    # grids without it are pixel registered if x actual_range is the cell edges.
+    if 'node_offset' in ds.attrs:
+        return int(ds.attrs['node_offset'])
+    x = da['x'].values
+    rng = da['x'].attrs.get('actual_range', None)
+    if rng is not None and len(x) > 1:
+        dx = abs(x[1] - x[0])
+        if np.isclose(min(rng), x.min() - dx / 2.):
+            return 1
+    return 0
+
+def write_grd(fn, da, registration=None, geographic=False):
+    # write_grd writes the DataArray da to a GMT-readable NetCDF grid fn;
+    # geographic=True marks x/y as lon/lat in degrees (as xyz2grd -fg).
+    if registration is None:
+        registration = int(da.attrs.get('node_offset', 0))
+    z = da.transpose('y', 'x').astype(np.float32)
+    w, e, s, n = grd_region(da, registration)
+    finite = np.isfinite(z.values)
+    zmin = float(np.min(z.values[finite])) if finite.any() else np.nan
+    zmax = float(np.max(z.values[finite])) if finite.any() else np.nan
+
+    xattrs = {'long_name': 'x', 'actual_range': np.array([w, e])}
+    yattrs = {'long_name': 'y', 'actual_range': np.array([s, n])}
+    if geographic:
+        xattrs.update({'long_name': 'longitude', 'units': 'degrees_east'})
+        yattrs.update({'long_name': 'latitude', 'units': 'degrees_north'})
+    x = xr.DataArray(z['x'].values.astype(np.float64), dims='x', attrs=xattrs)
+    y = xr.DataArray(z['y'].values.astype(np.float64), dims='y', attrs=yattrs)
+    zvar = xr.DataArray(z.values, dims=('y', 'x'), coords={'x': x, 'y': y},
+                        attrs={'long_name': 'z', 'actual_range': np.array([zmin, zmax])})
+    ds = xr.Dataset({'z': zvar},
+                    attrs={'Conventions': 'CF-1.7', 'title': os.path.basename(fn),
+                           'history': 'pyGMTSAR grid_lib', 'node_offset': np.int32(registration)})
+    tmp = fn + '.tmp'
+    ds.to_netcdf(tmp, format='NETCDF4', encoding={'z': {'_FillValue': np.float32(np.nan), 'zlib': False}})
+    os.replace(tmp, fn)
+
+def grd_inc(da):
+    # grd_inc returns the grid spacing (dx, dy).
+    x = da['x'].values
+    y = da['y'].values
+    dx = abs(float(x[1] - x[0])) if len(x) > 1 else 1.
+    dy = abs(float(y[1] - y[0])) if len(y) > 1 else 1.
+    return dx, dy
+
+def grd_region(da, registration=None):
+    # grd_region returns (w, e, s, n) as reported by gmt grdinfo -I-.
+    if registration is None:
+        registration = int(da.attrs.get('node_offset', 0))
+    dx, dy = grd_inc(da)
+    x = da['x'].values
+    y = da['y'].values
+    half = 0.5 if registration == 1 else 0.
+    return (float(x.min()) - half * dx, float(x.max()) + half * dx,
+            float(y.min()) - half * dy, float(y.max()) + half * dy)
+
+def cut_grd(da, region):
+    # cut_grd mimics gmt grdcut -Rw/e/s/n; region is a string 'w/e/s/n' or a tuple.
+    if isinstance(region, str):
+        region = [float(v) for v in region.replace('-R', '').split('/')]
+    w, e, s, n = region
+    dx, dy = grd_inc(da)
+    half = 0.5 if int(da.attrs.get('node_offset', 0)) == 1 else 0.
+    x = da['x'].values
+    y = da['y'].values
+    ex = 1e-4 * dx
+    ey = 1e-4 * dy
+    ix = np.where((x - half * dx >= w - ex) & (x + half * dx <= e + ex))[0]
+    iy = np.where((y - half * dy >= s - ey) & (y + half * dy <= n + ey))[0]
+    out = da.isel(x=ix, y=iy)
+    out.attrs = dict(da.attrs)
+    return out
+
+def sample_grd(da, like):
+    # sample_grd mimics gmt grdsample, resampling da onto the nodes of like.
+    if da.shape == like.shape and np.allclose(da['x'].values, like['x'].values) \
+            and np.allclose(da['y'].values, like['y'].values):
+        out = da.copy()
+    else:
+        out = da.interp(x=like['x'].values, y=like['y'].values, method='linear')
+    out.attrs = dict(like.attrs)
+    return out
+
+def grd_rows_tl(da):
+    # grd_rows_tl returns the z values with the top (north) row first,
+    # i.e. the -ZTL order used by gmt grd2xyz/xyz2grd.
+    z = da.transpose('y', 'x').values
+    y = da['y'].values
+    if len(y) > 1 and y[1] > y[0]:
+        z = z[::-1, :]
+    return z
+
+def grd_from_rows_tl(z, like):
+    # grd_from_rows_tl puts a top-row-first array z on the nodes of like.
+    y = like['y'].values
+    if len(y) > 1 and y[1] > y[0]:
+        z = z[::-1, :]
+    out = xr.DataArray(np.asarray(z).reshape(like.shape), dims=('y', 'x'),
+                       coords={'x': like['x'].values, 'y': like['y'].values}, name='z')
+    out.attrs = dict(like.attrs)
+    return out
+
+def grd_stats(da):
+    # grd_stats returns the mean, stdev and rms of the finite nodes, as gmt grdinfo -L2.
+    z = da.values
+    z = z[np.isfinite(z)].astype(np.float64)
+    if z.size == 0:
+        return np.nan, np.nan, np.nan
+    mean = z.mean()
+    return float(mean), float(z.std(ddof=1)) if z.size > 1 else 0., float(np.sqrt(np.mean(z * z)))
+
+# GridInfo is the header of a grid, as gmt grdinfo -C reports it.
+GridInfo = namedtuple('GridInfo', 'w e s n dx dy nx ny registration zmin zmax')
+
+# _info_cache keeps the header (and the statistics once asked for) of every
+# grid read by grd_info, keyed by absolute path; an entry is reused as long
+# as the size and modification time of the file are unchanged.
+_info_cache = {}
+
+def _info_entry(fn):
+    path = os.path.abspath(fn)
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    entry = _info_cache.get(path)
+    if entry is None or entry['stamp'] != stamp:
+        with netCDF4.Dataset(path, 'r') as ds:
+            xname = 'x' if 'x' in ds.variables else 'lon'
+            yname = 'y' if 'y' in ds.variables else 'lat'
+            zname = 'z' if 'z' in ds.variables else [v for v in ds.variables if v not in (xname, yname)][0]
+            x = np.asarray(ds.variables[xname][:], dtype=np.float64)
+            y = np.asarray(ds.variables[yname][:], dtype=np.float64)
+            dx = abs(x[1] - x[0]) if len(x) > 1 else 1.
+            dy = abs(y[1] - y[0]) if len(y) > 1 else 1.
+            if 'node_offset' in ds.ncattrs():
+                reg = int(ds.getncattr('node_offset'))
+            else:
+                rng = getattr(ds.variables[xname], 'actual_range', None)
+                reg = 1 if rng is not None and len(x) > 1 and np.isclose(min(rng), x.min() - dx / 2.) else 0
+            half = 0.5 if reg == 1 else 0.
+            zrange = getattr(ds.variables[zname], 'actual_range', None)
+            if zrange is None:
+                z = np.asarray(ds.variables[zname][:], dtype=np.float64)
+                zrange = (np.nanmin(z), np.nanmax(z))
+            info = GridInfo(float(x.min() - half * dx), float(x.max() + half * dx),
+                            float(y.min() - half * dy), float(y.max() + half * dy),
+                            float(dx), float(dy), len(x), len(y), reg, float(zrange[0]), float(zrange[1]))
+        entry = {'stamp': stamp, 'info': info, 'stats': None, 'zname': zname}
+        _info_cache[path] = entry
+    return entry
+
+def grd_info(fn):
+    # grd_info returns the GridInfo of grid fn from its NetCDF header, without
+    # reading the grid values (gmt grdinfo -C).
+    return _info_entry(fn)['info']
+
+def grd_info_stats(fn, block_rows=1024):
+    # grd_info_stats returns the mean, stdev and rms of the finite nodes of grid
+    # fn, as gmt grdinfo -L2, streamed in blocks of rows and cached with the header.
+    entry = _info_entry(fn)
+    if entry['stats'] is None:
+        n, mean, m2, ss = 0, 0., 0., 0.
+        with netCDF4.Dataset(os.path.abspath(fn), 'r') as ds:
+            var = ds.variables[entry['zname']]
+            var.set_auto_mask(False)
+            for i0 in range(0, var.shape[0], block_rows):
+                z = np.asarray(var[i0:i0 + block_rows, :], dtype=np.float64)
+                z = z[np.isfinite(z)]
+                if z.size == 0:
+                    continue
+                # combine the block mean and sum of squared deviations (Chan et al.)
+                bmean = z.mean()
+                bm2 = np.sum((z - bmean) ** 2)
+                delta = bmean - mean
+                mean += delta * z.size / (n + z.size)
+                m2 += bm2 + delta * delta * n * z.size / (n + z.size)
+                ss += np.sum(z * z)
+                n += z.size
+        if n == 0:
+            entry['stats'] = (np.nan, np.nan, np.nan)
+        else:
+            entry['stats'] = (float(mean), float(np.sqrt(m2 / (n - 1))) if n > 1 else 0., float(np.sqrt(ss / n)))
+    return entry['stats']
+
+def grd_R(fn):
+    # grd_R returns the region of grid fn as the -Rw/e/s/n string of gmt grdinfo -I-.
+    info = grd_info(fn)
+    return '-R%.12g/%.12g/%.12g/%.12g' % (info.w, info.e, info.s, info.n)
+
+def grd_I(fn):
+    # grd_I returns the spacing of grid fn as the -Idx/dy string of gmt grdinfo -I.
+    info = grd_info(fn)
+    return '-I%.12g/%.12g' % (info.dx, info.dy)
+
+def write_snaphu_input(fn, da, fill=0., block_rows=1024):
+    # write_snaphu_input writes da as the raw float32 file snaphu reads,
+    # top row first, with NaN replaced by fill (gmt grd2xyz -ZTLf -do0).
+    # da may be a lazy grid from open_grd; it is then streamed in blocks of rows.
+    ny, nx = da.shape
+    out = np.memmap(fn, dtype=np.float32, mode='w+', shape=(ny, nx))
+    y = da['y'].values
+    flip = len(y) > 1 and y[1] > y[0]
+    for i0 in range(0, ny, block_rows):
+        i1 = min(i0 + block_rows, ny)
+        if flip:
+            block = np.asarray(da[ny - i1:ny - i0, :].values)[::-1, :]
+        else:
+            block = np.asarray(da[i0:i1, :].values)
+        out[i0:i1, :] = np.where(np.isfinite(block), block, fill)
+    out.flush()
+    del out
+
+def read_snaphu_output(fn, like, dtype=np.float32):
+    # read_snaphu_output maps the raw top-row-first snaphu output fn onto the
+    # nodes of like without copying. The connected component file is written
+    # as 1-byte or 4-byte integers depending on CONNCOMPOUTTYPE, so dtype=None
+    # picks the type from the file size.
+    ny, nx = like.shape
+    if dtype is None:
+        dtype = np.uint8 if os.path.getsize(fn) == ny * nx else np.uint32
+    z = np.memmap(fn, dtype=dtype, mode='r', shape=(ny, nx))
+    return grd_from_rows_tl(z, like)
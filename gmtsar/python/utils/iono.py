@@ -0,0 +1,275 @@
+#! /usr/bin/env python3
+"""
+# iono.py is part of pyGMTSAR.
+# It replaces estimate_ionospheric_phase.csh.
+
+# Purpose: to estimate the ionospheric phase of an interferogram from the
+# split spectrum interferograms intf_h, intf_l and intf_o (Gomba et al., 2016)
+# with the filtering of Fattahi et al. (2017).
+# The unwrapped sub-band grids are read once and combined in memory. The
+# 21x21 median filter of the sub-band phases is done tile by tile of rows.
+# The long-wavelength filters (median, boxcar and gaussian of the 20 km
+# wavelength windows) are done on the grid decimated to about 8 nodes per
+# window, by FFT convolution for the boxcar and gaussian, and the result is
+# interpolated back to the full grid, instead of filtering the full grid.
+# Syntax: iono.py intf_high intf_low intf_orig intf_to_be_corrected [xratio yratio] [-nproc N]
+# Output: ph_iono.grd, ph_iono_orig.grd and ph_corrected.grd in the current folder.
+
+# nanmedian_filter
+# decimate
+# lowpass
+# upsample
+# estimate_iono
+"""
+
+import sys, os, glob, shutil, warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import median_filter, uniform_filter
+from scipy.signal import fftconvolve
+from concurrent.futures import ProcessPoolExecutor
+from gmtsar_lib import *
+from grid_lib import read_grd, write_grd, grd_info
+from nearest_grid import nearest_grid
+
+def _wrap(z):
+    return np.mod(z+np.pi, 2*np.pi)-np.pi
+
+def _round_cycles(v, period):
+    # round v/period half away from zero, as the awk of the csh.
+    return float(np.trunc(v/period+np.copysign(0.5, v)))
+
+def _median_tile(tile, valid, wy, wx):
+    # median of the valid nodes of the wy x wx windows of the NaN-padded
+    # tile, at the nodes valid of the unpadded tile.
+    hy, hx = wy//2, wx//2
+    ny, nx = valid.shape
+    bad = ~np.isfinite(tile)
+    med = median_filter(np.where(bad, 0., tile), size=(wy, wx), mode='constant')[hy:hy+ny, hx:hx+nx]
+    nbad = uniform_filter(bad.astype(np.float64), size=(wy, wx), mode='constant')[hy:hy+ny, hx:hx+nx]
+    fix = np.argwhere((nbad > 1e-9) & valid)
+    windows = sliding_window_view(tile, (wy, wx))
+    for k in range(0, len(fix), 4096):
+        ii, jj = fix[k:k+4096].T
+        med[ii, jj] = np.nanmedian(windows[ii, jj].reshape(len(ii), -1), axis=1)
+    return np.where(valid, med, np.nan)
+
+def nanmedian_filter(z, wy, wx, block_rows=256, nproc=1):
+    # nanmedian_filter is gmt grdfilter -Dp -Fm<wx>/<wy> -Nr: the median of
+    # the valid nodes of the wy x wx window, NaN where z is NaN. Windows
+    # without NaN use scipy's median filter; the others, at the edges and
+    # around the masked nodes, are taken by nanmedian. Done by tiles of rows,
+    # spread over nproc processes, in the float precision of z.
+    hy, hx = wy//2, wx//2
+    ny, nx = z.shape
+    z = np.asarray(z, dtype=np.result_type(z, np.float32))
+    pad = np.pad(z, ((hy, hy), (hx, hx)), constant_values=np.nan)
+    valid = np.isfinite(z)
+    tiles = [(r0, min(r0+block_rows, ny)) for r0 in range(0, ny, block_rows)]
+    args = [(pad[r0:r1+2*hy], valid[r0:r1], wy, wx) for r0, r1 in tiles]
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            parts = list(pool.map(_median_tile, *zip(*args)))
+    else:
+        parts = [_median_tile(*a) for a in args]
+    return np.concatenate(parts, axis=0)
+
+def decimate(z, qy, qx, median=False, block_rows=1024):
+    # decimate returns the NaN-ignoring mean (or median) of the qy x qx blocks
+    # of z and the fractional row/column indices of the block centres.
+    # z is read by bands of whole blocks of about block_rows rows.
+    ny, nx = z.shape
+    my, mx = -(-ny//qy), -(-nx//qx)
+    zd = np.empty((my, mx))
+    band = max(block_rows//qy, 1)*qy
+    for r0 in range(0, ny, band):
+        r1 = min(r0+band, ny)
+        by = -(-(r1-r0)//qy)
+        pad = np.full((by*qy, mx*qx), np.nan)
+        pad[:r1-r0, :nx] = z[r0:r1]
+        blocks = pad.reshape(by, qy, mx, qx).transpose(0, 2, 1, 3).reshape(by, mx, -1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            zd[r0//qy:r0//qy+by] = np.nanmedian(blocks, axis=2) if median else np.nanmean(blocks, axis=2)
+    cy = np.array([(r0+min(r0+qy, ny)-1)/2. for r0 in range(0, ny, qy)])
+    cx = np.array([(c0+min(c0+qx, nx)-1)/2. for c0 in range(0, nx, qx)])
+    return zd, cy, cx
+
+def lowpass(zd, fy, fx, kind):
+    # lowpass filters the decimated grid zd with a fy x fx window (in decimated
+    # nodes) ignoring NaNs, as grdfilter -Ni: 'm' median, 'b' boxcar and 'g'
+    # gaussian (GMT width = 6 sigma); the last two by FFT convolution.
+    if kind == 'm':
+        filled = nearest_grid(zd, 0).astype(np.float64)
+        return median_filter(filled, size=(fy, fx), mode='nearest')
+    if kind == 'b':
+        kernel = np.ones((fy, fx))
+    else:
+        ky = np.exp(-0.5*((np.arange(fy)-fy//2)/(fy/6.))**2)
+        kx = np.exp(-0.5*((np.arange(fx)-fx//2)/(fx/6.))**2)
+        kernel = np.outer(ky, kx)
+    valid = np.isfinite(zd)
+    num = fftconvolve(np.where(valid, zd, 0.), kernel, mode='same')
+    den = fftconvolve(valid.astype(np.float64), kernel, mode='same')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 1e-6*kernel.sum(), num/den, np.nan)
+
+def upsample(zd, cy, cx, rows, cols, block_rows=1024, dtype=np.float64):
+    # upsample interpolates zd, given at the fractional indices cy/cx of the
+    # full grid, bilinearly at the fractional indices rows/cols (held at the
+    # edge values outside), by tiles of rows, into an array of dtype.
+    def weights(c, q):
+        q = np.clip(q, c[0], c[-1])
+        j1 = np.clip(np.searchsorted(c, q), 1, max(len(c)-1, 1))
+        j0 = j1-1
+        if len(c) == 1:
+            return np.zeros(len(q), int), np.zeros(len(q), int), np.zeros(len(q))
+        return j0, j1, (q-c[j0])/(c[j1]-c[j0])
+    x0, x1, wx = weights(cx, np.asarray(cols, dtype=np.float64))
+    y0, y1, wy = weights(cy, np.asarray(rows, dtype=np.float64))
+    out = np.empty((len(y0), len(x0)), dtype=dtype)
+    for r0 in range(0, len(y0), block_rows):
+        s = slice(r0, min(r0+block_rows, len(y0)))
+        top = zd[y0[s]][:, x0]*(1-wx)+zd[y0[s]][:, x1]*wx
+        bot = zd[y1[s]][:, x0]*(1-wx)+zd[y1[s]][:, x1]*wx
+        out[s] = top*(1-wy[s, None])+bot*wy[s, None]
+    return out
+
+def _fractional(like, x, y):
+    # fractional row/column indices of coordinates x/y on the nodes of like.
+    xc, yc = like['x'].values, like['y'].values
+    return (np.asarray(y)-yc[0])/(yc[1]-yc[0]), (np.asarray(x)-xc[0])/(xc[1]-xc[0])
+
+def _merge_offset(intfH, ph):
+    # correct the offset between merged subswaths with correct_merge_offset.csh,
+    # as estimate_ionospheric_phase.csh does for merged TOPS interferograms.
+    write_grd('tmp_ph0.grd', ph)
+    if os.path.exists(intfH+'/merge_log'):
+        shutil.copy(intfH+'/tmp_phaselist', '.')
+        run('correct_merge_offset.csh tmp_phaselist ../intf_h/merge_log tmp_ph0.grd tmp_ph0_corrected.grd')
+    else:
+        shutil.copy(intfH+'/tmp_phaselist1', '.')
+        run('correct_merge_offset.csh tmp_phaselist1 ../intf_h/merge_log1 tmp_ph0.grd tmp_ph0_corrected.grd')
+        if not os.path.exists('tmp_first'):
+            os.symlink(intfH+'/tmp_first', 'tmp_first')
+        shutil.copy(intfH+'/tmp_phaselist2', '.')
+        run('correct_merge_offset.csh tmp_phaselist2 ../intf_h/merge_log2 tmp_ph0_corrected.grd tmp_ph0_final.grd')
+        shutil.move('tmp_ph0_final.grd', 'tmp_ph0_corrected.grd')
+    out = read_grd('tmp_ph0_corrected.grd')
+    for fn in ['tmp_ph0.grd', 'tmp_ph0_corrected.grd']:
+        delete(fn)
+    return out
+
+def estimate_iono(intfH, intfL, intfO, intf, rx=1, ry=1, thresh=0.1, block_rows=256, nproc=1):
+    # estimate_iono writes ph_iono.grd, ph_iono_orig.grd and ph_corrected.grd
+    # of intf/phasefilt.grd from the split spectrum folders intfH/intfL/intfO.
+    fc, fh, fl = get_prm(intfH+'/params1', 'center_freq', 'high_freq', 'low_freq')
+    print('IONO: applying split spectrum result to estimate ionospheric phase (', fh, fl, ') ...')
+    prm1 = sorted(glob.glob(intfH+'/*PRM'))[0]
+    fs, prf, vel = get_prm(prm1, 'rng_samp_rate', 'PRF', 'SC_vel')
+    rng_pxl = 299792458.0/fs/2.0
+    azi_pxl = vel/prf
+
+    # determine how much filtering is needed
+    wavelength = 20000
+    info = grd_info(intfH+'/phasefilt.grd')
+    filtx = int(wavelength*rx/rng_pxl/info.dx/2)*2+1
+    filty = int(wavelength*ry/azi_pxl/info.dy/2)*2+1
+    qx, qy = max(filtx//8, 1), max(filty//8, 1)
+    print('IONO: filtering size is set to ', filtx, ' along range and ', filty, ' along azimuth, on a grid decimated by ', qx, ' x ', qy)
+    limit = fh*fl/(fh*fh-fl*fl)*np.pi
+
+    # the grids are kept in float32 as stored and freed once used; up_o_grd
+    # is only kept for its nodes
+    nan = np.float32(np.nan)
+    up_o_grd = read_grd(intfO+'/unwrap.grd')
+    up_o = up_o_grd.values.astype(np.float32, copy=False)
+    like = up_o_grd.copy(data=np.broadcast_to(nan, up_o_grd.shape))
+    del up_o_grd
+    up_h = read_grd(intfH+'/unwrap.grd').values.astype(np.float32, copy=False)
+    up_l = read_grd(intfL+'/unwrap.grd').values.astype(np.float32, copy=False)
+
+    # correct for unwrapping errors
+    ch = _round_cycles(np.nanmedian(up_h-up_o), 2*np.pi)
+    print('IONO: correcting high passed phase by ', ch, ' * 2PI ...')
+    up_h -= np.float32(ch*2*np.pi)
+    cl = _round_cycles(np.nanmedian(up_l-up_o), 2*np.pi)
+    print('IONO: correcting low passed phase by ', cl, ' * 2PI ...')
+    up_l -= np.float32(cl*2*np.pi)
+
+    with np.errstate(invalid='ignore'):
+        keep = np.abs((up_h+up_l-2*up_o)/np.float32(2*np.pi)) < 0.2
+    del up_o
+    up_h = nanmedian_filter(np.where(keep, up_h, nan), 21, 21, block_rows, nproc)
+    up_l = nanmedian_filter(np.where(keep, up_l, nan), 21, 21, block_rows, nproc)
+
+    corr = read_grd(intfH+'/corr.grd').values.astype(np.float32, copy=False)
+    corr = (corr+read_grd(intfL+'/corr.grd').values)/np.float32(2.)
+    with np.errstate(invalid='ignore'):
+        keep &= np.nan_to_num(corr, nan=0.) >= thresh
+    del corr
+
+    ph = (fh/fc*up_l-fl/fc*up_h)*(fl*fh/(fh*fh-fl*fl))
+    del up_h, up_l
+    if os.path.exists(intfH+'/merge_log') or os.path.exists(intfH+'/merge_log1'):
+        ph = _merge_offset(intfH, like.copy(data=ph)).values.astype(np.float32, copy=False)
+
+    mm = np.nanmedian(ph[keep])
+    with np.errstate(invalid='ignore'):
+        keep &= (ph <= mm+limit) & (ph >= mm-limit)
+    ph_fixed = np.where(keep, np.nan_to_num(ph, nan=0.), np.float32(0.))
+    ph_interp = nearest_grid(np.where(keep, ph, nan), 0)
+    ny, nx = ph.shape
+    del ph
+
+    rows, cols = np.arange(ny), np.arange(nx)
+    fdx, fdy = max(filtx//qx, 1)//2*2+1, max(filty//qy, 1)//2*2+1
+    for iteration in range(1, 4):
+        kind = 'm' if iteration % 2 == 1 else 'b'
+        zd, cy, cx = decimate(ph_interp, qy, qx, median=(kind == 'm'))
+        del ph_interp
+        filt = upsample(lowpass(zd, fdy, fdx, kind), cy, cx, rows, cols, dtype=np.float32)
+        filled = nearest_grid(np.where(keep, filt, nan), 0)
+        del filt
+        ph_interp = np.where(keep, ph_fixed, filled)
+        del filled
+    del ph_fixed, keep
+
+    # final boxcar and gaussian on the decimated grid, evaluated on the nodes of phasefilt.grd
+    zd, cy, cx = decimate(ph_interp, qy, qx)
+    del ph_interp
+    zd = lowpass(lowpass(zd, fdy, fdx, 'b'), fdy, fdx, 'g')
+    ph0 = read_grd(intf+'/phasefilt.grd')
+    frow, fcol = _fractional(like, ph0['x'].values, ph0['y'].values)
+    iono0 = upsample(zd, cy, cx, frow, fcol)
+
+    corrected = _wrap(ph0.values-iono0)
+    cc = _round_cycles(np.nanmedian(corrected), np.pi)
+    del corrected
+    print('IONO: correcting iono phase by ', cc, ' PI ...')
+    iono = iono0+cc*np.pi
+    del iono0
+    write_grd('ph_iono_orig.grd', ph0.copy(data=iono))
+    write_grd('ph_iono.grd', ph0.copy(data=_wrap(iono)))
+    write_grd('ph_corrected.grd', ph0.copy(data=_wrap(ph0.values-iono)))
+
+def _main_func(description):
+    arg = sys.argv
+    nproc = int(assign_arg(arg, '-nproc')) or 1
+    pos = [a for k, a in enumerate(arg[1:], 1) if a != '-nproc' and arg[k-1] != '-nproc']
+    if len(pos) != 4 and len(pos) != 6:
+        print(description)
+        print("Usage: iono.py intf_high intf_low intf_orig intf_to_be_corrected [xratio yratio] [-nproc N]")
+        print(" ")
+        print(" estimate ionosphere based on split spectrum method in Gomba et. al. 2016")
+        print(" with filtering method in Fattahi et. al. 2017")
+        print(" -nproc N  -- spread the median filter of the sub-band phases over N processes")
+        print(" ")
+        print("Example: iono.py ../iono_phase/intf_h ../iono_phase/intf_l ../iono_phase/intf_o ../../intf/2018312_2018324")
+        sys.exit(1)
+    rx, ry = (float(pos[4]), float(pos[5])) if len(pos) == 6 else (1, 1)
+    estimate_iono(pos[0], pos[1], pos[2], pos[3], rx, ry, nproc=nproc)
+    print('IONO - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)
@@ -0,0 +1,294 @@
+#! /usr/bin/env python3
+"""
+# merge.py is part of pyGMTSAR.
+# It replaces merge_swath and the merging of merge_unwrap_geocode_tops.csh
+# and merge_batch.csh.
+
+# Purpose: to merge the 2 or 3 subswaths of TOPS interferograms. The
+# geometry of the merge (row shifts, overlaps, stitching columns) only
+# depends on the swath PRMs and the grid headers, so it is computed once and
+# reused for every grid and every pair sharing it; the stitching columns of
+# -det_stitch (the NaN edges of phasefilt.grd) are found once per stack.
+# Each swath grid is read once, only its columns that end in the merged grid,
+# and the PRM shifts are applied in memory instead of in tmp.PRM files, so the
+# pairs of a batch are merged concurrently on a process pool.
+# Syntax: merge.py filelist [-det_stitch] [-grids phasefilt,corr,mask,amp]
+#         merge.py -batch inputfile [-det_stitch] [-nproc N] [-grids phasefilt,corr,mask,amp]
+
+# swath_prm
+# merge_geometry
+# det_stitch
+# merge_grid
+# write_merge_log
+# merge_pair
+# merge_batch
+"""
+
+import sys, os
+import numpy as np
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor
+from gmtsar_lib import *
+from grid_lib import open_grd, write_grd, grd_info
+
+SOL = 299792458.
+GRIDS = ['phasefilt', 'corr', 'mask', 'amp']
+PRM_KEYS = ['PRF', 'rng_samp_rate', 'near_range', 'clock_start', 'rshift', 'first_sample', 'num_rng_bins']
+
+def _cround(v):
+    # C round(), half away from zero
+    return int(np.sign(v)*np.floor(abs(v)+0.5))
+
+def swath_prm(master, others):
+    # swath_prm returns the PRM of a swath as merge_swath reads it from
+    # tmp.PRM: the master PRM with the largest first_sample of master and
+    # others and the rshift of the last of others (the repeat PRM).
+    p = dict(zip(PRM_KEYS, get_prm(master, *PRM_KEYS)))
+    fs = max([p['first_sample']]+[get_prm(fn, 'first_sample') for fn in others])
+    p['updates'] = {'first_sample': fs, 'rshift': get_prm(others[-1], 'rshift')}
+    p.update(p['updates'])
+    p['file'] = master
+    return p
+
+_plans = {}
+
+def merge_geometry(prms, infos, stitch=None):
+    # merge_geometry returns the merge plan of grids with the GridInfo infos
+    # of swaths with PRMs prms, as merge_swath: the output size and spacing,
+    # the first output row of every swath and the output columns it fills
+    # (a, b, offset to the swath column). stitch = [n1, n2] overrides the
+    # stitching columns. Plans are kept for the next pairs and grids.
+    key = (tuple(tuple(p[k] for k in PRM_KEYS) for p in prms),
+           tuple((i.nx, i.ny, i.dx, i.dy) for i in infos), tuple(stitch or ()))
+    if key in _plans:
+        return _plans[key]
+    nf = len(prms)
+    if nf not in (2, 3):
+        sys.exit('MERGE: Incorrect input filelist, should contain 2 or 3 files')
+    prf, fs = prms[0]['PRF'], prms[0]['rng_samp_rate']
+    for p in prms[1:]:
+        if p['PRF'] != prf:
+            sys.exit('MERGE: Image PRFs are not consistent')
+        if p['rng_samp_rate'] != fs:
+            sys.exit('MERGE: Image range sampling rates are not consistent')
+    incx = sum(i.dx for i in infos)/nf
+    incy = sum(i.dy for i in infos)/nf
+    nc = [i.nx for i in infos]
+
+    head = [_cround((p['clock_start']-prms[0]['clock_start'])*86400.*prf/incy) for p in prms]
+    minh = min(head)
+    head = [h-minh for h in head]
+    maxy = max(i.ny+h for i, h in zip(infos, head))+1
+    ovl = [nc[k]-_cround((prms[k+1]['near_range']-prms[k]['near_range'])/(SOL/fs/2)/incx) for k in range(nf-1)]
+    xhi = sum(nc)-sum(ovl)-(nf-1)
+    nx = _cround(_cround(xhi*incx)/incx)
+    ny = _cround(_cround(maxy*incy)/incy)
+
+    n = [max(int(np.ceil((-float(p['rshift'])+float(p['first_sample'])+150.)/incx)), 10) for p in prms[1:]]
+    if stitch is not None:
+        n = list(stitch)[:nf-1]
+    c1 = nc[0]-(ovl[0]-n[0])
+    if nf == 2:
+        segs = [(0, c1, 0), (c1, nx, ovl[0]-nc[0])]
+    else:
+        b = nc[0]+nc[1]-ovl[0]-1
+        c2 = b-(ovl[1]-n[1])
+        segs = [(0, c1, 0), (c1, c2, ovl[0]-nc[0]-1), (c2, nx, ovl[1]-b-1)]
+    print('MERGE: ovl12,23: ', ovl[0], ovl[1] if nf == 3 else 0, ' stitching location n1, n2 = ', n[0], n[1] if nf == 3 else 0)
+    plan = {'incx': incx, 'incy': incy, 'nx': nx, 'ny': ny, 'maxy': maxy, 'minh': minh, 'head': head, 'segs': segs,
+            'ovl': ovl+[0]*(3-nf), 'n': list(n)+[0]*(3-nf)}
+    _plans[key] = plan
+    return plan
+
+def _valid_extent(fn, block_rows=1024):
+    # x range of the columns of grid fn with data, as gmt grdcut -Z+N
+    info = grd_info(fn)
+    da = open_grd(fn)
+    ok = np.zeros(info.nx, dtype=bool)
+    for r0 in range(0, info.ny, block_rows):
+        ok |= np.isfinite(da[r0:r0+block_rows, :].values).any(axis=0)
+    da.close()
+    cols = np.where(ok)[0]
+    if len(cols) == 0:
+        return info.w, info.e
+    return info.w+cols[0]*info.dx, info.w+(cols[-1]+info.registration)*info.dx
+
+def det_stitch(grids, prms):
+    # det_stitch returns the stitching columns [n1, n2] from the NaN areas of
+    # the swath grids (det_stitch of merge_unwrap_geocode_tops.csh), or None
+    # when they are estimated to be zero.
+    n = []
+    for k in range(len(grids)-1):
+        i0, i1 = grd_info(grids[k]), grd_info(grids[k+1])
+        e0 = _valid_extent(grids[k])[1]
+        w1 = _valid_extent(grids[k+1])[0]
+        right = int((i0.e-e0)/i0.dx)
+        left = int(w1/i1.dx)
+        ovl = int((prms[k]['num_rng_bins']-(prms[k+1]['near_range']-prms[k]['near_range'])/(SOL/prms[0]['rng_samp_rate']/2))/i1.dx)
+        n.append(int((ovl-right-left)/2+left))
+    if len(n) == 1:
+        n.append(0)
+    if n[0] <= 0 or (len(grids) == 3 and n[1] == 0):
+        print('MERGE: WARNING: Stitching position estimated to be zero, check merged grids carefully')
+        return None
+    print('MERGE: Stitching positions set to ', n[0], n[1])
+    return n
+
+def merge_grid(files, plan, out):
+    # merge_grid writes the merged grid of the swath grids files with plan,
+    # reading every swath once and only the columns it fills.
+    nx, ny = plan['nx'], plan['ny']
+    z = np.full((ny, nx), np.nan, dtype=np.float32)
+    for fn, h, (a, b, off) in zip(files, plan['head'], plan['segs']):
+        da = open_grd(fn)
+        nr, nc = da.shape
+        a, b = max(a, -off), min(b, nc-off, nx)
+        r1 = min(nr, ny-h)
+        if b > a and r1 > 0:
+            band = np.asarray(da[:, a+off:b+off].values, dtype=np.float32)
+            if nr > 1 and da['y'].values[0] > da['y'].values[-1]:
+                band = band[::-1]
+            z[h:h+r1, a:b] = band[:r1]
+        da.close()
+    x = (np.arange(nx)+0.5)*plan['incx']
+    y = (np.arange(ny)+0.5)*plan['incy']
+    write_grd(out, xr.DataArray(z, dims=('y', 'x'), coords={'x': x, 'y': y}), registration=1)
+
+def write_merge_log(outdir, swaths, plan):
+    # write_merge_log writes outdir/merge_log as merge_swath prints it for
+    # phasefilt.grd, and outdir/tmp_phaselist (PRM:grid of every swath), which
+    # correct_merge_offset.csh reads to find the stitching columns.
+    with open(os.path.join(outdir, 'merge_log'), 'w') as f:
+        f.write('ovl12,23: %d, %d\n' % tuple(plan['ovl'][:2]))
+        f.write('Writing the grid files..Size(%dx%d)...\n' % (plan['nx'], plan['ny']))
+        f.write('Stitching location n1 = %d\n' % plan['n'][0])
+        f.write('Stitching location n2 = %d\n' % plan['n'][1])
+
+    def rel(fn):
+        return fn if os.path.isabs(fn) else os.path.relpath(fn, outdir)
+    with open(os.path.join(outdir, 'tmp_phaselist'), 'w') as f:
+        for pth, p in swaths:
+            f.write(rel(p['file'])+':'+rel(os.path.join(pth, 'phasefilt.grd'))+'\n')
+
+def merge_pair(swaths, outdir='.', stem=None, grids=GRIDS, stitch=None):
+    # merge_pair merges the grids of the swath folders swaths [(path, prm)]
+    # into outdir and writes the merged stem.PRM of the first swath PRM, and
+    # merge_log and tmp_phaselist with phasefilt.grd.
+    # Grids missing in a swath folder are skipped, except phasefilt.
+    prms = [p for pth, p in swaths]
+    for g in grids:
+        files = [os.path.join(pth, g+'.grd') for pth, p in swaths]
+        if not all(os.path.isfile(fn) for fn in files):
+            if g == 'phasefilt':
+                sys.exit('MERGE: phasefilt.grd is missing in '+' '.join(pth for pth, p in swaths))
+            print('MERGE: skipping ', g, ', not in every swath folder')
+            continue
+        print('MERGE: merging ', len(files), ' swaths of ', g, '.grd into ', outdir)
+        plan = merge_geometry(prms, [grd_info(fn) for fn in files], stitch)
+        merge_grid(files, plan, os.path.join(outdir, g+'.grd'))
+        if g == 'phasefilt':
+            write_merge_log(outdir, swaths, plan)
+        if g == 'phasefilt' and stem is not None:
+            p = prms[0]
+            num_lines = _cround(plan['maxy']*plan['incy'])
+            num_rng_bins = _cround(plan['nx']*plan['incx'])
+            dt = (-plan['minh']*plan['incy'])/p['PRF']/86400.
+            sc_start, start = get_prm(p['file'], 'SC_clock_start', 'clock_start')
+            # one line per parameter, the last one of the master PRM, as put_sio_struct
+            with open(p['file'], 'r') as f:
+                lines = f.readlines()
+            names = [line.split('=', 1)[0].strip() if '=' in line else None for line in lines]
+            last = {name: k for k, name in enumerate(names)}
+            fn = os.path.join(outdir, stem+'.PRM')
+            with open(fn, 'w') as f:
+                f.writelines(line for k, line in enumerate(lines) if names[k] is None or last[names[k]] == k)
+            updates = dict(p['updates'])
+            updates.update({'num_lines': num_lines, 'nrows': num_lines, 'num_valid_az': num_lines,
+                            'num_rng_bins': num_rng_bins, 'bytes_per_line': num_rng_bins*4,
+                            'good_bytes_per_line': num_rng_bins*4,
+                            'SC_clock_start': sc_start-dt, 'clock_start': start-dt,
+                            'SC_clock_stop': sc_start-dt+num_lines/p['PRF']/86400.,
+                            'clock_stop': start-dt+num_lines/p['PRF']/86400.})
+            set_prm(fn, updates)
+
+def _read_swaths(entries, masters=None):
+    # (path, swath PRM) of 'path:master.PRM:repeat.PRM' entries; with
+    # masters, the PRMs are those of the super master of every swath.
+    swaths = []
+    for k, entry in enumerate(entries):
+        fields = entry.split(':')
+        pth = fields[0]
+        prms = [os.path.join(pth, fn) for fn in fields[1:] if fn != '']
+        if masters is None:
+            swaths.append((pth, swath_prm(prms[0], prms[1:] or prms)))
+        else:
+            swaths.append((pth, swath_prm(masters[k], prms)))
+    return swaths
+
+def merge_batch(inputfile, stitch=False, nproc=1, grids=GRIDS):
+    # merge_batch merges every pair of the merge_batch.csh inputfile into a
+    # folder named after the pair, nproc pairs at a time. The first line holds
+    # the super master PRMs; the stitching columns come from its first pair.
+    with open(inputfile, 'r') as f:
+        lines = [line.strip() for line in f if line.strip() != '']
+    masters = [os.path.join(e.split(':')[0], e.split(':')[1]) for e in lines[0].split(',')]
+    pairs = [_read_swaths(line.split(','), masters) for line in lines]
+    n = None
+    if stitch:
+        n = det_stitch([os.path.join(pth, 'phasefilt.grd') for pth, p in pairs[0]], [p for pth, p in pairs[0]])
+        n = n if n is not None and n[0] > 5 else None
+    jobs = []
+    for swaths in pairs:
+        outdir = os.path.basename(os.path.normpath(swaths[0][0]))
+        os.makedirs(outdir, exist_ok=True)
+        jobs.append((swaths, outdir, 'supermaster', grids, n))
+    print('MERGE: merging ', len(jobs), ' pairs with ', nproc, ' processes')
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            for job in [pool.submit(merge_pair, *args) for args in jobs]:
+                job.result()
+    else:
+        for args in jobs:
+            merge_pair(*args)
+
+def _main_func(description):
+    arg = sys.argv
+    valued = ['-nproc', '-grids']
+    pos = [a for k, a in enumerate(arg[1:], 1) if not a.startswith('-') and arg[k-1] not in valued]
+
+    def Error_Message():
+        print(description)
+        print("Usage: merge.py filelist [-det_stitch] [-grids phasefilt,corr,mask,amp]")
+        print("       merge.py -batch inputfile [-det_stitch] [-nproc N] [-grids phasefilt,corr,mask,amp]")
+        print(" ")
+        print("  filelist    -- Swath_Path:master.PRM:repeat.PRM per swath, as merge_unwrap_geocode_tops.csh")
+        print("  inputfile   -- one pair per line, the swath entries separated by ',', as merge_batch.csh;")
+        print("                 the master PRMs of the first line are the super masters")
+        print("  -det_stitch -- stitch at the middle of the NaN-free overlaps of phasefilt.grd")
+        print("  output: the merged grids, stem.PRM (supermaster.PRM in the pair folders of -batch),")
+        print("          merge_log and tmp_phaselist for correct_merge_offset.csh")
+        print(" ")
+        print("Example: merge.py -batch merge_list -det_stitch -nproc 8")
+        sys.exit(1)
+
+    grids = assign_arg(arg, '-grids')
+    grids = grids.split(',') if grids else GRIDS
+    stitch = '-det_stitch' in arg
+    if '-batch' in arg and len(pos) >= 1 and os.path.isfile(pos[0]):
+        nproc = int(assign_arg(arg, '-nproc')) or 1
+        merge_batch(pos[0], stitch, nproc, grids)
+    elif '-batch' not in arg and len(pos) >= 1 and os.path.isfile(pos[0]):
+        with open(pos[0], 'r') as f:
+            entries = [line.strip() for line in f if line.strip() != '']
+        swaths = _read_swaths(entries)
+        n = None
+        if stitch:
+            n = det_stitch([os.path.join(pth, 'phasefilt.grd') for pth, p in swaths], [p for pth, p in swaths])
+            n = n if n is not None and n[0] > 5 else None
+        merge_pair(swaths, '.', entries[0].split(':')[1].split('.')[0], grids, n)
+    else:
+        Error_Message()
+    print('MERGE - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)
@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+"""
+# nearest_grid.py is part of pyGMTSAR.
+# It is an in-process port of the C program nearest_grid.
+
+# Purpose: to fill NaN nodes of a grid with the value of the nearest
+# non-NaN node, searching no further than a given radius in pixels.
+# Syntax: nearest_grid.py input.grd output.grd [search_radius] [-chunk rows] [-kdtree]
+"""
+
+import sys, os
+import numpy as np
+from gmtsar_lib import *
+
+def _nearest_edt(z, radius):
+    # _nearest_edt fills the NaNs of z from the Euclidean distance transform
+    # of the valid pixels, which also returns the index of the nearest one.
+    from scipy.ndimage import distance_transform_edt
+
+    invalid = ~np.isfinite(z)
+    if not invalid.any() or invalid.all():
+        return z.copy()
+    dist, (ii, jj) = distance_transform_edt(invalid, return_distances=True, return_indices=True)
+    out = z[ii, jj]
+    if radius > 0:
+        out[dist > radius] = np.nan
+    return out
+
+def _nearest_kdtree(z, radius):
+    # _nearest_kdtree fills the NaNs of z by querying a KD-tree of the valid
+    # pixels; cheaper than the distance transform when valid pixels are sparse.
+    from scipy.spatial import cKDTree
+
+    valid = np.isfinite(z)
+    if valid.all() or not valid.any():
+        return z.copy()
+    iv, jv = np.nonzero(valid)
+    tree = cKDTree(np.column_stack((iv, jv)))
+    iq, jq = np.nonzero(~valid)
+    bound = radius+1e-6 if radius > 0 else np.inf
+    dist, k = tree.query(np.column_stack((iq, jq)), k=1, distance_upper_bound=bound)
+    out = z.copy()
+    found = np.isfinite(dist)
+    out[iq[found], jq[found]] = z[iv[k[found]], jv[k[found]]]
+    return out
+
+def nearest_grid(z, radius=300, method='edt', chunk_rows=0, out=None):
+    # nearest_grid replaces every NaN of the 2-D array z by its nearest valid
+    # neighbour within radius pixels (radius=0: no limit), like the C nearest_grid.
+    # method is 'edt' (distance transform), 'kdtree' or 'auto', which picks the
+    # KD-tree when fewer than 5% of the pixels are valid.
+    # With chunk_rows > 0 and radius > 0, z is processed in blocks of rows with a
+    # halo of radius rows, so z may be a lazy grid or np.memmap and out a
+    # preallocated np.memmap; the result is the same as for the whole array.
+    ny, nx = z.shape
+    if out is None:
+        out = np.empty((ny, nx), dtype=np.float32)
+    if chunk_rows <= 0 or radius <= 0:
+        chunk_rows = ny
+
+    for r0 in range(0, ny, chunk_rows):
+        r1 = min(r0+chunk_rows, ny)
+        h0 = max(r0-radius, 0)
+        h1 = min(r1+radius, ny)
+        block = np.asarray(z[h0:h1, :], dtype=np.float32)
+        use = method
+        if method == 'auto':
+            use = 'kdtree' if np.isfinite(block).mean() < 0.05 else 'edt'
+        if use == 'kdtree':
+            filled = _nearest_kdtree(block, radius)
+        else:
+            filled = _nearest_edt(block, radius)
+        out[r0:r1, :] = filled[r0-h0:r1-h0, :]
+    return out
+
+def _main_func(description):
+    from grid_lib import open_grd, write_grd
+
+    arg = sys.argv
+    if len(arg) < 3:
+        print(description)
+        print("Usage: nearest_grid.py input.grd output.grd [search_radius] [-chunk rows] [-kdtree]")
+        print(" ")
+        print("      NaNs will be interpolated to its nearest neighbour")
+        sys.exit(1)
+
+    radius = 0
+    if len(arg) > 3 and not arg[3].startswith('-'):
+        radius = int(arg[3])
+        print('NEAREST_GRID: setting search radius to be ', radius)
+    chunk_rows = assign_arg(arg, '-chunk')
+    method = 'kdtree' if '-kdtree' in arg else 'edt'
+
+    grd = open_grd(arg[1])
+    filled = nearest_grid(grd, radius, method, chunk_rows)
+    write_grd(arg[2], grd.copy(data=filled))
+    grd.close()
+
+if __name__ == "__main__":
+    _main_func(__doc__)
@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+"""
+# ra2ll.py is part of pyGMTSAR.
+# It geocodes grids from range/azimuth to lon/lat with a reusable lookup table.
+
+# Purpose: proj_ra2ll rebuilds the lon/lat of every range/azimuth node from
+# trans.dat (gmt surface), then grdtrack, blockmedian and xyz2grd, for each
+# grid it projects. Here the geographic cell of every node is computed once
+# per geometry (trans.dat, grid nodes, pixel size) and saved next to
+# trans.dat as ra2ll_<key>.npz; every grid on those nodes is then projected
+# with one sort and gather, several grids in one batch.
+#   lon/lat of the nodes: trans.dat is averaged on the 16/32 range/azimuth
+#   bins proj_ra2ll gives to surface, holes of up to 2 bins are filled with
+#   the nearest bin, and the bins are interpolated bilinearly at the nodes.
+#   output grid: the pixel size and region of m2s.csh and gmtinfo -I, taken
+#   from all nodes, and the median of the nodes in each cell (blockmedian).
+# Syntax: ra2ll.py trans.dat in.grd out.grd [in2.grd out2.grd ...] [-wave filter_wavelength]
+
+# pixel_size
+# geo_incs
+# grid_nodes
+# ra_bins
+# ra_lonlat
+# build_ra2ll_map
+# ra2ll_key
+# load_ra2ll_map
+# apply_ra2ll
+# write_ll_grid
+# read_rows_up
+# geocode_grids
+"""
+
+import sys, os, glob, hashlib
+import numpy as np
+import xarray as xr
+from scipy.ndimage import map_coordinates
+from gmtsar_lib import *
+from grid_lib import read_grd, write_grd, grd_info
+from nearest_grid import nearest_grid
+
+RA_INC = (16., 32.)
+FILL_BINS = 2
+M_PER_DEG = 111195.079734
+
+def pixel_size(filt_wave=None):
+    # pixel_size returns the output pixel size in meters as proj_ra2ll picks it:
+    # 1/4 of filt_wave, else 1/4 of the gauss_* filter in cwd, else 60 m.
+    if filt_wave is not None:
+        return float(filt_wave)/4
+    filt = glob.glob('gauss_*')
+    if filt != []:
+        return float(filt[0][6:])/4
+    return 60.
+
+def geo_incs(pix_m, lat_min, lat_max):
+    # geo_incs returns the (dx, dy) in arc seconds of m2s.csh for pixels of pix_m meters.
+    mlat = (lat_min+lat_max)/2.
+    dy = max(np.rint(pix_m/M_PER_DEG*3600*2), 1)/2
+    dx = max(np.rint(pix_m/M_PER_DEG/np.cos(np.radians(mlat))*3600*2), 1)/2
+    return float(dx), float(dy)
+
+def grid_nodes(info):
+    # grid_nodes returns the x and y (ascending) of the nodes of a GridInfo.
+    half = 0.5 if info.registration == 1 else 0.
+    x = info.w+(np.arange(info.nx)+half)*info.dx
+    y = info.s+(np.arange(info.ny)+half)*info.dy
+    return x, y
+
+def ra_bins(trans, x, y, chunk=2000000):
+    # ra_bins averages the lon and lat of trans.dat (r a topo lon lat, float64
+    # binary) on the RA_INC bins covering the nodes x (range), y (azimuth).
+    # Returns the binned lon/lat relative to (lon0, lat0) and the bin origin.
+    ix, iy = RA_INC
+    w = np.floor(x.min()/ix)*ix
+    e = np.ceil(x.max()/ix)*ix
+    s = np.floor(y.min()/iy)*iy
+    n = np.ceil(y.max()/iy)*iy
+    nxb = int(round((e-w)/ix))+1
+    nyb = int(round((n-s)/iy))+1
+
+    data = np.memmap(trans, dtype=np.float64, mode='r')
+    data = data[:data.size//5*5].reshape(-1, 5)
+    count = np.zeros(nxb*nyb)
+    slon = np.zeros(nxb*nyb)
+    slat = np.zeros(nxb*nyb)
+    lon0 = None
+    for i0 in range(0, data.shape[0], chunk):
+        block = np.asarray(data[i0:i0+chunk])
+        j = np.rint((block[:, 0]-w)/ix).astype(np.int64)
+        i = np.rint((block[:, 1]-s)/iy).astype(np.int64)
+        ok = (j >= 0) & (j < nxb) & (i >= 0) & (i < nyb) & np.isfinite(block[:, 3]) & np.isfinite(block[:, 4])
+        if not ok.any():
+            continue
+        if lon0 is None:
+            lon0, lat0 = block[ok, 3].mean(), block[ok, 4].mean()
+        idx = i[ok]*nxb+j[ok]
+        count += np.bincount(idx, minlength=nxb*nyb)
+        slon += np.bincount(idx, weights=block[ok, 3]-lon0, minlength=nxb*nyb)
+        slat += np.bincount(idx, weights=block[ok, 4]-lat0, minlength=nxb*nyb)
+    if lon0 is None:
+        sys.exit('RA2LL: no point of '+trans+' falls on the grid')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        blon = nearest_grid((slon/count).reshape(nyb, nxb), FILL_BINS)
+        blat = nearest_grid((slat/count).reshape(nyb, nxb), FILL_BINS)
+    return {'lon': blon, 'lat': blat, 'lon0': lon0, 'lat0': lat0, 'w': w, 's': s}
+
+def ra_lonlat(bins, x, y, block_rows=1024):
+    # ra_lonlat yields (r0, lon, lat) for blocks of block_rows rows of the
+    # nodes x (range), y (azimuth), interpolated bilinearly from the bins of ra_bins.
+    ix, iy = RA_INC
+    fj = (x-bins['w'])/ix
+    for r0 in range(0, len(y), block_rows):
+        fi = (y[r0:r0+block_rows]-bins['s'])/iy
+        coords = np.array(np.meshgrid(fi, fj, indexing='ij'))
+        lon = map_coordinates(bins['lon'], coords, order=1, mode='nearest', cval=np.nan)+bins['lon0']
+        lat = map_coordinates(bins['lat'], coords, order=1, mode='nearest', cval=np.nan)+bins['lat0']
+        yield r0, lon, lat
+
+def build_ra2ll_map(trans, info, pix_m, block_rows=1024):
+    # build_ra2ll_map returns the lookup table of the nodes of a grid with
+    # header info (GridInfo): 'cell' is the flat output cell (top row first) of
+    # every node, rows in ascending y, -1 where the node has no lon/lat; 'region'
+    # (w, e, s, n) and 'inc' (dx, dy) in degrees describe the pixel registered
+    # output grid. The lon/lat of the nodes are computed by blocks of rows,
+    # once for the extent and once for the cells.
+    x, y = grid_nodes(info)
+    bins = ra_bins(trans, x, y)
+    lon_min, lon_max, lat_min, lat_max = np.inf, -np.inf, np.inf, -np.inf
+    for r0, lon, lat in ra_lonlat(bins, x, y, block_rows):
+        ok = np.isfinite(lon) & np.isfinite(lat)
+        if ok.any():
+            lon_min, lon_max = min(lon_min, lon[ok].min()), max(lon_max, lon[ok].max())
+            lat_min, lat_max = min(lat_min, lat[ok].min()), max(lat_max, lat[ok].max())
+    if lon_min > lon_max:
+        sys.exit('RA2LL: no node of the grid has a lon/lat in '+trans)
+    dxs, dys = geo_incs(pix_m, lat_min, lat_max)
+    # region rounded out to 10 times the increments, as gmtinfo -I<inc2>
+    w = np.floor(lon_min*3600/(10*dxs))*10*dxs/3600
+    e = np.ceil(lon_max*3600/(10*dxs))*10*dxs/3600
+    s = np.floor(lat_min*3600/(10*dys))*10*dys/3600
+    n = np.ceil(lat_max*3600/(10*dys))*10*dys/3600
+    dx, dy = dxs/3600, dys/3600
+    nxo = int(round((e-w)/dx))
+    nyo = int(round((n-s)/dy))
+    cell = np.full((len(y), len(x)), -1, dtype=np.int32)
+    for r0, lon, lat in ra_lonlat(bins, x, y, block_rows):
+        ok = np.isfinite(lon) & np.isfinite(lat)
+        col = np.clip(np.floor((lon[ok]-w)/dx).astype(np.int64), 0, nxo-1)
+        row = np.clip(np.floor((n-lat[ok])/dy).astype(np.int64), 0, nyo-1)
+        cell[r0:r0+len(lon)][ok] = row*nxo+col
+    print('RA2LL: geographic grid of ', nxo, ' x ', nyo, ' pixels at ', dxs, 's/', dys, 's')
+    return {'cell': cell.ravel(), 'region': np.array([w, e, s, n]), 'inc': np.array([dx, dy]),
+            'shape': np.array([nyo, nxo]), 'incs': np.array([dxs, dys])}
+
+def ra2ll_key(trans, info, pix_m):
+    # ra2ll_key hashes what the lookup table depends on: trans.dat (path, size,
+    # mtime), the nodes of the grid with header info and the pixel size.
+    st = os.stat(trans)
+    x, y = grid_nodes(info)
+    text = '%s %d %d %d %d %.10g %.10g %.10g %.10g %.10g' % (os.path.realpath(trans), st.st_size,
+           st.st_mtime_ns, len(x), len(y), x[0], x[-1], y[0], y[-1], pix_m)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def load_ra2ll_map(trans, info, pix_m):
+    # load_ra2ll_map returns the lookup table of the grid with header info,
+    # read from ra2ll_<key>.npz next to trans.dat (or in cwd) or built and saved there.
+    key = ra2ll_key(trans, info, pix_m)
+    name = 'ra2ll_'+key+'.npz'
+    paths = [os.path.join(os.path.dirname(os.path.realpath(trans)), name), name]
+    for fn in paths:
+        if os.path.isfile(fn):
+            print('RA2LL: reusing lookup table ', fn)
+            with np.load(fn) as f:
+                return {k: f[k] for k in f.files}
+    print('RA2LL: building lookup table ', name, ' from ', trans)
+    lut = build_ra2ll_map(trans, info, pix_m)
+    for fn in paths:
+        try:
+            with open(fn+'.tmp', 'wb') as f:
+                np.savez(f, **lut)
+            os.replace(fn+'.tmp', fn)
+            break
+        except OSError:
+            print('RA2LL: could not write ', fn)
+    return lut
+
+def apply_ra2ll(lut, zs):
+    # apply_ra2ll projects the arrays zs, all on the nodes of the lookup table,
+    # in one sort: the median of the finite values falling in each cell.
+    # Returns an array (len(zs), ny, nx) with the top row first.
+    nyo, nxo = [int(v) for v in lut['shape']]
+    ncell = nyo*nxo
+    cell = lut['cell']
+    gid = np.concatenate([np.where(cell >= 0, cell.astype(np.int64)+k*ncell, -1) for k in range(len(zs))])
+    vals = np.concatenate([np.asarray(z, dtype=np.float32).ravel() for z in zs])
+    ok = (gid >= 0) & np.isfinite(vals)
+    gid = gid[ok]
+    vals = vals[ok]
+    order = np.lexsort((vals, gid))
+    gid = gid[order]
+    vals = vals[order]
+    count = np.bincount(gid, minlength=len(zs)*ncell)
+    start = np.cumsum(count)-count
+    has = count > 0
+    lo = start[has]+(count[has]-1)//2
+    hi = start[has]+count[has]//2
+    out = np.full(len(zs)*ncell, np.nan, dtype=np.float32)
+    out[has] = 0.5*(vals[lo]+vals[hi])
+    return out.reshape(len(zs), nyo, nxo)
+
+def write_ll_grid(fn, z, lut):
+    # write_ll_grid writes a top-row-first array z as the pixel registered
+    # lon/lat grid of the lookup table.
+    w, e, s, n = lut['region']
+    dx, dy = lut['inc']
+    nyo, nxo = z.shape
+    x = w+(np.arange(nxo)+0.5)*dx
+    y = s+(np.arange(nyo)+0.5)*dy
+    da = xr.DataArray(z[::-1, :], dims=('y', 'x'), coords={'x': x, 'y': y}, name='z')
+    write_grd(fn, da, registration=1, geographic=True)
+
+def read_rows_up(fn):
+    # read_rows_up reads grid fn with its rows in ascending y, the node order
+    # of the lookup table.
+    z = read_grd(fn).transpose('y', 'x')
+    y = z['y'].values
+    if len(y) > 1 and y[0] > y[-1]:
+        return z.values[::-1, :]
+    return z.values
+
+def geocode_grids(trans, inputs, outputs, filt_wave=None, batch=8):
+    # geocode_grids projects the grids inputs to lon/lat grids outputs, like
+    # proj_ra2ll trans.dat input output [filt_wave] for each of them. Grids on
+    # the same nodes, told from their headers, share one lookup table; they are
+    # read and projected batch at a time.
+    pix_m = pixel_size(filt_wave)
+    print('RA2LL: Sampling in geocoordinates with '+str(pix_m)+' meter pixels ... ...')
+    groups = {}
+    for fin, fout in zip(inputs, outputs):
+        info = grd_info(fin)
+        key = ra2ll_key(trans, info, pix_m)
+        groups.setdefault(key, []).append((fin, fout, info))
+    for key, items in groups.items():
+        lut = load_ra2ll_map(trans, items[0][2], pix_m)
+        for k0 in range(0, len(items), batch):
+            part = items[k0:k0+batch]
+            out = apply_ra2ll(lut, [read_rows_up(fin) for fin, fout, info in part])
+            for k, (fin, fout, info) in enumerate(part):
+                print('RA2LL: ', fin, ' -> ', fout)
+                write_ll_grid(fout, out[k], lut)
+            del out
+
+def _main_func(description):
+    arg = sys.argv
+    wave = assign_arg(arg, '-wave')
+    pos = [a for k, a in enumerate(arg[1:], 1) if a != '-wave' and arg[k-1] != '-wave']
+    if len(pos) < 3 or len(pos) % 2 == 0:
+        print(description)
+        print("Usage: ra2ll.py trans.dat in.grd out.grd [in2.grd out2.grd ...] [-wave filter_wavelength]")
+        print(" ")
+        print(" trans.dat  - file generated by llt_grid2rat  (r a topo lon lat) ")
+        print(" in.grd     - GRD files in range/azimuth coordinates ")
+        print(" out.grd    - output files in lon/lat coordinates ")
+        print(" -wave      - will sample every 1/4 wavelength (in meters) ")
+        sys.exit(1)
+    geocode_grids(pos[0], pos[1::2], pos[2::2], wave if '-wave' in arg else None)
+
+if __name__ == "__main__":
+    _main_func(__doc__)
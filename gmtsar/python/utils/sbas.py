@@ -0,0 +1,275 @@
+#! /usr/bin/env python3
+"""
+# sbas.py is part of pyGMTSAR.
+# It solves the SBAS time series of the C sbas program from the same
+# intf.tab and scene.tab.
+
+# Purpose: to invert a stack of unwrapped interferograms for the cumulative
+# displacement of every scene, the mean LOS velocity and the DEM error.
+# The interferograms are read tile by tile of rows, so memory is bounded by the
+# tile size and not by the size of the stack, and the tiles can be spread over
+# a pool of processes. In a tile the pixels are grouped by the pattern of their
+# valid (not NaN) interferograms; all pixels of a pattern share the rows of the
+# design matrix and are solved together as one batched NumPy solve. Without
+# correlation weights (-noweight) the design matrix of a pattern is factored
+# once and applied to all its pixels. The displacement grids are gathered in a
+# memory-mapped file before they are written.
+# Syntax: sbas.py intf.tab scene.tab [N S xdim ydim] [-smooth sf] [-wavelength wl]
+#                 [-incidence theta] [-range rng] [-rms] [-dem] [-noweight]
+#                 [-nproc N] [-block rows]
+
+# read_tables
+# design_matrix
+# corr_sigma
+# pixel_patterns
+# solve_pattern
+# solve_tile
+# sbas
+"""
+
+import sys, os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from gmtsar_lib import *
+from grid_lib import open_grd, write_grd
+from stack import read_band
+
+RCOND = 1e-3    # rcond of dgelsy in sbas_utils.c
+MM = -79.58     # 1000/(4*pi), phase to mm of LOS
+SOLVE_MB = 256  # memory of the batched weighted solves of one pattern chunk
+
+def read_tables(intf_tab, scene_tab):
+    # read_tables reads intf.tab (unwrap.grd corr.grd ref_id rep_id B_perp)
+    # and scene.tab (scene_id number_of_days) as sbas does. Returns the phase
+    # and correlation grids, the (ref_id, rep_id) pairs, the perpendicular
+    # baselines, the scene ids and the days since the first scene.
+    gfiles, cfiles, pairs, bperp = [], [], [], []
+    with open(intf_tab, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            gfiles.append(fields[0])
+            cfiles.append(fields[1])
+            pairs.append((int(fields[2]), int(fields[3])))
+            bperp.append(float(fields[4]))
+    ids, days = [], []
+    with open(scene_tab, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            ids.append(int(fields[0]))
+            days.append(float(fields[1]))
+    days = np.array(days)
+    return gfiles, cfiles, np.array(pairs, dtype=np.int64).reshape(-1, 2), np.array(bperp), \
+        np.array(ids, dtype=np.int64), days-days[0]
+
+def design_matrix(pairs, ids, time, bperp, sf, scale):
+    # design_matrix returns the matrix of init_G_ts: the N rows of the
+    # interferograms over the S-1 phase increments between consecutive scenes
+    # and the DEM error column bperp*scale, then the S-2 rows smoothing the
+    # increments with factor sf.
+    N, S = len(pairs), len(ids)
+    A = np.zeros((N+S-2, S))
+    A[:N, :S-1] = (ids[None, :S-1] >= pairs[:, 0:1]) & (ids[None, :S-1] < pairs[:, 1:2])
+    A[:N, S-1] = bperp*scale
+    k = np.arange(S-2)
+    A[N+k, k] = sf/(time[k+1]-time[k])
+    A[N+k, k+1] = -sf/(time[k+2]-time[k+1])
+    return A
+
+def corr_sigma(c):
+    # corr_sigma returns the phase sigma sqrt((1-c^2)/c^2) of correlation c
+    # (Rosen et al., 2000) with the bounds of read_table_data_ts.
+    sig = np.full(c.shape, 0.1)
+    with np.errstate(invalid='ignore'):
+        low = c < 1e-2
+        mid = (c >= 1e-2) & (c <= 0.99)
+    sig[low] = 99.99
+    sig[mid] = np.sqrt((1.-c[mid]**2)/c[mid]**2)
+    return sig
+
+def pixel_patterns(valid):
+    # pixel_patterns groups the pixels (columns of the N x P boolean array
+    # valid) by their pattern of valid interferograms. Returns the unique
+    # patterns (n_pattern x N) and the pattern index of each pixel.
+    keys = np.ascontiguousarray(np.packbits(valid, axis=0).T)
+    keys = keys.view(np.dtype((np.void, keys.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return valid[:, first].T, inverse.ravel()
+
+def solve_pattern(Ap, nv, phi, sig=None, budget_mb=SOLVE_MB):
+    # solve_pattern solves Ap x = [phi; 0] in the least-squares sense for the
+    # pixels (columns) of phi, nv x P, with the first nv rows of Ap weighted by
+    # 1/sig as lsqlin_sov_ts. Unweighted, Ap is factored once for all pixels.
+    # Weighted, each pixel has its own m x n copy of Ap; the stacked copies,
+    # their pseudo-inverses and the SVD factors (about 3*m*n doubles a pixel)
+    # are kept within budget_mb by solving the pixels in chunks.
+    if sig is None:
+        return np.linalg.pinv(Ap, RCOND)[:, :nv] @ phi
+    m, n = Ap.shape
+    chunk = max(1, int(budget_mb*2**20)//(8*m*n*3))
+    x = np.empty((n, phi.shape[1]))
+    for p0 in range(0, phi.shape[1], chunk):
+        p1 = min(p0+chunk, phi.shape[1])
+        w = 1./sig[:, p0:p1].T
+        G = np.repeat(Ap[None], p1-p0, axis=0)
+        G[:, :nv, :] *= w[:, :, None]
+        pinv = np.linalg.pinv(G, RCOND)
+        x[:, p0:p1] = np.einsum('pkm,pm->kp', pinv[:, :, :nv], phi[:, p0:p1].T*w)
+    return x
+
+def solve_tile(gfiles, cfiles, r0, r1, A, time, wl, weight, disp_file):
+    # solve_tile solves rows r0:r1 of the stack. The displacement (mm) of every
+    # scene is written into the memory-mapped disp_file; the velocity (mm/yr),
+    # its rms misfit and the DEM error of the rows are returned.
+    N = len(gfiles)
+    S = A.shape[1]
+    phi = np.stack([read_band(fn, r0, r1) for fn in gfiles])
+    ny, nx = phi.shape[1:]
+    phi = phi.reshape(N, -1)
+    sig = np.stack([corr_sigma(read_band(fn, r0, r1)) for fn in cfiles]).reshape(N, -1) if weight else None
+
+    full_rank = np.linalg.matrix_rank(A)
+    x = np.full((S, phi.shape[1]), np.nan)
+    patterns, inverse = pixel_patterns(np.isfinite(phi))
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(patterns)+1))
+    for u, pattern in enumerate(patterns):
+        idx = order[bounds[u]:bounds[u+1]]
+        rows = np.concatenate([np.flatnonzero(pattern), np.arange(N, A.shape[0])])
+        Ap = A[rows]
+        # a pattern missing interferograms that the network needs is left NaN
+        if not pattern.any() or np.linalg.matrix_rank(Ap) < full_rank:
+            continue
+        x[:, idx] = solve_pattern(Ap, int(pattern.sum()), phi[pattern][:, idx],
+                                  None if sig is None else sig[pattern][:, idx])
+
+    disp = np.zeros_like(x)
+    disp[0] = np.where(np.isnan(x[0]), np.nan, 0.)
+    disp[1:] = np.cumsum(x[:S-1], axis=0)
+
+    # straight line fit of the displacement as lsqlin_sov_ts
+    t = time[:, None]
+    sumx, sumxx = time.sum(), (time*time).sum()
+    sumy, sumxy = disp.sum(axis=0), (t*disp).sum(axis=0)
+    slope = (S*sumxy-sumx*sumy)/(S*sumxx-sumx*sumx)
+    aa = sumy/S-slope*sumx/S
+    sumyy = ((disp[2:S-2]-t[2:S-2]*slope-aa)**2).sum(axis=0)
+    vel = MM*wl*slope*365.
+    res = np.sqrt(S*sumyy/((S-2)*(S*sumxx-sumx*sumx)))*(-MM*wl*365.)
+
+    out = np.load(disp_file, mmap_mode='r+')
+    out[:, r0:r1, :] = (MM*wl*disp).reshape(S, ny, nx)
+    out.flush()
+    del out
+    return vel.reshape(ny, nx), res.reshape(ny, nx), x[S-1].reshape(ny, nx)
+
+def sbas(intf_tab, scene_tab, sf=0., wl=0.236, theta=37., rng=866000., weight=True,
+         nproc=1, block_rows=256, disp_file='sbas_disp.npy'):
+    # sbas solves the time series of intf.tab/scene.tab and returns the
+    # template grid, the scene ids, the displacement memmap (S x ny x nx, mm)
+    # and the velocity, rms and DEM error grids.
+    gfiles, cfiles, pairs, bperp, ids, time = read_tables(intf_tab, scene_tab)
+    N, S = len(gfiles), len(ids)
+    print('SBAS: number of interferograms is ', N, ', number of SAR scenes is ', S)
+    scale = 4.*np.pi/wl/rng/np.sin(theta/180.*np.pi)
+    A = design_matrix(pairs, ids, time, bperp, sf, scale)
+    rank = np.linalg.matrix_rank(A)
+    print('SBAS: matrix is full rank: '+str(rank) if rank == S else 'SBAS: matrix is rank-deficient: '+str(rank))
+
+    like = open_grd(cfiles[0])
+    ny, nx = like.shape
+    for fn in gfiles+cfiles:
+        da = open_grd(fn)
+        if da.shape != (ny, nx):
+            sys.exit('SBAS: dimension of '+fn+" doesn't match")
+        da.close()
+
+    np.lib.format.open_memmap(disp_file, mode='w+', dtype=np.float32, shape=(S, ny, nx)).flush()
+    tiles = [(r0, min(r0+block_rows, ny)) for r0 in range(0, ny, block_rows)]
+    args = (A, time, wl, weight, disp_file)
+    print('SBAS: run least-squares problem over ', nx, ' by ', ny, ' pixels in ', len(tiles), ' tiles on ', nproc, ' processes')
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            jobs = [pool.submit(solve_tile, gfiles, cfiles, r0, r1, *args) for r0, r1 in tiles]
+            parts = [job.result() for job in jobs]
+    else:
+        parts = [solve_tile(gfiles, cfiles, r0, r1, *args) for r0, r1 in tiles]
+    vel, res, dem = (np.concatenate([p[k] for p in parts], axis=0) for k in range(3))
+    disp = np.load(disp_file, mmap_mode='r')
+    return like, ids, disp, vel, res, dem
+
+def _main_func(description):
+    arg = sys.argv
+    valued = ['-smooth', '-wavelength', '-incidence', '-range', '-nproc', '-block', '-atm']
+    pos = [a for k, a in enumerate(arg[1:], 1)
+           if not a.startswith('-') and arg[k-1] not in valued]
+
+    def Error_Message():
+        print(description)
+        print("Usage: sbas.py intf.tab scene.tab [N S xdim ydim] [-smooth sf] [-wavelength wl] [-incidence theta]")
+        print("               [-range rng] [-rms] [-dem] [-noweight] [-nproc N] [-block rows]")
+        print(" ")
+        print("  intf.tab        -- unwrap.grd corr.grd ref_id rep_id B_perp per line")
+        print("  scene.tab       -- scene_id number_of_days per line, in chronological order")
+        print("  N S xdim ydim   -- optional, checked against the tables and grids as sbas")
+        print("  -smooth sf      -- smoothing factor, default=0")
+        print("  -wavelength wl  -- radar wavelength (m), default=0.236")
+        print("  -incidence theta -- incidence angle (degree), default=37")
+        print("  -range rng      -- range distance to the center of the interferogram (m), default=866000")
+        print("  -rms            -- output velocity uncertainty grid (mm/yr): rms.grd")
+        print("  -dem            -- output DEM error (m): dem_err.grd")
+        print("  -noweight       -- no correlation weights; one factorization per pattern of valid interferograms")
+        print("  -nproc N        -- spread tiles of rows over N processes")
+        print("  -block n        -- number of rows per tile (default 256)")
+        print(" ")
+        print("  output: disp_#######.grd (mm) for every scene and vel.grd (mm/yr)")
+        print("  pixels are solved with their valid interferograms while these keep the rank of the network")
+        print("  atmospheric correction (-atm) is only done by the C sbas")
+        sys.exit(1)
+
+    if len(pos) < 2 or not os.path.isfile(pos[0]) or not os.path.isfile(pos[1]):
+        Error_Message()
+    if '-atm' in arg or '-robust' in arg:
+        print('SBAS: -atm and -robust are not supported, use the C sbas')
+        Error_Message()
+
+    sf = float(assign_arg(arg, '-smooth'))
+    wl = float(assign_arg(arg, '-wavelength')) or 0.236
+    theta = float(assign_arg(arg, '-incidence')) or 37.
+    rng = float(assign_arg(arg, '-range')) or 866000.
+    nproc = int(assign_arg(arg, '-nproc')) or 1
+    block_rows = int(assign_arg(arg, '-block')) or 256
+
+    if len(pos) >= 6:
+        N, S, xdim, ydim = [int(p) for p in pos[2:6]]
+        gfiles, cfiles, pairs, bperp, ids, time = read_tables(pos[0], pos[1])
+        if N != len(gfiles):
+            sys.exit("SBAS: N and number of interferograms don't match!")
+        if S != len(ids):
+            sys.exit("SBAS: S and number of the SAR scenes don't match!")
+        da = open_grd(cfiles[0])
+        if da.shape != (ydim, xdim):
+            sys.exit("SBAS: xdim and ydim don't match the grids!")
+        da.close()
+
+    like, ids, disp, vel, res, dem = sbas(pos[0], pos[1], sf, wl, theta, rng, '-noweight' not in arg,
+                                         nproc, block_rows)
+
+    print('SBAS: write output ... ...')
+    for i, scene in enumerate(ids):
+        write_grd('disp_%07d.grd' % scene, like.copy(data=np.asarray(disp[i])))
+    write_grd('vel.grd', like.copy(data=vel))
+    if '-rms' in arg:
+        write_grd('rms.grd', like.copy(data=res))
+    if '-dem' in arg:
+        write_grd('dem_err.grd', like.copy(data=dem))
+    like.close()
+    del disp
+    delete('sbas_disp.npy')
+    print('SBAS - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)
@@ -9,7 +9,159 @@
 
 import sys, os, re, configparser
 import subprocess, glob, shutil
+import numpy as np
 from gmtsar_lib import * 
+from grid_lib import *
+from nearest_grid import nearest_grid
+
+def snaphu_command(phase_in, ncol, conf, corr_in, unwrap_out, conncomp_out, defomax):
+    # snaphu_command builds the snaphu call used for the whole patch and for each tile.
+    if float(defomax) == 0:
+        mode = ' -s '
+    else:
+        mode = ' -d '
+    return 'snaphu '+phase_in+' '+str(ncol)+' -f '+conf+' -c '+corr_in+' -o '+unwrap_out+' -v'+mode+'-g '+conncomp_out
+
+def tile_bounds(n, ntile, overlap):
+    # tile_bounds splits n rows (or columns) into ntile overlapping pieces.
+    # Returns a list of (start, end, core_start, core_end); the core is the
+    # part of the tile kept when stitching, split at the middle of each overlap.
+    step = int(np.ceil(n/ntile))
+    bounds = []
+    for k in range(ntile):
+        c0 = k*step
+        c1 = min((k+1)*step, n)
+        if c0 >= c1:
+            break
+        bounds.append((max(c0-overlap, 0), min(c1+overlap, n), c0, c1))
+    return bounds
+
+def _run_tile(cmd, workdir):
+    # _run_tile runs snaphu for one tile inside its own directory.
+    with open(os.path.join(workdir, 'snaphu.log'), 'w') as f:
+        status = subprocess.run(cmd, shell=True, cwd=workdir, stdout=f, stderr=subprocess.STDOUT).returncode
+    return workdir, status
+
+def unwrap_tiled(phase, corr, valid, conf, defomax, ntile_rng, ntile_azi, overlap, nproc):
+    # unwrap_tiled unwraps the top-row-first arrays phase and corr in
+    # ntile_azi x ntile_rng overlapping tiles on a pool of nproc snaphu processes.
+    # The integer-cycle offset of each tile is reconciled against its already
+    # placed neighbours in the overlaps (only pixels where valid is True count),
+    # and connected components touching across an overlap are merged.
+    # Returns the stitched unwrapped phase and connected component arrays.
+    from concurrent.futures import ProcessPoolExecutor
+    
+    ny, nx = phase.shape
+    rows = tile_bounds(ny, ntile_azi, overlap)
+    cols = tile_bounds(nx, ntile_rng, overlap)
+    conf = os.path.abspath(conf)
+    tiles = {}
+    for i, r in enumerate(rows):
+        for j, c in enumerate(cols):
+            workdir = 'snaphu_tile_'+str(i)+'_'+str(j)
+            os.makedirs(workdir, exist_ok=True)
+            sub = (slice(r[0], r[1]), slice(c[0], c[1]))
+            np.where(np.isfinite(phase[sub]), phase[sub], 0.).astype(np.float32).tofile(workdir+'/phase.in')
+            np.where(np.isfinite(corr[sub]), corr[sub], 0.).astype(np.float32).tofile(workdir+'/corr.in')
+            tiles[(i, j)] = {'dir': workdir, 'rows': r, 'cols': c, 'cmd':
+                             snaphu_command('phase.in', c[1]-c[0], conf, 'corr.in', 'unwrap.out', 'conncomp.out', defomax)}
+    
+    print('SNAPHU: unwrapping', len(tiles), 'tiles on', nproc, 'processes ... ...')
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        jobs = [pool.submit(_run_tile, t['cmd'], t['dir']) for t in tiles.values()]
+        for job in jobs:
+            workdir, status = job.result()
+            print('SNAPHU: tile', workdir, 'finished with status', status)
+            if status != 0:
+                sys.exit('SNAPHU: ERROR: snaphu failed in '+workdir)
+    
+    label_offset = 0
+    for t in tiles.values():
+        shape = (t['rows'][1]-t['rows'][0], t['cols'][1]-t['cols'][0])
+        t['unwrap'] = np.fromfile(t['dir']+'/unwrap.out', dtype=np.float32).reshape(shape)
+        fn = t['dir']+'/conncomp.out'
+        dtype = np.uint8 if os.path.getsize(fn) == shape[0]*shape[1] else np.uint32
+        cc = np.fromfile(fn, dtype=dtype).reshape(shape).astype(np.int64)
+        # make the component labels unique across tiles, 0 stays unassigned
+        t['conncomp'] = np.where(cc > 0, cc+label_offset, 0)
+        label_offset += int(cc.max())
+    
+    print('SNAPHU: reconcile integer-cycle offsets across tile overlaps ... ...')
+    placed = [(0, 0)]
+    todo = [k for k in tiles if k != (0, 0)]
+    while len(todo) > 0:
+        # place the tile with the largest valid overlap against the placed ones
+        best = None
+        for k in todo:
+            t = tiles[k]
+            diffs = []
+            for p in placed:
+                q = tiles[p]
+                r0 = max(t['rows'][0], q['rows'][0])
+                r1 = min(t['rows'][1], q['rows'][1])
+                c0 = max(t['cols'][0], q['cols'][0])
+                c1 = min(t['cols'][1], q['cols'][1])
+                if r0 >= r1 or c0 >= c1:
+                    continue
+                a = q['unwrap'][r0-q['rows'][0]:r1-q['rows'][0], c0-q['cols'][0]:c1-q['cols'][0]]
+                b = t['unwrap'][r0-t['rows'][0]:r1-t['rows'][0], c0-t['cols'][0]:c1-t['cols'][0]]
+                diffs.append((a-b)[valid[r0:r1, c0:c1]])
+            diffs = np.concatenate(diffs) if len(diffs) > 0 else np.array([])
+            if best is None or diffs.size > best[1].size:
+                best = (k, diffs)
+        k, diffs = best
+        cycles = np.round(np.median(diffs)/(2.*np.pi)) if diffs.size > 0 else 0.
+        print('SNAPHU: tile', tiles[k]['dir'], 'shifted by', int(cycles), 'cycles using', diffs.size, 'pixels')
+        tiles[k]['unwrap'] = tiles[k]['unwrap']+np.float32(2.*np.pi*cycles)
+        placed.append(k)
+        todo.remove(k)
+    
+    print('SNAPHU: stitch the tiles and merge connected components ... ...')
+    unwrap = np.zeros((ny, nx), dtype=np.float32)
+    conncomp = np.zeros((ny, nx), dtype=np.int64)
+    parent = np.arange(label_offset+1)
+    
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+    
+    for k, t in tiles.items():
+        r, c = t['rows'], t['cols']
+        core = (slice(r[2]-r[0], r[3]-r[0]), slice(c[2]-c[0], c[3]-c[0]))
+        unwrap[r[2]:r[3], c[2]:c[3]] = t['unwrap'][core]
+        conncomp[r[2]:r[3], c[2]:c[3]] = t['conncomp'][core]
+        # components of two tiles are the same where they overlap and agree
+        for p, q in tiles.items():
+            if p <= k:
+                continue
+            r0 = max(r[0], q['rows'][0])
+            r1 = min(r[1], q['rows'][1])
+            c0 = max(c[0], q['cols'][0])
+            c1 = min(c[1], q['cols'][1])
+            if r0 >= r1 or c0 >= c1:
+                continue
+            la = t['conncomp'][r0-r[0]:r1-r[0], c0-c[0]:c1-c[0]]
+            lb = q['conncomp'][r0-q['rows'][0]:r1-q['rows'][0], c0-q['cols'][0]:c1-q['cols'][0]]
+            ua = t['unwrap'][r0-r[0]:r1-r[0], c0-c[0]:c1-c[0]]
+            ub = q['unwrap'][r0-q['rows'][0]:r1-q['rows'][0], c0-q['cols'][0]:c1-q['cols'][0]]
+            same = (la > 0) & (lb > 0) & (np.abs(ua-ub) < np.pi)
+            for a, b in set(zip(la[same].tolist(), lb[same].tolist())):
+                ra, rb = find(a), find(b)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+    
+    roots = np.array([find(a) for a in range(label_offset+1)])
+    labels = np.unique(roots[conncomp])
+    labels = labels[labels > 0]
+    relabel = np.zeros(label_offset+1, dtype=np.uint32)
+    relabel[labels] = np.arange(1, len(labels)+1, dtype=np.uint32)
+    conncomp = relabel[roots[conncomp]]
+    
+    for t in tiles.values():
+        shutil.rmtree(t['dir'])
+    return unwrap, conncomp
 
 def snaphu():
     
@@ -17,21 +169,44 @@ def snaphu():
         print( "snaphu.py - unwrap the phase.")
         print( " if interp flag is invoked, unwrap the phase with nearest neighbor interpolating low coherence and blank pixels.")
         print( "Usage: snaphu.py correlation_threshold maximum_discontinuity interp [<rng0>/<rngf>/<azi0>/<azif>]")  
+        print( "                 [-ntile_rng N -ntile_azi N [-overlap pixels] [-nproc N]]")
         print( " ")
         print( " correlation is reset to zero when < threshold ")
         print( " maximum_discontinuity enables phase jumps for earthquake ruptures, etc. ")
         print( " set maximum_discontinuity = 0 for continuous phase such as interseismic ")
-        print( " interp=1, then calling nearest_grid to interpolate. ")
+        print( " interp=1, then nearest neighbour interpolation (nearest_grid.py) within 300 pixels. ")
+        print( " -ntile_rng/-ntile_azi split the patch into overlapping tiles unwrapped in parallel ")
+        print( "   on -nproc processes (default: number of tiles); -overlap defaults to 200 pixels. ")
         print( " ")
         print( "Example: snaphu.py .12 40 1 1000/3000/24000/27000 ")
+        print( "Example: snaphu.py .12 0 0 -ntile_rng 4 -ntile_azi 8 -overlap 300 -nproc 32 ")
         print( "Reference: ")
         print( "Chen C. W. and H. A. Zebker, Network approaches to two-dimensional phase unwrapping: intractability and two new algorithms, Journal of the Optical Society of America A, vol. 17, pp. 401-414 (2000).")
         print( "Agram, P. S., & Zebker, H. A. (2009). Sparse two-dimensional phase unwrapping using regular-grid methods. IEEE Geoscience and Remote Sensing Letters, 6(2), 327-331.")
         
     print('SNAPHU - START ... ...')
-    n = len(sys.argv)
     print('SNAPHU: input arguments are ', sys.argv)
     
+    ntile_rng = assign_arg(sys.argv, '-ntile_rng')
+    ntile_azi = assign_arg(sys.argv, '-ntile_azi')
+    overlap   = assign_arg(sys.argv, '-overlap')
+    nproc     = assign_arg(sys.argv, '-nproc')
+    # positional arguments without the tiling options
+    arg = []
+    for i, a in enumerate(sys.argv):
+        if a in ['-ntile_rng', '-ntile_azi', '-overlap', '-nproc'] or \
+           (i > 0 and sys.argv[i-1] in ['-ntile_rng', '-ntile_azi', '-overlap', '-nproc']):
+            continue
+        arg.append(a)
+    n = len(arg)
+    ntile_rng = max(ntile_rng, 1)
+    ntile_azi = max(ntile_azi, 1)
+    tiled = ntile_rng*ntile_azi > 1
+    if overlap == 0:
+        overlap = 200
+    if nproc == 0:
+        nproc = ntile_rng*ntile_azi
+    
     if n==1:
         print('SNAPHU: snaphu help information ... ...')
         Error_Message()
@@ -41,67 +216,57 @@ def snaphu():
         print('FILTER: Wrong # of input arguments; # should be larger than 3 ... ...')
         Error_Message()
     
-    interp = int(sys.argv[3])
+    interp = int(arg[3])
     if interp == 1:
         print('SNAPHU: interp is activated; unwrap the phase with nearest neighbor interpolating low coherence and blank pixels.')
     else: 
         print('SNAPHU: interp is NOT activated; unwrap the phase.')
         
-    V = '-V'
-    
-    print('SNAPHU: prepare the files adding the correlation mask ... ...')
+    print('SNAPHU: load the grids once and prepare the correlation mask in memory ... ...')
+    thresh = float(arg[1])
+    mask  = read_grd('mask.grd')
+    corr  = read_grd('corr.grd')
+    phase = read_grd('phasefilt.grd')
     if n==5:
-        run('gmt grdcut mask.grd -R'+sys.argv[4]+' -Gmask_patch.grd')
-        run('gmt grdcut corr.grd -R'+sys.argv[4]+' -Gcorr_patch.grd')
-        run('gmt grdcut phasefilt.grd -R'+sys.argv[4]+' -Gphase_patch.grd')
-    else:
-        file_shuttle('mask.grd', 'mask_patch.grd', 'link')
-        file_shuttle('corr.grd', 'corr_patch.grd', 'link')
-        file_shuttle('phasefilt.grd', 'phase_patch.grd', 'link')
+        mask  = cut_grd(mask, arg[4])
+        corr  = cut_grd(corr, arg[4])
+        phase = cut_grd(phase, arg[4])
     
     print(' ')
     print('SNAPHU: ceate landmask ... ...')
     
+    landmask = None
     if check_file_report('landmask_ra.grd')==True:
-        if n==5:
-            par_tmp = subprocess.run(["gmt","grdinfo","-I","phase_patch.grd"],stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
-            print('SNAPHU: par_tmp is ', par_tmp)
-            run('gmt grdsample landmask_ra.grd -R'+sys.argv[4]+' '+par_tmp+' -Glandmask_ra_patch.grd')
-        else:
-            if interp==0:
-                run('gmt grdsample landmask_ra.grd -Rphase_patch.grd -Glandmask_ra_patch.grd')
-            elif interp==1:
-                par = catch_output_cmd(["gmt","grdinfo","-I","phase_patch.grd"],False,-999,-100000)
-                run('gmt grdsample landmask_ra.grd '+par+' -Glandmask_ra_patch.grd')
-        print(' ')
-        run('gmt grdmath phase_patch.grd landmask_ra_patch.grd MUL = phase_patch.grd '+V)
+        landmask = sample_grd(read_grd('landmask_ra.grd'), phase)
+        phase = phase.copy(data=phase.values*landmask.values)
 
     print(' ')
     print('SNAPHU: user defined mask ... ...')
     
+    mask_def = None
     if check_file_report('mask_def.grd')==True:
+        mask_def = read_grd('mask_def.grd')
         if n==5:
-            run('gmt grdcut mask_def.grd -R'+sys.argv[4]+' -Gmask_def_patch.grd') 
-        else:
-            file_shuttle('mask_def.grd','mask_def_patch.grd','cp')
+            mask_def = cut_grd(mask_def, arg[4])
+        corr = corr.copy(data=corr.values*mask_def.values)
     
-        print(' ')
-        run('gmt grdmath corr_patch.grd mask_def_patch.grd MUL = corr_patch.grd '+V)
-
-    
-    run('gmt grdmath corr_patch.grd '+sys.argv[1]+' GE 0 NAN mask_patch.grd MUL = mask2_patch.grd')
-    run('gmt grdmath corr_patch.grd 0. XOR 1. MIN  = corr_patch.grd')
-    run('gmt grdmath mask2_patch.grd corr_patch.grd MUL = corr_tmp.grd') 
+    # gmt grdmath corr_patch.grd thresh GE 0 NAN mask_patch.grd MUL = mask2_patch.grd
+    mask2 = np.where(corr.values >= thresh, 1., np.nan)*mask.values
+    # gmt grdmath corr_patch.grd 0. XOR 1. MIN = corr_patch.grd
+    corr_clip = np.minimum(np.nan_to_num(corr.values, nan=0.), 1.)
+    corr_tmp = phase.copy(data=mask2*corr_clip)
     
     if interp==0:
-        run('gmt grd2xyz phase_patch.grd -ZTLf -do0 > phase.in')
+        phase_tmp = phase
     elif interp==1:
-        run('gmt grdmath mask2_patch.grd phase_patch.grd MUL = phase_tmp.grd')
-        run('nearest_grid phase_tmp.grd tmp.grd 300')
-        file_shuttle('tmp.grd', 'phase_tmp.grd', 'mv')
-        run('gmt grd2xyz phase_tmp.grd -ZTLf -do0 > phase.in')
-    
-    run('gmt grd2xyz corr_tmp.grd -ZTLf  -do0 > corr.in')
+        print('SNAPHU: nearest neighbour interpolation of low coherence and blank pixels ... ...')
+        try:
+            phase_tmp = phase.copy(data=nearest_grid(mask2*phase.values, 300))
+        except ImportError:
+            print('SNAPHU: scipy is not available; calling the C nearest_grid ... ...')
+            write_grd('phase_tmp.grd', phase.copy(data=mask2*phase.values))
+            run('nearest_grid phase_tmp.grd tmp.grd 300')
+            phase_tmp = open_grd('tmp.grd')
     
     print(' ')
     print('SNAPHU: run snaphu ... ...')
@@ -110,66 +275,73 @@ def snaphu():
     print(' ')
     print('SNAPHU: unwrapping phase with snaphu - higher threshold for faster unwrapping ... ...')
     
-    par_tmp = catch_output_cmd(["gmt","grdinfo","-C","phase_patch.grd"], True, 10, -100000)
-    #par_tmp = subprocess.run(["gmt","grdinfo","-C","phase_patch.grd"], stdout=subprocess.PIPE).stdout.decode('utf-8').strip().split()[9]
-    print('SNAPHU: output from gmt grdinfo -C phase_patch.grd | cut -f 10 is ', par_tmp)
-    
-    if float(sys.argv[2]) == 0:    
-        run('snaphu phase.in '+par_tmp+' -f '+sharedir+'/snaphu/config/snaphu.conf.brief -c corr.in -o unwrap.out -v -s -g conncomp.out')
+    if float(arg[2]) == 0:    
+        conf = sharedir+'/snaphu/config/snaphu.conf.brief'
     else:
         print('SNAPHU: replacing the line containing DEFOMAX_CYCLE to DEFOMAX_CYCLE $2 from snaphu.conf.brief... ...')
         file_shuttle(sharedir+'/snaphu/config/snaphu.conf.brief','snaphu.conf.brief','cp')
-        replace_strings('snaphu.conf.brief','DEFOMAX_CYCLE','DEFOMAX_CYCLE '+sys.argv[2])
-        run('snaphu phase.in '+par_tmp+' -f snaphu.conf.brief -c corr.in -o unwrap.out -v -d -g conncomp.out')
-    
-    print(' ')
-    print('SNAPHU: convert to grd ... ...')
+        replace_strings('snaphu.conf.brief','DEFOMAX_CYCLE','DEFOMAX_CYCLE '+arg[2])
+        conf = 'snaphu.conf.brief'
     
-    par1 = catch_output_cmd(["gmt","grdinfo","-I-","phase_patch.grd"],False,0,-100000)
-    par2 = catch_output_cmd(["gmt","grdinfo","-I", "phase_patch.grd"],False,0,-100000)
-    print('SNAPHU: output from gmt grdinfo -I- phase_patch.grd is', par1)
-    print('SNAPHU: output from gmt grdinfo -I phase_patch.grd is', par2)
+    w, e, s, nn = grd_region(phase)
+    if tiled:
+        print('SNAPHU: tiled unwrapping with', ntile_rng, 'x', ntile_azi, 'tiles and', overlap, 'pixels overlap ... ...')
+        unwrap_tl, conncomp_tl = unwrap_tiled(grd_rows_tl(phase_tmp), grd_rows_tl(corr_tmp), 
+                                              np.isfinite(grd_rows_tl(corr_tmp)), conf, arg[2], 
+                                              ntile_rng, ntile_azi, overlap, nproc)
+        unwrap = grd_from_rows_tl(unwrap_tl, phase)
+        conncomp = grd_from_rows_tl(conncomp_tl, phase)
+    else:
+        print('SNAPHU: write the float32 snaphu inputs phase.in and corr.in ... ...')
+        write_snaphu_input('phase.in', phase_tmp)
+        write_snaphu_input('corr.in', corr_tmp)
+        
+        par_tmp = str(phase.shape[1])
+        print('SNAPHU: number of columns of phase_patch is ', par_tmp)
+        run(snaphu_command('phase.in', par_tmp, conf, 'corr.in', 'unwrap.out', 'conncomp.out', arg[2]))
+        
+        print(' ')
+        print('SNAPHU: convert to grd ... ...')
+        unwrap = read_snaphu_output('unwrap.out', phase)
+        conncomp = read_snaphu_output('conncomp.out', phase, None)
+    if interp==1:
+        phase_tmp.close()
     
-    run('gmt xyz2grd unwrap.out -ZTLf -r '+par1+' '+par2+' -Gtmp.grd')
+    unwrap = unwrap.copy(data=unwrap.values*mask2)
     print(' ')
     print('SNAPHU: generate connected component ... ...')
-    run('gmt xyz2grd conncomp.out -ZTLu -r '+par1+' '+par2+' -Gconncomp.grd')
-    run('gmt grdmath tmp.grd mask2_patch.grd MUL = tmp.grd')
+    write_grd('conncomp.grd', conncomp)
     
     print(' ')
     print('SNAPHU: detrend the unwrapped if DEFOMAX = 0 for interseismic ... ...')
-    file_shuttle('tmp.grd','unwrap.grd', 'mv')
     
     print(' ')
     print('SNAPHU: landmask ... ...')
-    if check_file_report('landmask_ra.grd')==True:
-        run('gmt grdmath unwrap.grd landmask_ra_patch.grd MUL = tmp.grd '+V)
-        file_shuttle('tmp.grd','unwrap.grd', 'mv')
+    if landmask is not None:
+        unwrap = unwrap.copy(data=unwrap.values*landmask.values)
     
     print(' ')
     print('SNAPHU: user defined mask ... ...')
-    if check_file_report('mask_def.grd')==True:
-        run('gmt grdmath unwrap.grd mask_def_patch.grd MUL = tmp.grd '+V)
-        file_shuttle('tmp.grd','unwrap.grd', 'mv')
+    if mask_def is not None:
+        unwrap = unwrap.copy(data=unwrap.values*mask_def.values)
+    write_grd('unwrap.grd', unwrap)
     
     print(' ')
     print('SNAPHU: plot the unwrapped phase ... ...')
     
-    run('gmt grdgradient unwrap.grd -Nt.9 -A0. -Gunwrap_grad.grd')
-    tmp = catch_output_cmd(["gmt","grdinfo","-C","-L2","unwrap.grd"],True,-999,-100000)
-    print('SNAPHU: output from cmd gmt grdinfo -C -L2 unwrap.grd is', tmp, 'which should be a list')
-    limitU = float(tmp[11])+float(tmp[12])*2.
+    mean, stdev, rms = grd_stats(unwrap)
+    print('SNAPHU: mean and stdev of unwrap.grd are', mean, stdev)
+    limitU = mean+stdev*2.
     limitU = round(limitU,1)
-    limitL = float(tmp[11])-float(tmp[12])*2.
+    limitL = mean-stdev*2.
     limitL = round(limitL,1)
-    std    = round(float(tmp[12]),1)
-    run('gmt makecpt -Cseis -I -Z -T'+'''"'''+str(limitL)+'''"/"'''+str(limitU)+'''"/1 -D > unwrap.cpt''')
+    std    = round(stdev,1)
+    run_parallel(['gmt grdgradient unwrap.grd -Nt.9 -A0. -Gunwrap_grad.grd',
+                  'gmt makecpt -Cseis -I -Z -T'+'''"'''+str(limitL)+'''"/"'''+str(limitU)+'''"/1 -D > unwrap.cpt'''])
     
     if interp==1:
-        tmp1 = catch_output_cmd(["gmt","grdinfo","unwrap.grd","-C"],True,-999,-100000)
-        print('SNAPHU: output from cmd gmt grdinfo unwrap.grd -C is', tmp1, 'which should be a list')
-        boundR = (float(tmp1[2])-float(tmp1[1]))/4
-        boundA = (float(tmp1[4])-float(tmp1[3]))/4
+        boundR = (e-w)/4
+        boundA = (nn-s)/4
         
     run('gmt grdimage unwrap.grd -Iunwrap_grad.grd -Cunwrap.cpt -JX6.5i -Bxaf+lRange -Byaf+lAzimuth -BWSen -X1.3i -Y3i -P -K > unwrap.ps')
     run('''gmt psscale -Runwrap.grd -J -DJTC+w5/0.2+h+e -Cunwrap.cpt -Bxaf+l"Unwrapped phase" -By+lrad -O >> unwrap.ps''')
@@ -181,17 +353,11 @@ def snaphu():
     print(' ')
     print('SNAPHU: clean up ... ...')
     
-    run('rm -f tmp.grd corr_tmp.grd unwrap.out tmp2.grd unwrap_grad.grd conncomp.out')
-    run('rm -f phase.in corr.in') 
+    for fn in ['tmp.grd', 'phase_tmp.grd', 'unwrap.out', 'unwrap_grad.grd', 'conncomp.out', 'phase.in', 'corr.in']:
+        delete(fn)
     
     if interp==1:
-        run('rm -f phase_tmp.grd')
-        file_shuttle('phase_patch.grd','phasefilt_interp.grd','mv')
-        
-    if n==5:
-        file_shuttle('corr_patch.grd', 'corr_cut.grd', 'mv')
-    run('rm -f mask_patch.grd mask3.grd mask3.out')
-    run('rm -f corr_cut.grd corr_patch.grd')
+        write_grd('phasefilt_interp.grd', phase)
     
     print("SNAPHU - END ... ...")
 
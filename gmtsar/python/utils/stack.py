@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+"""
+# stack.py is part of pyGMTSAR.
+# It replaces stack.csh, stack_corr.csh and stack_phase.bash.
+
+# Purpose: to compute stack statistics of a list of grids in one pass.
+# The grids are read band by band of rows, so memory does not grow with the
+# number of grids, and the bands can be spread over a pool of processes.
+#   stack mode:  mean and standard deviation (Welford's online update)
+#   -corr mode:  mean correlation from the sum of (1-c^2)/c^2
+#   -phase mode: mean LOS velocity and its standard deviation
+# Syntax: stack.py grid.list scale mean.grd std.grd [-nproc N] [-block rows]
+#         stack.py -corr corr.list corr_mean.grd [-nproc N] [-block rows]
+#         stack.py -phase phase.list mean.grd std.grd [-nproc N] [-block rows]
+
+# read_band
+# welford_band
+# corr_band
+# phase_band
+# stack_bands
+# stack_mean_std
+# stack_corr
+# stack_phase
+# plot_stack
+"""
+
+import sys, os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from gmtsar_lib import *
+from grid_lib import open_grd, read_grd, write_grd
+
+def read_band(fn, r0, r1):
+    # read_band reads rows r0:r1 of grid fn as float64.
+    da = open_grd(fn)
+    z = np.asarray(da[r0:r1, :].values, dtype=np.float64)
+    da.close()
+    return z
+
+def welford_band(files, r0, r1, factors=None):
+    # welford_band returns the mean and the sum of squared deviations (M2) of
+    # rows r0:r1 over the grids in files, each multiplied by factors[k] if given.
+    mean = None
+    for k, fn in enumerate(files):
+        z = read_band(fn, r0, r1)
+        if factors is not None:
+            z *= factors[k]
+        if mean is None:
+            mean = z
+            m2 = np.zeros_like(z)
+        else:
+            delta = z-mean
+            mean += delta/(k+1)
+            m2 += delta*(z-mean)
+    return mean, m2
+
+def corr_band(files, r0, r1):
+    # corr_band returns the sum of (1-c^2)/c^2 of rows r0:r1 over the correlation grids.
+    total = None
+    for fn in files:
+        c2 = read_band(fn, r0, r1)**2
+        term = (1.-c2)/c2
+        total = term if total is None else total+term
+    return total
+
+def phase_band(files, r0, r1, factors):
+    # phase_band returns the sum of the unwrapped phase and the Welford mean
+    # and M2 of the per-interferogram velocities phase*factors[k].
+    total = None
+    mean = None
+    for k, fn in enumerate(files):
+        z = read_band(fn, r0, r1)
+        total = z.copy() if total is None else total+z
+        v = z*factors[k]
+        if mean is None:
+            mean = v
+            m2 = np.zeros_like(v)
+        else:
+            delta = v-mean
+            mean += delta/(k+1)
+            m2 += delta*(v-mean)
+    return total, mean, m2
+
+def stack_bands(func, files, args=(), nproc=1, block_rows=512):
+    # stack_bands runs func(files, r0, r1, *args) for bands of block_rows rows
+    # and stacks the band results back into full grids. The first grid is
+    # returned too, as the template for the output grids.
+    like = read_grd(files[0])
+    ny, nx = like.shape
+    for fn in files[1:]:
+        da = open_grd(fn)
+        if da.shape != (ny, nx):
+            sys.exit('STACK: '+fn+' is not on the grid of '+files[0])
+        da.close()
+    bands = [(r0, min(r0+block_rows, ny)) for r0 in range(0, ny, block_rows)]
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            jobs = [pool.submit(func, files, r0, r1, *args) for r0, r1 in bands]
+            parts = [job.result() for job in jobs]
+    else:
+        parts = [func(files, r0, r1, *args) for r0, r1 in bands]
+    if isinstance(parts[0], tuple):
+        out = tuple(np.concatenate([p[k] for p in parts], axis=0) for k in range(len(parts[0])))
+    else:
+        out = np.concatenate(parts, axis=0)
+    return out, like
+
+def stack_mean_std(files, scale=1., nproc=1, block_rows=512):
+    # stack_mean_std returns the mean and standard deviation (divided by N,
+    # as stack.csh) of the grids, multiplied by scale.
+    (mean, m2), like = stack_bands(welford_band, files, (), nproc, block_rows)
+    std = np.sqrt(m2/len(files))
+    return like.copy(data=mean*scale), like.copy(data=std*scale)
+
+def stack_corr(files, nproc=1, block_rows=512):
+    # stack_corr returns the mean correlation sqrt(1/(1+sum((1-c^2)/c^2)/N)),
+    # as stack_corr.csh.
+    total, like = stack_bands(corr_band, files, (), nproc, block_rows)
+    return like.copy(data=np.sqrt(1./(total/len(files)+1.)))
+
+def _days(prm_ref, prm_rep):
+    # number of days between the SC_clock_start (yyyyddd.ddd) of two PRM files,
+    # counted like stack_phase.bash.
+    t_ref = str(get_prm(prm_ref, 'SC_clock_start'))
+    t_rep = str(get_prm(prm_rep, 'SC_clock_start'))
+    return (int(t_rep[0:4])-int(t_ref[0:4]))*365+int(t_rep[4:7])-int(t_ref[4:7])
+
+def stack_phase(rows, nproc=1, block_rows=512):
+    # stack_phase returns the mean LOS velocity (mm/yr) of the unwrapped phase
+    # grids in rows [(grd, ref.PRM, rep.PRM), ...] and its standard deviation,
+    # as stack_phase.bash.
+    files = [r[0] for r in rows]
+    days = [_days(r[1], r[2]) for r in rows]
+    if min(days) < 0:
+        sys.exit('STACK: the reference image must be acquired before the repeat image')
+    wavel = get_prm(rows[0][1], 'radar_wavelength')
+    factors = [365.*wavel*-79.58/d for d in days]
+    (total, mean, m2), like = stack_bands(phase_band, files, (factors,), nproc, block_rows)
+    vmean = total/sum(days)*365.*wavel*-79.58
+    # sum of (v_k - vmean)^2 from the Welford mean and M2 of the v_k
+    std = np.sqrt((m2+len(files)*(mean-vmean)**2)/len(files))
+    return like.copy(data=vmean), like.copy(data=std)
+
+def plot_stack(fn, label):
+    # plot_stack makes the pdf map stack.csh makes of its outputs.
+    name = os.path.splitext(fn)[0]
+    z = read_grd(fn).values
+    limitU = round(float(np.nanmax(z)), 1)
+    limitL = round(float(np.nanmin(z)), 1)
+    run('gmt grdgradient '+fn+' -Nt.9 -A0. -G'+name+'.grad.grd')
+    run('gmt makecpt -Cseis -I -Z -T"'+str(limitL)+'"/"'+str(limitU)+'"/0.1 -D > '+name+'.cpt')
+    run('gmt grdimage '+fn+' -I'+name+'.grad.grd -C'+name+'.cpt -JX6.5i -Bxaf+lRange -Byaf+lAzimuth -BWSen -X1.3i -Y3i -P -K > '+name+'.ps')
+    run('gmt psscale -R'+fn+' -J -DJTC+w5/0.2+h+e -C'+name+'.cpt -Bxaf+l"'+label+'" -By -O >> '+name+'.ps')
+    run('gmt psconvert -Tf -P -A -Z '+name+'.ps')
+    delete(name+'.cpt')
+    delete(name+'.grad.grd')
+
+def _main_func(description):
+    arg = sys.argv
+    nproc = assign_arg(arg, '-nproc')
+    block_rows = assign_arg(arg, '-block')
+    nproc = nproc if nproc > 0 else 1
+    block_rows = block_rows if block_rows > 0 else 512
+    pos = [a for k, a in enumerate(arg[1:], 1)
+           if not a.startswith('-') and arg[k-1] not in ['-nproc', '-block']]
+
+    def Error_Message():
+        print(description)
+        print("Usage: stack.py grid.list scale mean.grd std.grd [-nproc N] [-block rows]")
+        print("       stack.py -corr corr.list corr_mean.grd [-nproc N] [-block rows]")
+        print("       stack.py -phase phase.list mean.grd std.grd [-nproc N] [-block rows]")
+        print(" ")
+        print("  grid.list  -- a list of grd file names; phase.list has 'grd ref.PRM rep.PRM' per line")
+        print("  scale      -- a scale factor put 1 if not scale")
+        print("  -nproc N   -- spread bands of rows over N processes")
+        print("  -block n   -- number of rows read from each grid at a time (default 512)")
+        print(" ")
+        print("  note that the grid of the grd files must be consistent")
+        sys.exit(1)
+
+    if len(pos) < 2 or not os.path.isfile(pos[0]):
+        Error_Message()
+    with open(pos[0], 'r') as f:
+        lines = [line.split() for line in f if line.strip() != '']
+
+    print('STACK: stacking ', len(lines), ' grids from ', pos[0], ' on ', nproc, ' processes')
+    if '-corr' in arg:
+        out = stack_corr([l[0] for l in lines], nproc, block_rows)
+        write_grd(pos[1], out)
+    elif '-phase' in arg:
+        if len(pos) < 3:
+            Error_Message()
+        mean, std = stack_phase(lines, nproc, block_rows)
+        write_grd(pos[1], mean)
+        write_grd(pos[2], std)
+    else:
+        if len(pos) < 4:
+            Error_Message()
+        mean, std = stack_mean_std([l[0] for l in lines], float(pos[1]), nproc, block_rows)
+        write_grd(pos[2], mean)
+        write_grd(pos[3], std)
+        plot_stack(pos[2], 'Mean of Image Stack')
+        plot_stack(pos[3], 'Std. Dev. of Image Stack')
+    print('STACK - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)
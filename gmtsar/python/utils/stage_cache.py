@@ -0,0 +1,210 @@
+#! /usr/bin/env python3
+"""
+# stage_cache.py is part of pyGMTSAR.
+# It hosts a content-addressed cache for the stages of p2p_processing.
+
+# Each stage gets a key hashed from its configuration values, the checksums
+# of its input files, the versions of the GMT/GMTSAR tools and the key of the
+# stage before it. A stage whose outputs already exist for that key is skipped,
+# or its outputs are restored from the cache; otherwise it runs and its outputs
+# are copied into the cache. The cache is capped in size and the least
+# recently used entries are evicted first.
+
+# open_stage_cache
+# file_checksum
+# tool_versions
+# stage_key
+# restore_stage
+# list_files
+# store_stage
+# evict_stages
+# run_stage
+# skip_cached_stage
+"""
+
+import os, json, time, shutil
+import hashlib, subprocess
+
+CACHE_DIR = '.p2p_cache'
+TOOLS = ['gmt', 'snaphu', 'sarp.csh', 'SAT_baseline', 'xcorr', 'phasediff', 'conv', 'phasefilt', 'nearest_grid']
+
+def open_stage_cache(max_gb=50., root='.'):
+    # open_stage_cache loads (or creates) the cache index under root/.p2p_cache.
+    # Returns the cache state dict passed to the other functions.
+    root = os.path.abspath(root)
+    path = os.path.join(root, CACHE_DIR)
+    os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+    index = {'checksums': {}, 'entries': {}, 'stages': {}}
+    fn = os.path.join(path, 'index.json')
+    if os.path.isfile(fn):
+        with open(fn, 'r') as f:
+            index.update(json.load(f))
+    cache = {'root': root, 'path': path, 'max_bytes': int(float(max_gb)*1e9),
+             'index': index, 'tools': tool_versions(), 'parent': ''}
+    print('STAGE CACHE: using ', path, ' capped at ', max_gb, ' GB')
+    return cache
+
+def _save_index(cache):
+    # write the index atomically so an interrupted run never leaves it half written.
+    fn = os.path.join(cache['path'], 'index.json')
+    with open(fn+'.tmp', 'w') as f:
+        json.dump(cache['index'], f, indent=1)
+    os.replace(fn+'.tmp', fn)
+
+def file_checksum(cache, fn):
+    # file_checksum returns the sha256 of file fn; it is only recomputed when
+    # the size or modification time of fn has changed since the last run.
+    fn = os.path.abspath(fn)
+    st = os.stat(fn)
+    known = cache['index']['checksums'].get(fn)
+    if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+        return known[2]
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(8*1024*1024), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    cache['index']['checksums'][fn] = [st.st_size, st.st_mtime_ns, digest]
+    return digest
+
+def tool_versions():
+    # tool_versions fingerprints the GMT version and the GMTSAR programs on the PATH.
+    versions = {}
+    try:
+        versions['gmt --version'] = subprocess.run(['gmt', '--version'], stdout=subprocess.PIPE,
+                                                   stderr=subprocess.DEVNULL).stdout.decode('utf-8').strip()
+    except OSError:
+        versions['gmt --version'] = ''
+    for tool in TOOLS:
+        exe = shutil.which(tool)
+        if exe is not None:
+            st = os.stat(exe)
+            versions[tool] = [exe, st.st_size, st.st_mtime_ns]
+    return versions
+
+def stage_key(cache, stage, params, inputs=()):
+    # stage_key hashes the stage number, its configuration values params (dict),
+    # the checksums of the input files, the tool versions and the parent stage key.
+    checksums = {}
+    for fn in sorted(set(inputs)):
+        if os.path.isfile(fn):
+            checksums[fn] = file_checksum(cache, fn)
+    record = {'stage': stage, 'params': params, 'inputs': checksums,
+              'tools': cache['tools'], 'parent': cache['parent']}
+    return hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _outputs_in_place(cache, entry):
+    for rel, (size, mtime_ns) in entry['outputs'].items():
+        fn = os.path.join(cache['root'], rel)
+        if not os.path.lexists(fn):
+            return False
+        st = os.lstat(fn)
+        if st.st_size != size or st.st_mtime_ns != mtime_ns:
+            return False
+    return True
+
+def restore_stage(cache, stage, key):
+    # restore_stage returns True if the outputs of stage for key are in place,
+    # copying them back from the cache if they were removed or overwritten.
+    entry = cache['index']['entries'].get(key)
+    if entry is None:
+        return False
+    if not _outputs_in_place(cache, entry):
+        objects = os.path.join(cache['path'], 'objects', key)
+        if not os.path.isdir(objects):
+            return False
+        print('STAGE CACHE: restoring outputs of stage ', stage, ' from ', key[:12])
+        for rel, (size, mtime_ns) in entry['outputs'].items():
+            fn = os.path.join(cache['root'], rel)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            if os.path.lexists(fn):
+                os.remove(fn)
+            shutil.copy2(os.path.join(objects, rel), fn, follow_symlinks=False)
+            st = os.lstat(fn)
+            entry['outputs'][rel] = [st.st_size, st.st_mtime_ns]
+    entry['last_used'] = time.time()
+    cache['index']['stages'][str(stage)] = key
+    cache['parent'] = key
+    _save_index(cache)
+    return True
+
+def list_files(cache, dirs):
+    # list_files returns {path relative to the cache root: (size, mtime, ctime,
+    # inode)} of the files and links under dirs; any write, move or copy into
+    # place changes at least the ctime or the inode of a path.
+    listing = {}
+    for d in dirs:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(cache['root'], d)):
+            for name in filenames:
+                fn = os.path.join(dirpath, name)
+                st = os.lstat(fn)
+                listing[os.path.relpath(fn, cache['root'])] = (st.st_size, st.st_mtime_ns,
+                                                               st.st_ctime_ns, st.st_ino)
+    return listing
+
+def store_stage(cache, stage, key, dirs, before):
+    # store_stage copies every file under dirs that is new or changed since
+    # the listing before (from list_files) into the cache as the outputs of
+    # stage for key.
+    objects = os.path.join(cache['path'], 'objects', key)
+    if os.path.isdir(objects):
+        shutil.rmtree(objects)
+    outputs = {}
+    size = 0
+    for rel, st in sorted(list_files(cache, dirs).items()):
+        if before.get(rel) == st:
+            continue
+        os.makedirs(os.path.dirname(os.path.join(objects, rel)), exist_ok=True)
+        shutil.copy2(os.path.join(cache['root'], rel), os.path.join(objects, rel), follow_symlinks=False)
+        outputs[rel] = [st[0], st[1]]
+        size += st[0]
+    cache['index']['entries'][key] = {'stage': stage, 'outputs': outputs, 'size': size,
+                                      'last_used': time.time()}
+    cache['index']['stages'][str(stage)] = key
+    cache['parent'] = key
+    print('STAGE CACHE: stored ', len(outputs), ' outputs of stage ', stage, ' as ', key[:12])
+    evict_stages(cache)
+    _save_index(cache)
+
+def evict_stages(cache, keep=()):
+    # evict_stages removes the least recently used entries until the cache
+    # fits in max_bytes; the latest entry of each stage is never evicted.
+    entries = cache['index']['entries']
+    latest = set(cache['index']['stages'].values()) | set(keep)
+    total = sum(e['size'] for e in entries.values())
+    for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+        if total <= cache['max_bytes']:
+            break
+        if key in latest:
+            continue
+        print('STAGE CACHE: evicting stage ', entries[key]['stage'], ' entry ', key[:12])
+        shutil.rmtree(os.path.join(cache['path'], 'objects', key), ignore_errors=True)
+        total -= entries[key]['size']
+        del entries[key]
+
+def run_stage(cache, stage, params, inputs, dirs, func, *args):
+    # run_stage runs func(*args) for stage unless the cache already holds its
+    # outputs for the same key. Without a cache (cache=None) it just runs func.
+    if cache is None:
+        func(*args)
+        return
+    # the stages change directory, so the cwd is restored even if one fails
+    cwd = os.getcwd()
+    try:
+        os.chdir(cache['root'])
+        key = stage_key(cache, stage, params, inputs)
+        if restore_stage(cache, stage, key):
+            print('STAGE CACHE: stage ', stage, ' is up to date, skipping it')
+            return
+        before = list_files(cache, dirs)
+        func(*args)
+        os.chdir(cache['root'])
+        store_stage(cache, stage, key, dirs, before)
+    finally:
+        os.chdir(cwd)
+
+def skip_cached_stage(cache, stage):
+    # skip_cached_stage chains the next stage on the last known key of a stage
+    # the user skipped with skip_i.
+    if cache is not None:
+        cache['parent'] = cache['index']['stages'].get(str(stage), cache['parent'])
@@ -0,0 +1,412 @@
+#! /usr/bin/env python3
+"""
+# tide.py is part of pyGMTSAR.
+# It replaces tide_correction.csh.
+
+# Purpose: to compute the solid earth tide correction (phase) of a pair in
+# radar coordinates. The tide of the C solid_tide is evaluated on all the
+# nodes of the 0.02/0.02 degree grid of the DEM at once, and the E/N/U tide
+# of an acquisition time is cached in tide_enu_<key>.npz, so every pair
+# sharing a date reuses it. The look vectors and range/azimuth of the nodes
+# only depend on the geometry (PRM, LED and DEM) and are cached likewise in
+# tide_look_<key>.npz. The LOS difference is put on the 200/50 radar grid in
+# memory and written to tide.grd.
+# Syntax: tide.py PRM1 PRM2 dem.grd [tide.grd]
+#         tide.py -batch dem.grd pairs.list
+
+# solid_tide
+# tide_nodes
+# epoch_tide
+# node_geometry
+# radar_grid
+# tide_correction
+"""
+
+import sys, os, hashlib
+import subprocess
+import numpy as np
+import xarray as xr
+from gmtsar_lib import *
+from grid_lib import open_grd, write_grd, grd_info
+
+RAD = 180./np.pi
+A_WGS84 = 6378137.0
+E2_WGS84 = 6.69438002290341574957e-3
+
+# step 2 corrections of the love numbers, IERS conventions 2003 tables 7.5a
+# (diurnal) and 7.5b (long period) as in solid_tide.c, in mm
+# columns are s, h, p, N', ps, dR(ip), dR(op), dT(ip), dT(op) (7.5a)
+STEP2DIU = np.array([
+    [-3.,  0.,  2.,  0.,  0., -0.01, -0.01,  0.00,  0.00],
+    [-3.,  2.,  0.,  0.,  0., -0.01, -0.01,  0.00,  0.00],
+    [-2.,  0.,  1., -1.,  0., -0.02, -0.01,  0.00,  0.00],
+    [-2.,  0.,  1.,  0.,  0., -0.08,  0.00,  0.01,  0.01],
+    [-2.,  2., -1.,  0.,  0., -0.02, -0.01,  0.00,  0.00],
+    [-1.,  0.,  0., -1.,  0., -0.10,  0.00,  0.00,  0.00],
+    [-1.,  0.,  0.,  0.,  0., -0.51,  0.00, -0.02,  0.03],
+    [-1.,  2.,  0.,  0.,  0.,  0.01,  0.00,  0.00,  0.00],
+    [ 0., -2.,  1.,  0.,  0.,  0.01,  0.00,  0.00,  0.00],
+    [ 0.,  0., -1.,  0.,  0.,  0.02,  0.01,  0.00,  0.00],
+    [ 0.,  0.,  1.,  0.,  0.,  0.06,  0.00,  0.00,  0.00],
+    [ 0.,  0.,  1.,  1.,  0.,  0.01,  0.00,  0.00,  0.00],
+    [ 0.,  2., -1.,  0.,  0.,  0.01,  0.00,  0.00,  0.00],
+    [ 1., -3.,  0.,  0.,  1., -0.06,  0.00,  0.00,  0.00],
+    [ 1., -2.,  0.,  1.,  0.,  0.01,  0.00,  0.00,  0.00],
+    [ 1., -2.,  0.,  0.,  0., -1.23, -0.07,  0.06,  0.01],
+    [ 1., -1.,  0.,  0., -1.,  0.02,  0.00,  0.00,  0.00],
+    [ 1., -1.,  0.,  0.,  1.,  0.04,  0.00,  0.00,  0.00],
+    [ 1.,  0.,  0., -1.,  0., -0.22,  0.01,  0.01,  0.00],
+    [ 1.,  0.,  0.,  0.,  0., 12.00, -0.78, -0.67, -0.03],
+    [ 1.,  0.,  0.,  1.,  0.,  1.73, -0.12, -0.10,  0.00],
+    [ 1.,  0.,  0.,  2.,  0., -0.04,  0.00,  0.00,  0.00],
+    [ 1.,  1.,  0.,  0., -1., -0.50, -0.01,  0.03,  0.00],
+    [ 1.,  1.,  0.,  0.,  1.,  0.01,  0.00,  0.00,  0.00],
+    [ 1.,  1.,  0.,  1., -1., -0.01,  0.00,  0.00,  0.00],
+    [ 1.,  2., -2.,  0.,  0., -0.01,  0.00,  0.00,  0.00],
+    [ 1.,  2.,  0.,  0.,  0., -0.11,  0.01,  0.01,  0.00],
+    [ 2., -2.,  1.,  0.,  0., -0.01,  0.00,  0.00,  0.00],
+    [ 2.,  0., -1.,  0.,  0., -0.02,  0.02,  0.00,  0.01],
+    [ 3.,  0.,  0.,  0.,  0.,  0.00,  0.01,  0.00,  0.01],
+    [ 3.,  0.,  0.,  1.,  0.,  0.00,  0.01,  0.00,  0.00]])
+# columns are s, h, p, N', ps, dR(ip), dT(ip), dR(op), dT(op) (7.5b)
+STEP2LON = np.array([
+    [0., 0.,  0., 1., 0.,  0.47,  0.23,  0.16,  0.07],
+    [0., 2.,  0., 0., 0., -0.20, -0.12, -0.11, -0.05],
+    [1., 0., -1., 0., 0., -0.11, -0.08, -0.09, -0.04],
+    [2., 0.,  0., 0., 0., -0.13, -0.11, -0.15, -0.07],
+    [2., 0.,  0., 1., 0., -0.05, -0.05, -0.06, -0.03]])
+# TAI-UTC since 1980 (mjd, seconds), newest first
+TAI_UTC = [(57754, 37.), (57204, 36.), (56109, 35.), (54832, 34.), (53736, 33.), (51179, 32.),
+           (50630, 31.), (50083, 30.), (49534, 29.), (49169, 28.), (48804, 27.), (48257, 26.),
+           (47892, 25.), (47161, 24.), (46247, 23.), (45516, 22.), (45151, 21.), (44786, 20.),
+           (44239, 19.)]
+
+def _epoch(tt):
+    # convert yyyyddd.fff (SC_clock_start) to mjd and fraction of day, as
+    # day2date and civmjd of solid_tide.c: the date is day ceil(ddd.fff) of
+    # the year, counted from the mjd of January 1 so that it rolls over.
+    yr = np.floor(tt/1000.)
+    day = tt-yr*1000.
+    if yr < 1900:
+        sys.exit('TIDE: year should not be smaller than 1900 in '+str(tt))
+    mjd = np.floor(365.25*(yr-1.))+np.floor(30.6001*14.)+1.-679019.+np.ceil(day)-1.
+    frac = (day-np.floor(day))*86400.
+    ihr = np.floor(frac/3600.)
+    imn = np.floor((frac-ihr*3600.)/60.)
+    sec = frac-ihr*3600.-imn*60.
+    fmjd = (3600.*ihr+60.*imn+sec)/86400.
+    return mjd, fmjd
+
+def _gpsleap(mjd):
+    # GPS leap seconds (TAI-UTC minus 19 s) at mjd
+    for start, tai_utc in TAI_UTC:
+        if mjd >= start:
+            return tai_utc-19.
+    sys.exit('TIDE: date before the GPS epoch')
+
+def _ghar(mjd, fmjd):
+    # Greenwich hour angle (radians) of mjd/fmjd in GPS time
+    fmjdutc = (fmjd*86400.-_gpsleap(mjd))/86400.
+    d = (np.round(mjd)-51544.)+(fmjdutc-0.5)
+    ghad = 280.460618375040+360.98564736628620*d
+    return np.mod((ghad-np.floor(ghad/360.)*360.)/RAD, 2*np.pi)
+
+def _rot1(theta, v):
+    s, c = np.sin(theta), np.cos(theta)
+    return np.array([v[0], c*v[1]+s*v[2], c*v[2]-s*v[1]])
+
+def _rot3(theta, v):
+    s, c = np.sin(theta), np.cos(theta)
+    return np.array([c*v[0]+s*v[1], c*v[1]-s*v[0], v[2]])
+
+def _centuries_tt(mjd, fmjd):
+    # julian centuries since J2000 in TT (GPS + 51.184 s)
+    return (np.round(mjd)+(fmjd*86400.+51.184)/86400.+2400000.5-2451545.0)/36525.
+
+def _sun(mjd, fmjd):
+    # low precision ECEF position of the sun (m), Montenbruck & Gill 3.3.2
+    t = _centuries_tt(mjd, fmjd)
+    obe = 23.43929111/RAD
+    emdeg = 357.5256+35999.049*t
+    em = emdeg/RAD
+    r = (149.619-2.499*np.cos(em)-0.021*np.cos(2*em))*1.0e9
+    slon = (282.9400+emdeg+(6892.0*np.sin(em)+72.0*np.sin(2*em))/3600.+1.39720*t)/RAD
+    rs = np.array([r*np.cos(slon), r*np.sin(slon)*np.cos(obe), r*np.sin(slon)*np.sin(obe)])
+    return _rot3(_ghar(mjd, fmjd), rs)
+
+def _moon(mjd, fmjd):
+    # low precision ECEF position of the moon (m), Montenbruck & Gill 3.3.2
+    t = _centuries_tt(mjd, fmjd)
+    el0 = 218.316170+(481267.880880-1.3972)*t
+    el = 134.962920+477198.867530*t
+    elp = 357.525430+35999.049440*t
+    f = 93.272830+483202.018730*t
+    d = 297.850270+445267.111350*t
+    s = lambda deg: np.sin(deg/RAD)
+    c = lambda deg: np.cos(deg/RAD)
+    selond = (el0+(22640.*s(el)+769.*s(2*el)-4586.*s(el-2*d)+2370.*s(2*d)-668.*s(elp)-412.*s(2*f)
+                   -212.*s(2*el-2*d)-206.*s(el+elp-2*d)+192.*s(el+2*d)-165.*s(elp-2*d)+148.*s(el-elp)
+                   -125.*s(d)-110.*s(el+elp)-55.*s(2*f-2*d))/3600.)
+    q = (412.*s(2*f)+541.*s(elp))/3600.
+    selatd = (18520.*s(f+selond-el0+q)-526.*s(f-2*d)+44.*s(el+f-2*d)-31.*s(-el+f-2*d)
+              -25.*s(-2*el+f)-23.*s(elp+f-2*d)+21.*s(-el+f)+11.*s(-elp+f-2*d))/3600.
+    rse = (385000.-20905.*c(el)-3699.*c(2*d-el)-2956.*c(2*d)-570.*c(2*el)+246.*c(2*el-2*d)
+           -205.*c(elp-2*d)-171.*c(el+2*d)-152.*c(el+elp-2*d))*1000.
+    selond = selond+1.39720*t
+    rm = np.array([rse*c(selond)*c(selatd), rse*s(selond)*c(selatd), rse*s(selatd)])
+    rm = _rot1(-23.439291110/RAD, rm)
+    return _rot3(_ghar(mjd, fmjd), rm)
+
+def _to_xyz(dr, dn, de, sinphi, cosphi, sinla, cosla):
+    # local radial/north/east corrections to ECEF
+    return np.array([dr*cosla*cosphi-de*sinla-dn*sinphi*cosla,
+                     dr*sinla*cosphi+de*cosla-dn*sinphi*sinla,
+                     dr*sinphi+dn*cosphi])
+
+def _fundamental(t):
+    # s, h, p, N', ps (degrees) and the s of tau, at t centuries (TT)
+    s = 218.31664563+481267.88194*t-0.0014663889*t**2+0.00000185139*t**3
+    pr = 1.396971278*t+0.000308889*t**2+0.000000021*t**3+0.000000007*t**4
+    h = 280.46645+36000.7697489*t+0.00030322222*t**2+0.000000020*t**3-0.00000000654*t**4
+    p = 83.35324312+4069.01363525*t-0.01032172222*t**2-0.0000124991*t**3+0.00000005263*t**4
+    zns = 234.95544499+1934.13626197*t-0.00207561111*t**2-0.00000213944*t**3+0.00000001650*t**4
+    ps = 282.93734098+1.71945766667*t+0.00045688889*t**2-0.00000001778*t**3-0.00000000334*t**4
+    return np.fmod(np.array([s+pr, h, p, zns, ps]), 360.), s
+
+def solid_tide(lon, lat, tt):
+    # solid_tide returns the solid earth tide (E, N, U in m) at the points
+    # lon/lat (degrees, on the ellipsoid) at time tt (yyyyddd.fff, GPS), as
+    # the C solid_tide (Milbert's solid, IERS conventions 2003) for all the
+    # points at once: the sun, the moon and the time terms are computed once.
+    mjd, fmjd = _epoch(float(tt))
+    xsun, xmon = _sun(mjd, fmjd), _moon(mjd, fmjd)
+    gla = np.asarray(lat, dtype=np.float64)/RAD
+    glo = np.asarray(lon, dtype=np.float64)/RAD
+    en = A_WGS84/np.sqrt(1.-E2_WGS84*np.sin(gla)**2)
+    xsta = np.array([en*np.cos(gla)*np.cos(glo), en*np.cos(gla)*np.sin(glo), en*(1.-E2_WGS84)*np.sin(gla)])
+
+    rsta = np.sqrt(np.sum(xsta**2, axis=0))
+    sinphi = xsta[2]/rsta
+    cosphi = np.hypot(xsta[0], xsta[1])/rsta
+    sinla = xsta[1]/cosphi/rsta
+    cosla = xsta[0]/cosphi/rsta
+    costwola = cosla**2-sinla**2
+    sintwola = 2.*cosla*sinla
+
+    # step 1: degree 2 and 3 tides with latitude dependent h2/l2
+    h3, l3 = 0.292, 0.015
+    h2 = 0.6078-0.0006*(1.-1.5*cosphi**2)
+    l2 = 0.0847+0.0002*(1.-1.5*cosphi**2)
+    re = 6378136.55
+    dxtide = np.zeros_like(xsta)
+    dr, dn, de = 0., 0., 0.
+    for xb, mass_ratio in [(xsun, 332945.943062), (xmon, 0.012300034)]:
+        rb = np.sqrt(np.sum(xb**2))
+        sc = (xb @ xsta)/rsta/rb
+        fac2 = mass_ratio*re*(re/rb)**3
+        fac3 = fac2*(re/rb)
+        p2 = 3.*(h2/2.-l2)*sc**2-h2/2.
+        p3 = 5./2.*(h3-3.*l3)*sc**3+3./2.*(l3-h3)*sc
+        x2 = 3.*l2*sc
+        x3 = 3.*l3/2.*(5.*sc**2-1.)
+        dxtide += fac2*(x2*xb[:, None]/rb+p2*xsta/rsta)+fac3*(x3*xb[:, None]/rb+p3*xsta/rsta)
+
+        # out-of-phase (st1idiu, st1isem) and l^(1) (st1l1) corrections
+        q = fac2/rb**2
+        diu_s = xb[2]*(xb[0]*sinla-xb[1]*cosla)*q
+        diu_c = xb[2]*(xb[0]*cosla+xb[1]*sinla)*q
+        sem_s = ((xb[0]**2-xb[1]**2)*sintwola-2.*xb[0]*xb[1]*costwola)*q
+        sem_c = ((xb[0]**2-xb[1]**2)*costwola+2.*xb[0]*xb[1]*sintwola)*q
+        dr = dr-3.*(-0.0025)*sinphi*cosphi*diu_s-3./4.*(-0.0022)*cosphi**2*sem_s
+        dn = (dn-3.*(-0.0007)*(cosphi**2-sinphi**2)*diu_s+1.5*(-0.0007)*sinphi*cosphi*sem_s
+              -3.*0.0012*sinphi**2*diu_c-3.*0.0024/2.*sinphi*cosphi*sem_c)
+        de = (de-3.*(-0.0007)*sinphi*diu_c-3./2.*(-0.0007)*cosphi*sem_c
+              +3.*0.0012*sinphi*(cosphi**2-sinphi**2)*diu_s-3.*0.0024/2.*sinphi**2*cosphi*sem_s)
+    dxtide += _to_xyz(dr, dn, de, sinphi, cosphi, sinla, cosla)
+
+    # step 2: frequency dependence of the love numbers (mm)
+    dmjdtt = mjd+(fmjd*86400.+51.184)/86400.
+    t = (dmjdtt-51544.0)/36525.
+    fhr = (dmjdtt-np.floor(dmjdtt))*24.
+    args, s0 = _fundamental(t)
+    tau = np.fmod(fhr*15.0+280.46061840+36000.77005360*t+0.000387930*t**2-0.0000000258*t**3-s0, 360.)
+    theta = (tau+STEP2DIU[:, :5] @ args)/RAD
+    zla = np.arctan2(xsta[1], xsta[0])
+    # sum over the table of c*sin(theta+zla) and c*cos(theta+zla)
+    def harmonics(c_sin, c_cos):
+        a = np.sum(c_sin*np.cos(theta)-c_cos*np.sin(theta))
+        b = np.sum(c_sin*np.sin(theta)+c_cos*np.cos(theta))
+        return a*np.sin(zla)+b*np.cos(zla)
+    dr = 2.*sinphi*cosphi*harmonics(STEP2DIU[:, 5], STEP2DIU[:, 6])
+    dn = (cosphi**2-sinphi**2)*harmonics(STEP2DIU[:, 7], STEP2DIU[:, 8])
+    de = sinphi*harmonics(-STEP2DIU[:, 8], STEP2DIU[:, 7])
+    dxtide += _to_xyz(dr, dn, de, sinphi, cosphi, sinla, cosla)/1000.
+    theta = (STEP2LON[:, :5] @ args)/RAD
+    dr = (3.*sinphi**2-1.)/2.*np.sum(STEP2LON[:, 5]*np.cos(theta)+STEP2LON[:, 7]*np.sin(theta))
+    dn = 2.*cosphi*sinphi*np.sum(STEP2LON[:, 6]*np.cos(theta)+STEP2LON[:, 8]*np.sin(theta))
+    dxtide += _to_xyz(dr, dn, 0., sinphi, cosphi, sinla, cosla)/1000.
+
+    # ECEF to local east, north, up
+    sb, cb, sl, cl = np.sin(gla), np.cos(gla), np.sin(glo), np.cos(glo)
+    north = -sb*cl*dxtide[0]-sb*sl*dxtide[1]+cb*dxtide[2]
+    east = -sl*dxtide[0]+cl*dxtide[1]
+    up = cb*cl*dxtide[0]+cb*sl*dxtide[1]+sb*dxtide[2]
+    return east, north, up
+
+def tide_nodes(dem, inc=0.02):
+    # tide_nodes returns the lon/lat nodes of the DEM resampled at inc
+    # degrees (as gmt grdsample -I) and the DEM heights on them (bilinear).
+    info = grd_info(dem)
+    half = 0.5*inc if info.registration == 1 else 0.
+    nx = int(np.floor((info.e-info.w)/inc+1e-6))+(0 if info.registration == 1 else 1)
+    ny = int(np.floor((info.n-info.s)/inc+1e-6))+(0 if info.registration == 1 else 1)
+    x = info.w+half+inc*np.arange(nx)
+    y = info.s+half+inc*np.arange(ny)
+    da = open_grd(dem)
+    hgt = da.interp(x=np.clip(x, da['x'].values.min(), da['x'].values.max()),
+                    y=np.clip(y, da['y'].values.min(), da['y'].values.max()), method='linear').values
+    da.close()
+    lon, lat = np.meshgrid(x, y)
+    return lon.ravel(), lat.ravel(), hgt.ravel()
+
+def _key(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def _file_key(*fns):
+    text = ''
+    for fn in fns:
+        st = os.stat(fn)
+        text += '%s %d %d ' % (os.path.realpath(fn), st.st_size, st.st_mtime_ns)
+    return text
+
+def _save(fn, **arrays):
+    with open(fn+'.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(fn+'.tmp', fn)
+
+_epochs = {}
+_geometries = {}
+
+def epoch_tide(lon, lat, tt):
+    # epoch_tide returns the tide (E, N, U, npoint x 3) of the nodes lon/lat
+    # at tt, from memory or tide_enu_<key>.npz of the nodes and tt when a
+    # pair with the same date has computed it already.
+    key = _key('%.10f %d %.10f %.10f %.10f %.10f' % (tt, len(lon), lon[0], lat[0], lon[-1], lat[-1]))
+    if key not in _epochs:
+        fn = 'tide_enu_'+key+'.npz'
+        if os.path.isfile(fn):
+            with np.load(fn) as f:
+                _epochs[key] = f['enu']
+        else:
+            print('TIDE: computing the solid earth tide at ', tt, ' on ', len(lon), ' nodes')
+            _epochs[key] = np.column_stack(solid_tide(lon, lat, tt))
+            _save(fn, enu=_epochs[key])
+    return _epochs[key]
+
+def node_geometry(prm, dem, lon, lat, hgt):
+    # node_geometry returns the look vectors (npoint x 3) and range/azimuth
+    # of the nodes, NaN where the DEM is NaN, from memory or
+    # tide_look_<key>.npz of the PRM/LED/DEM, else by one SAT_look and one
+    # SAT_llt2rat call for all the nodes.
+    files = [prm, dem]
+    led = get_prm(prm, 'led_file') if 'led_file' in read_prm(prm) else ''
+    if led != '' and os.path.isfile(led):
+        files.append(led)
+    key = _key(_file_key(*files)+'%d %.10f %.10f' % (len(lon), lon[0], lat[0]))
+    if key not in _geometries:
+        fn = 'tide_look_'+key+'.npz'
+        if os.path.isfile(fn):
+            with np.load(fn) as f:
+                _geometries[key] = {k: f[k] for k in f.files}
+        else:
+            ok = np.isfinite(hgt)
+            print('TIDE: computing the look vectors and radar coordinates of ', int(ok.sum()), ' nodes')
+            text = ''.join('%.10f %.10f %.6f\n' % p for p in zip(lon[ok], lat[ok], hgt[ok]))
+            lltn = subprocess.run(['SAT_look', prm], input=text, stdout=subprocess.PIPE,
+                                  universal_newlines=True, check=True).stdout
+            rat = subprocess.run(['SAT_llt2rat', prm, '1'], input=text, stdout=subprocess.PIPE,
+                                 universal_newlines=True, check=True).stdout
+            look = np.array([[float(v) for v in l.split()[3:6]] for l in lltn.splitlines() if l.strip() != '']).reshape(-1, 3)
+            ra = np.array([[float(v) for v in l.split()[:2]] for l in rat.splitlines() if l.strip() != '']).reshape(-1, 2)
+            if not (len(look) == len(ra) == ok.sum()):
+                sys.exit('TIDE: SAT_look/SAT_llt2rat did not return one line per node')
+            geom = {'look': np.full((len(lon), 3), np.nan), 'rng': np.full(len(lon), np.nan),
+                    'azi': np.full(len(lon), np.nan)}
+            geom['look'][ok] = look
+            geom['rng'][ok] = ra[:, 0]
+            geom['azi'][ok] = ra[:, 1]
+            _save(fn, **geom)
+            _geometries[key] = geom
+    return _geometries[key]
+
+def radar_grid(rng, azi, z, num_rng, num_azi, inc=(200, 50)):
+    # radar_grid returns the pixel registered grid of 0/num_rng/0/num_azi at
+    # inc of the points rng/azi/z: the block median of every cell and a thin
+    # plate spline through the block medians elsewhere (gmt blockmedian and
+    # surface of tide_correction.csh).
+    from scipy.interpolate import RBFInterpolator
+    nx = max(int(round(num_rng/inc[0])), 1)
+    ny = max(int(round(num_azi/inc[1])), 1)
+    ok = np.isfinite(z) & np.isfinite(rng) & np.isfinite(azi)
+    ix = np.floor(np.where(ok, rng, -1.)/inc[0]).astype(np.int64)
+    iy = np.floor(np.where(ok, azi, -1.)/inc[1]).astype(np.int64)
+    keep = ok & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    if keep.sum() < 3:
+        sys.exit('TIDE: fewer than 3 nodes of the DEM fall in the radar frame')
+    cell = (iy*nx+ix)[keep]
+    uniq, start, count = np.unique(np.sort(cell), return_index=True, return_counts=True)
+    lo, hi = start+(count-1)//2, start+count//2
+    med = []
+    for v in [rng[keep], azi[keep], z[keep]]:
+        v = v[np.lexsort((v, cell))]
+        med.append(0.5*(v[lo]+v[hi]))
+    xc = inc[0]*(np.arange(nx)+0.5)
+    yc = inc[1]*(np.arange(ny)+0.5)
+    X, Y = np.meshgrid(xc, yc)
+    rbf = RBFInterpolator(np.column_stack(med[:2]), med[2], kernel='thin_plate_spline',
+                          neighbors=min(32, len(uniq)))
+    return xc, yc, rbf(np.column_stack([X.ravel(), Y.ravel()])).reshape(ny, nx)
+
+def tide_correction(prm1, prm2, dem, out='tide.grd', inc=0.02, rinc=(200, 50)):
+    # tide_correction writes the LOS phase (radians) of the difference of the
+    # solid earth tide at the SC_clock_start of prm2 and prm1 on the radar grid.
+    num_rng, num_azi, wave, tt1 = get_prm(prm1, 'num_rng_bins', 'num_lines', 'radar_wavelength', 'SC_clock_start')
+    tt2 = get_prm(prm2, 'SC_clock_start')
+    print('TIDE: computing tidal correction for dates ', tt1, ' ', tt2, ' ...')
+    lon, lat, hgt = tide_nodes(dem, inc)
+    geom = node_geometry(prm1, dem, lon, lat, hgt)
+    enu = epoch_tide(lon, lat, tt2)-epoch_tide(lon, lat, tt1)
+    los = np.einsum('ij,ij->i', enu, geom['look'])
+    phase = -los*4.*np.pi/wave
+    xc, yc, z = radar_grid(geom['rng'], geom['azi'], phase, num_rng, num_azi, rinc)
+    write_grd(out, xr.DataArray(z, dims=('y', 'x'), coords={'x': xc, 'y': yc}), registration=1)
+
+def _main_func(description):
+    arg = sys.argv
+    pos = [a for a in arg[1:] if not a.startswith('-')]
+
+    def Error_Message():
+        print(description)
+        print("Usage: tide.py PRM1 PRM2 dem.grd [tide.grd]")
+        print("       tide.py -batch dem.grd pairs.list")
+        print(" ")
+        print("  PRM1 PRM2   -- the PRM files of the two acquisitions, the geometry is that of PRM1")
+        print("  pairs.list  -- 'PRM1 PRM2 tide.grd' per line, the tide of every date is computed once")
+        print("  output: tide.grd, the tidal phase difference on the 200/50 radar grid")
+        print(" ")
+        print("Example: tide.py IMG-HH-ALPSRP055750660-H1.0__A.PRM IMG-HH-ALPSRP049040660-H1.0__A.PRM dem.grd")
+        sys.exit(1)
+
+    if '-batch' in arg and len(pos) >= 2 and os.path.isfile(pos[0]) and os.path.isfile(pos[1]):
+        with open(pos[1], 'r') as f:
+            pairs = [line.split() for line in f if len(line.split()) >= 3]
+        for prm1, prm2, out in pairs:
+            tide_correction(prm1, prm2, pos[0], out)
+    elif '-batch' not in arg and len(pos) >= 3 and all(os.path.isfile(fn) for fn in pos[:3]):
+        tide_correction(pos[0], pos[1], pos[2], pos[3] if len(pos) > 3 else 'tide.grd')
+    else:
+        Error_Message()
+    print('TIDE - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+"""
+# ts_cube.py is part of pyGMTSAR.
+# It replaces extract_one_time_series.csh.
+
+# Purpose: to gather the disp_#######.grd of an SBAS run into one NetCDF4
+# cube (time, y, x) and to extract time series of points from it.
+# The cube is chunked with all the scenes of a small spatial block in one
+# chunk, so the history of a pixel is one chunk read instead of one read of
+# every grid of the stack. Points are extracted together: the chunks under
+# all their boxes are read once each and the box mean and standard deviation
+# of every scene are computed at once.
+# Syntax: ts_cube.py -build scene.tab cube.nc [-chunk n]
+#         ts_cube.py -extract cube.nc points.txt time_series.dat [-box m_rng m_azi]
+#                    [-prm PRM -dem dem.grd]
+
+# build_cube
+# lonlat_to_ra
+# box_samples
+# read_samples
+# extract_points
+"""
+
+import sys, os
+import subprocess
+import numpy as np
+from gmtsar_lib import *
+from grid_lib import open_grd
+from stack import read_band
+
+def build_cube(scene_tab, cube, chunk=16, grid_fmt='disp_%07d.grd'):
+    # build_cube writes the displacement grids of the scenes of scene.tab
+    # (scene_id number_of_days) into the cube, chunk x chunk nodes of all
+    # scenes per chunk. The grids are read a band of chunk rows at a time.
+    import netCDF4
+    ids, days = [], []
+    with open(scene_tab, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            ids.append(int(fields[0]))
+            days.append(float(fields[1]))
+    files = [grid_fmt % scene for scene in ids]
+    like = open_grd(files[0])
+    ny, nx = like.shape
+    for fn in files[1:]:
+        da = open_grd(fn)
+        if da.shape != (ny, nx):
+            sys.exit('TS_CUBE: '+fn+' is not on the grid of '+files[0])
+        da.close()
+
+    S = len(files)
+    tmp = cube+'.tmp'
+    with netCDF4.Dataset(tmp, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', S)
+        ds.createDimension('y', ny)
+        ds.createDimension('x', nx)
+        ds.node_offset = np.int32(like.attrs.get('node_offset', 0))
+        ds.title = 'SBAS displacement time series of '+os.path.basename(scene_tab)
+        ds.createVariable('scene', 'i8', ('time',))[:] = ids
+        days_var = ds.createVariable('days', 'f8', ('time',))
+        days_var[:] = days
+        days_var.long_name = 'number of days of scene.tab'
+        ds.createVariable('x', 'f8', ('x',))[:] = like['x'].values
+        ds.createVariable('y', 'f8', ('y',))[:] = like['y'].values
+        disp = ds.createVariable('disp', 'f4', ('time', 'y', 'x'), fill_value=np.float32(np.nan),
+                                 chunksizes=(S, min(chunk, ny), min(chunk, nx)))
+        disp.units = 'mm'
+        for r0 in range(0, ny, chunk):
+            r1 = min(r0+chunk, ny)
+            disp[:, r0:r1, :] = np.stack([read_band(fn, r0, r1) for fn in files]).astype(np.float32)
+    like.close()
+    os.replace(tmp, cube)
+    print('TS_CUBE: ', S, ' grids of ', nx, ' by ', ny, ' written to ', cube)
+
+def lonlat_to_ra(lon, lat, prm, dem):
+    # lonlat_to_ra returns the range and azimuth of the points lon/lat, with
+    # the elevation of dem.grd, by one gmt grdtrack | SAT_llt2rat call for all
+    # points; points off the DEM keep their line (grdtrack -N) and get NaN.
+    text = ''.join('%.10f %.10f\n' % p for p in zip(lon, lat))
+    track = subprocess.run(['gmt', 'grdtrack', '-N', '-G'+dem], input=text, stdout=subprocess.PIPE,
+                           universal_newlines=True, check=True).stdout
+    rat = subprocess.run(['SAT_llt2rat', prm, '1'], input=track, stdout=subprocess.PIPE,
+                         universal_newlines=True, check=True).stdout
+    hgt = np.array([float(line.split()[2]) for line in track.splitlines() if line.strip() != ''])
+    ra = np.array([[float(v) for v in line.split()[:2]] for line in rat.splitlines() if line.strip() != '']).reshape(-1, 2)
+    if not (len(hgt) == len(ra) == len(lon)):
+        sys.exit('TS_CUBE: grdtrack/SAT_llt2rat did not return one line per point')
+    ra[~np.isfinite(hgt)] = np.nan
+    return ra[:, 0], ra[:, 1]
+
+def box_samples(xc, yc, x, y, m_rng=5, m_azi=5):
+    # box_samples returns the node indices (point, iy, ix) of the m_rng x m_azi
+    # boxes centred on the nodes nearest to the points x/y, cut at the grid edges;
+    # points with a NaN position get no node.
+    dx, dy = xc[1]-xc[0], yc[1]-yc[0]
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    off = ~(np.isfinite(x) & np.isfinite(y))
+    ix = np.rint((np.where(off, xc[0], x)-xc[0])/dx).astype(np.int64)
+    iy = np.rint((np.where(off, yc[0], y)-yc[0])/dy).astype(np.int64)
+    oy, ox = np.meshgrid(np.arange(m_azi)-m_azi//2, np.arange(m_rng)-m_rng//2, indexing='ij')
+    sy = (iy[:, None]+oy.ravel()[None, :]).ravel()
+    sx = (ix[:, None]+ox.ravel()[None, :]).ravel()
+    sp = np.repeat(np.arange(len(ix)), oy.size)
+    keep = (sy >= 0) & (sy < len(yc)) & (sx >= 0) & (sx < len(xc)) & ~off[sp]
+    return sp[keep], sy[keep], sx[keep]
+
+def read_samples(var, sy, sx):
+    # read_samples returns the S x n values of the cube variable var at the
+    # nodes sy/sx, reading every chunk under them once.
+    S, ny, nx = var.shape
+    cy, cx = var.chunking()[1:] if var.chunking() != 'contiguous' else (ny, nx)
+    ncx = (nx+cx-1)//cx
+    cid = (sy//cy)*ncx+sx//cx
+    order = np.argsort(cid, kind='stable')
+    uniq, start = np.unique(cid[order], return_index=True)
+    stop = np.append(start[1:], len(order))
+    out = np.full((S, len(sy)), np.nan, dtype=np.float32)
+    for c, a, b in zip(uniq, start, stop):
+        y0, x0 = (c//ncx)*cy, (c % ncx)*cx
+        block = np.ma.filled(var[:, y0:min(y0+cy, ny), x0:min(x0+cx, nx)], np.nan)
+        k = order[a:b]
+        out[:, k] = block[:, sy[k]-y0, sx[k]-x0]
+    return out
+
+def extract_points(cube, x, y, m_rng=5, m_azi=5):
+    # extract_points returns the scene ids, the days and the mean and standard
+    # deviation (npoint x S) of the m_rng x m_azi boxes around the points x/y
+    # (range/azimuth or the x/y of the grids), as grdinfo -L2 of the boxes.
+    import netCDF4
+    with netCDF4.Dataset(cube, 'r') as ds:
+        ids = np.asarray(ds.variables['scene'][:])
+        days = np.asarray(ds.variables['days'][:])
+        xc = np.asarray(ds.variables['x'][:])
+        yc = np.asarray(ds.variables['y'][:])
+        sp, sy, sx = box_samples(xc, yc, x, y, m_rng, m_azi)
+        z = read_samples(ds.variables['disp'], sy, sx).astype(np.float64)
+
+    npoint = len(np.atleast_1d(x))
+    ok = np.isfinite(z)
+    zf = np.where(ok, z, 0.)
+    count = np.zeros((len(ids), npoint))
+    total = np.zeros((len(ids), npoint))
+    for k in range(len(ids)):
+        count[k] = np.bincount(sp, ok[k], npoint)
+        total[k] = np.bincount(sp, zf[k], npoint)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+        ss = np.zeros_like(total)
+        for k in range(len(ids)):
+            ss[k] = np.bincount(sp, np.where(ok[k], (z[k]-mean[k, sp])**2, 0.), npoint)
+        std = np.sqrt(ss/(count-1))
+    return ids, days, mean.T, std.T
+
+def _main_func(description):
+    arg = sys.argv
+    valued = ['-chunk', '-prm', '-dem']
+    pos = [a for k, a in enumerate(arg[1:], 1)
+           if not a.startswith('-') and arg[k-1] not in valued
+           and not (k >= 2 and arg[k-2] == '-box') and arg[k-1] != '-box']
+
+    def Error_Message():
+        print(description)
+        print("Usage: ts_cube.py -build scene.tab cube.nc [-chunk n]")
+        print("       ts_cube.py -extract cube.nc points.txt time_series.dat [-box m_rng m_azi] [-prm PRM -dem dem.grd]")
+        print(" ")
+        print("  scene.tab   -- the scene table of sbas; disp_#######.grd of every scene are read")
+        print("  -chunk n    -- spatial size of a chunk of the cube, all scenes in a chunk (default 16)")
+        print("  points.txt  -- 'x y [name]' per line, range/azimuth (or lon/lat with -prm and -dem)")
+        print("  -box m_rng m_azi -- number of pixels averaged around the points, default is 5 5")
+        print("  output (time_series.dat): name scene_id days mean std, one line per point and scene")
+        print(" ")
+        print("Example: ts_cube.py -build scene.tab disp_cube.nc")
+        print("         ts_cube.py -extract disp_cube.nc gnss_sites.txt time_series.dat -prm supermaster.PRM -dem dem.grd")
+        sys.exit(1)
+
+    if '-build' in arg and len(pos) >= 2 and os.path.isfile(pos[0]):
+        chunk = int(assign_arg(arg, '-chunk')) or 16
+        build_cube(pos[0], pos[1], chunk)
+    elif '-extract' in arg and len(pos) >= 3 and os.path.isfile(pos[0]) and os.path.isfile(pos[1]):
+        m_rng, m_azi = 5, 5
+        if '-box' in arg:
+            m_rng, m_azi = int(arg[arg.index('-box')+1]), int(arg[arg.index('-box')+2])
+        x, y, names = [], [], []
+        with open(pos[1], 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                x.append(float(fields[0]))
+                y.append(float(fields[1]))
+                names.append(fields[2] if len(fields) > 2 else 'P%d' % len(names))
+        if '-prm' in arg:
+            x, y = lonlat_to_ra(x, y, assign_arg(arg, '-prm'), assign_arg(arg, '-dem'))
+        print('TS_CUBE: extracting ', len(names), ' points from ', pos[0], ' with ', m_rng, ' x ', m_azi, ' boxes')
+        ids, days, mean, std = extract_points(pos[0], x, y, m_rng, m_azi)
+        with open(pos[2], 'w') as f:
+            for p, name in enumerate(names):
+                for k in range(len(ids)):
+                    f.write('%s %d %g %g %g\n' % (name, ids[k], days[k], mean[p, k], std[p, k]))
+    else:
+        Error_Message()
+    print('TS_CUBE - END ... ...')
+
+if __name__ == "__main__":
+    _main_func(__doc__)